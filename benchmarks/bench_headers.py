@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the header handling of the ProxyHandler, to spot
+performance regressions in the CPU time spent per request (which
+`bench_proxy.py` hides behind the network and the upstream).
+
+For a typical browser request (with the cookies of the hub) and response,
+it reports the CPU time per request of:
+- request: the headers sent to the upstream (`get_upstream_headers`);
+- response: the headers of the response set from the upstream ones
+  (`_set_upstream_headers`).
+
+Each one is measured next to its baseline: the per-header loops that
+jhproxy used before `jhproxy.headers` (a copy of the request headers with
+three headers deleted one by one, and `add_header` for each header of the
+response, which validates the values again). The baseline request does less
+work (it neither strips the cookies of the hub nor sets the X-Forwarded-*
+headers), so it is an upper bound of the old speed.
+
+The handler runs without a hub, as in `bench_proxy.py`.
+
+Usage: python benchmarks/bench_headers.py [--iterations N] [--repeat N]
+       [--json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+
+from tornado import httputil, web
+
+# Benchmark the jhproxy of this checkout
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_proxy import PROXY_PORT, stub_hub # pylint: disable=wrong-import-position
+
+# The headers skipped by the baseline loops
+BASELINE_REQUEST_SKIPPED = ('Proxy-Connection', 'Transfer-Encoding', 'Expect')
+BASELINE_RESPONSE_SKIPPED = ('Content-Length', 'Transfer-Encoding',
+                             'Connection')
+
+REQUEST_HEADERS = [
+    ('Host', 'hub.example.org'),
+    ('User-Agent',
+     'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'),
+    ('Accept',
+     'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'),
+    ('Accept-Language', 'en-US,en;q=0.5'),
+    ('Accept-Encoding', 'gzip, deflate, br'),
+    ('Referer', 'https://hub.example.org/hub/proxy/user0/'),
+    ('Cookie', '_xsrf=2|8a3b|1c2d|1700000000; '
+     'jupyterhub-hub-login=2|1:0|10:1700000000|20:jupyterhub-hub-login|'
+     '44:ZjE2ZTc0ZjY0; jupyterhub-session-id=0123456789abcdef; theme=dark'),
+    ('Connection', 'keep-alive'),
+    ('Upgrade-Insecure-Requests', '1'),
+    ('Sec-Fetch-Dest', 'document'),
+    ('Sec-Fetch-Mode', 'navigate'),
+    ('Sec-Fetch-Site', 'same-origin'),
+    ('X-Forwarded-For', '192.0.2.10'),
+    ('X-Forwarded-Proto', 'https'),
+    ('Cache-Control', 'max-age=0'),
+]
+
+RESPONSE_HEADERS = [
+    ('Server', 'TornadoServer/6.4'),
+    ('Content-Type', 'text/html; charset=UTF-8'),
+    ('Date', 'Sat, 17 Oct 2026 09:00:00 GMT'),
+    ('Etag', '"0123456789abcdef"'),
+    ('Content-Length', '12345'),
+    ('Cache-Control', 'no-cache'),
+    ('Set-Cookie', 'session=1; Path=/; HttpOnly'),
+    ('Set-Cookie', 'theme=dark; Path=/'),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('Vary', 'Accept-Encoding'),
+    ('Connection', 'keep-alive'),
+    ('Keep-Alive', 'timeout=5'),
+    ('Last-Modified', 'Sat, 17 Oct 2026 08:00:00 GMT'),
+    ('Content-Security-Policy', "frame-ancestors 'self'"),
+]
+
+
+class _Connection(object):
+    """The connection of a request that is never written."""
+
+    def set_close_callback(self, callback):
+        pass
+
+
+def make_handler():
+    """Return a ProxyHandler for a request with REQUEST_HEADERS."""
+    from jhproxy import ProxyHandler
+
+    headers = httputil.HTTPHeaders()
+    for name, value in REQUEST_HEADERS:
+        headers.add(name, value)
+    request = httputil.HTTPServerRequest(
+        method='GET', uri='/proxy/user0/index.html', headers=headers,
+        connection=_Connection())
+    request.remote_ip = '192.0.2.20'
+    return ProxyHandler(web.Application(), request, proxy_port=PROXY_PORT)
+
+
+def get_baseline_request_headers(handler):
+    """The headers sent to the upstream, as computed before."""
+    headers = handler.request.headers.copy()
+    for header in BASELINE_REQUEST_SKIPPED:
+        if header in headers:
+            del headers[header]
+    return headers
+
+
+def get_baseline_copy_headers(handler):
+    """
+    Return a replacement of `jhproxy.headers.copy_headers` for the
+    response headers of the handler, with the loop used before.
+    """
+
+    def copy_headers(headers, target, skipped): # pylint: disable=unused-argument
+        for header, value in headers.get_all():
+            if header not in BASELINE_RESPONSE_SKIPPED:
+                handler.add_header(header, value)
+        return target
+
+    return copy_headers
+
+
+def measure(function, iterations, repeat):
+    """Return the best CPU time per call of function, in microseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(iterations):
+            function()
+        elapsed = (time.process_time() - start) / iterations * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of the header handling of jhproxy")
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help="calls per measurement")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="measurements (the best one is reported)")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    options = parser.parse_args()
+
+    stub_hub()
+    import jhproxy.proxy
+
+    handler = make_handler()
+    upstream_headers = httputil.HTTPHeaders()
+    for name, value in RESPONSE_HEADERS:
+        upstream_headers.add(name, value)
+
+    def set_upstream_headers():
+        handler._set_upstream_headers( # pylint: disable=protected-access
+            200, 'OK', upstream_headers)
+
+    results = {
+        'request': measure(handler.get_upstream_headers, options.iterations,
+                           options.repeat),
+        'request_baseline': measure(
+            lambda: get_baseline_request_headers(handler),
+            options.iterations, options.repeat),
+        'response': measure(set_upstream_headers, options.iterations,
+                            options.repeat),
+    }
+    # The same handler method, with the loop used before
+    copy_headers = jhproxy.proxy.copy_headers
+    jhproxy.proxy.copy_headers = get_baseline_copy_headers(handler)
+    try:
+        results['response_baseline'] = measure(
+            set_upstream_headers, options.iterations, options.repeat)
+    finally:
+        jhproxy.proxy.copy_headers = copy_headers
+    if options.json:
+        print(json.dumps(results))
+        return
+    for name, usec in results.items():
+        print("{:<18} {:8.2f} us/request".format(name, usec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Benchmark of the jhproxy handlers, to spot performance regressions.
+
+Everything runs locally, without docker nor network access:
+- an upstream HTTP server (the service "inside the containers"), in its own
+  process, serving small responses and large streamed bodies;
+- the proxy, in its own process: a tornado application with the jhproxy
+  handlers, where the hub is stubbed (no database, the user is taken from
+  the `X-Bench-User` header) and the spawners are `TokenizedDockerSpawner`s
+  whose `docker("inspect_container")` answers after a configurable latency;
+- the load generator, in this process.
+
+Each scenario starts a new proxy process (so the caches are cold) and
+reports the requests per second, the p50/p99 latency and the peak RSS of
+the proxy process:
+- small: small responses for a single user (no token);
+- large: large bodies streamed through the proxy;
+- users: small responses for many users, round-robin;
+- token: small responses for a single user, protected by a token;
+- tokenapi: GET requests to the ProxyTokenHandler.
+
+The absolute numbers depend on the machine (and the three processes share
+its cores): compare runs on the same machine, e.g. before and after a change.
+
+Usage: python benchmarks/bench_proxy.py [--scenario small --scenario ...]
+       [--requests N] [--concurrency N] [--users N] [--docker-latency S]
+       [--large-size MB] [--streaming-handler] [--upstream-client curl]
+       [--json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import types
+
+from tornado import gen, httpclient, httpserver, netutil, web
+from tornado.ioloop import IOLoop
+
+# Benchmark the jhproxy of this checkout
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROXY_PORT = 5000
+SCENARIOS = ('small', 'large', 'users', 'token', 'tokenapi')
+
+
+## Upstream
+
+class UpstreamHandler(web.RequestHandler):
+    """The service proxied: small responses, or large streamed bodies."""
+
+    @gen.coroutine
+    def get(self, path):
+        if path == 'small':
+            self.write('x' * 100)
+            return
+        size = int(self.get_argument('size'))
+        chunk = b'x' * 65536
+        while size > 0:
+            self.write(chunk[:size])
+            size -= len(chunk)
+            yield self.flush()
+
+
+def run_upstream(conn):
+    """Run the upstream server, sending its port through conn."""
+    sock, = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(
+        web.Application([(r'/(.*)', UpstreamHandler)]))
+    server.add_sockets([sock])
+    conn.send(sock.getsockname()[1])
+    IOLoop.current().start()
+
+
+## Proxy
+
+def stub_hub():
+    """
+    Replace the parts of the JupyterHub BaseHandler that need a running hub
+    (database, hub settings, cookies) with the plain tornado ones.
+    """
+    from jupyterhub.handlers.base import BaseHandler
+
+    @gen.coroutine
+    def prepare(self):
+        username = self.request.headers.get('X-Bench-User')
+        self._jupyterhub_user = (types.SimpleNamespace(name=username)
+                                 if username else None)
+
+    BaseHandler.prepare = prepare
+    BaseHandler.finish = web.RequestHandler.finish
+    BaseHandler.set_default_headers = web.RequestHandler.set_default_headers
+    BaseHandler.write_error = web.RequestHandler.write_error
+
+
+def make_spawner_class():
+    """Return a TokenizedDockerSpawner with a fake docker API."""
+    from jhproxy.spawners import TokenizedDockerSpawner
+
+    class BenchSpawner(TokenizedDockerSpawner):
+        """A spawner whose container maps PROXY_PORT to the upstream."""
+
+        def __init__(self, username, upstream_port, docker_latency):
+            super().__init__()
+            self.user = types.SimpleNamespace(name=username)
+            self.object_id = 'container-{}'.format(username)
+            self.upstream_port = upstream_port
+            self.docker_latency = docker_latency
+
+        @gen.coroutine
+        def docker(self, method, *args, **kwargs):
+            yield gen.sleep(self.docker_latency)
+            raise gen.Return({'NetworkSettings': {'Ports': {
+                '{}/tcp'.format(PROXY_PORT): [{
+                    'HostIp': self.host_ip,
+                    'HostPort': str(self.upstream_port)
+                }]
+            }}})
+
+    return BenchSpawner
+
+
+class StatsHandler(web.RequestHandler):
+    """Return the peak RSS and the cache statistics of the proxy process."""
+
+    def get(self):
+        from jhproxy.routes import route_cache, user_routes
+        self.write({
+            # KB on Linux
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'route_cache': route_cache.stats(),
+            'user_routes': user_routes.stats(),
+        })
+
+
+def run_proxy(conn, upstream_port, options):
+    """Run the proxy server, sending its port through conn."""
+    stub_hub()
+    from jhproxy import ProxyHandler, ProxyTokenHandler, StreamingProxyHandler
+
+    spawner_class = make_spawner_class()
+    spawners = {}
+    for i in range(options.users):
+        username = 'user{}'.format(i)
+        spawner = spawner_class(username, upstream_port,
+                                options.docker_latency)
+        spawner.set_token('')
+        spawners[username] = spawner
+    # The token scenario uses its own user
+    spawners['tokenuser'] = spawner_class('tokenuser', upstream_port,
+                                          options.docker_latency)
+    spawners['tokenuser'].set_token('secret')
+
+    class BenchMixin(object):
+        def get_spawner_from_username(self, username):
+            return spawners.get(username)
+
+    proxy_class = (StreamingProxyHandler
+                   if options.streaming_handler else ProxyHandler)
+    BenchProxyHandler = type('BenchProxyHandler', (BenchMixin, proxy_class), {})
+    BenchTokenHandler = type('BenchTokenHandler',
+                             (BenchMixin, ProxyTokenHandler), {})
+
+    app = web.Application([
+        (r'/proxy/([^/]+)(/.*)', BenchProxyHandler, dict(
+            proxy_port=PROXY_PORT,
+            upstream_client=options.upstream_client)),
+        (r'/proxytoken/?', BenchTokenHandler),
+        (r'/_bench/stats', StatsHandler),
+    ])
+    sock, = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    conn.send(sock.getsockname()[1])
+    IOLoop.current().start()
+
+
+def start_process(target, *args):
+    """Start target(conn, *args) in a new process, return it and its port."""
+    # Not forked: the child must not share the event loop of this process
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=target, args=(child_conn,) + args)
+    process.daemon = True
+    process.start()
+    return process, parent_conn.recv()
+
+
+## Load generator
+
+def get_requests(scenario, options):
+    """Return the (path, headers) of the requests of a scenario."""
+    if scenario == 'small':
+        return [('/proxy/user0/small', {})] * options.requests
+    if scenario == 'large':
+        size = options.large_size * 1024 * 1024
+        return [('/proxy/user0/large?size={}'.format(size), {})] * max(
+            1, options.requests // 100)
+    if scenario == 'users':
+        return [('/proxy/user{}/small'.format(i % options.users), {})
+                for i in range(options.requests)]
+    if scenario == 'token':
+        return [('/proxy/tokenuser/small', {'X-Proxy-Token': 'secret'})
+                ] * options.requests
+    if scenario == 'tokenapi':
+        return [('/proxytoken/', {'X-Bench-User': 'tokenuser'})
+                ] * options.requests
+    raise RuntimeError("Unknown scenario '{}'".format(scenario))
+
+
+def percentile(values, fraction):
+    """Return the percentile of a sorted list."""
+    if not values:
+        return float('nan')
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+@gen.coroutine
+def run_load(proxy_port, requests, concurrency):
+    """
+    Send the requests with the given concurrency; return the sorted
+    latencies, the number of errors and the total duration.
+    """
+    client = httpclient.AsyncHTTPClient(force_instance=True,
+                                        max_clients=concurrency)
+    pending = iter(requests)
+    latencies = []
+    errors = [0]
+
+    def discard(chunk): # pylint: disable=unused-argument
+        pass
+
+    @gen.coroutine
+    def worker():
+        for path, headers in pending:
+            start = time.perf_counter()
+            response = yield client.fetch(
+                'http://127.0.0.1:{}{}'.format(proxy_port, path),
+                headers=headers, streaming_callback=discard,
+                request_timeout=600, raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            if response.code != 200:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    yield [worker() for _ in range(concurrency)]
+    duration = time.perf_counter() - start
+    client.close()
+    raise gen.Return((sorted(latencies), errors[0], duration))
+
+
+@gen.coroutine
+def get_stats(proxy_port):
+    """Return the statistics of the proxy process."""
+    response = yield httpclient.AsyncHTTPClient().fetch(
+        'http://127.0.0.1:{}/_bench/stats'.format(proxy_port))
+    raise gen.Return(json.loads(response.body.decode('utf-8')))
+
+
+def run_scenario(scenario, upstream_port, options):
+    """Run a scenario against a new proxy process, return its results."""
+    proxy, proxy_port = start_process(run_proxy, upstream_port, options)
+    try:
+        requests = get_requests(scenario, options)
+        latencies, errors, duration = IOLoop.current().run_sync(
+            lambda: run_load(proxy_port, requests, options.concurrency))
+        stats = IOLoop.current().run_sync(lambda: get_stats(proxy_port))
+    finally:
+        proxy.terminate()
+        proxy.join()
+    return {
+        'scenario': scenario,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': stats['max_rss'] / 1024.,
+        'route_cache': stats['route_cache'],
+        'user_routes': stats['user_routes'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the jhproxy handlers")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="requests per scenario (the 'large' scenario "
+                        "sends 1 per 100)")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="requests sent concurrently")
+    parser.add_argument('--users', type=int, default=100,
+                        help="number of users of the 'users' scenario")
+    parser.add_argument('--docker-latency', type=float, default=0.05,
+                        help="seconds taken by each inspect_container call")
+    parser.add_argument('--large-size', type=int, default=10,
+                        help="size in MB of the bodies of the 'large' "
+                        "scenario")
+    parser.add_argument('--streaming-handler', action='store_true',
+                        help="use the StreamingProxyHandler")
+    parser.add_argument('--upstream-client', default='simple',
+                        choices=('simple', 'curl'),
+                        help="backend of the client used by the proxy")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    options = parser.parse_args()
+
+    upstream, upstream_port = start_process(run_upstream)
+    try:
+        results = [
+            run_scenario(scenario, upstream_port, options)
+            for scenario in options.scenario or SCENARIOS
+        ]
+    finally:
+        upstream.terminate()
+        upstream.join()
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("{:<10} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms',
+        'RSS MB'))
+    for result in results:
+        print("{scenario:<10} {requests:>8} {errors:>7} "
+              "{requests_per_second:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} "
+              "{peak_rss_mb:>9.1f}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
-from jhproxy import ProxyHandler, ProxyTokenHandler
+from jhproxy import (MultiPortProxyHandler, ProxyHandler,
+                     ProxyTokenAdminHandler, ProxyTokenHandler)
+from jhproxy.routes import port_policy
 
 c = get_config() # pylint: disable=undefined-variable; # flake8: noqa
 
@@ -18,6 +20,10 @@ c.DockerSpawner.image = "aiidalab/aiidalab-docker-stack:latest"
 ## - Enable proxy with randomly-generated token authentication by default
 c.TokenizedDockerSpawner.default_startup_behavior = "random"
 
+# When a token is regenerated, keep accepting the previous one for a while,
+# so that the clients can switch to the new one gradually
+c.TokenizedDockerSpawner.token_rotation_grace_period = 300
+
 # I show as an example how to proxy more than one port:
 # This is not needed of course.
 # These are the ports INSIDE the docker container that you want to expose
@@ -54,22 +60,43 @@ c.DockerSpawner.extra_host_config.update({
     'init': True,
     })
 
+# The ports that can be proxied. They can be changed without restarting
+# the hub: e.g. use port_policy.watch('/etc/jhproxy/ports.json') instead,
+# to read them from a JSON list, again whenever the file changes. A spawner
+# can also set its own, with c.TokenizedDockerSpawner.proxy_allowed_ports.
+port_policy.set(proxy_ports)
+
 # Define our extra handlers
 # Only one proxytoken handler (to get, change tokens) as the token
 # is stored in the spawner, so its the same for all ports
 extra_handlers = [(r'/proxytoken/', ProxyTokenHandler)] 
-for proxy_port in proxy_ports:
-    # You can change the URL if you want. Important, however: 
-    # 1. if you use more than one proxy_port, give them different names
-    # 2. remember to pass the third parameter (even if you have only
-    #    one proxy handler) to configure the handler port.
-    extra_handlers.append(
-        (
-            r'/proxy{}/([^/]+)(/.*)'.format(proxy_port), 
-            ProxyHandler, 
-            dict(proxy_port=proxy_port)
-        ),
-    )
+# The admins can change the tokens of many users at once (e.g. to rotate
+# or disable them after an incident)
+extra_handlers.append((r'/proxytoken-admin/', ProxyTokenAdminHandler))
+# A single handler proxies all the ports, taking the port from the first
+# group of the URL (here, /hub/proxy<PORT>/<USER>/...).
+# You can change the URL if you want. Notes:
+# 1. if the service receives large uploads, use the
+#    MultiPortStreamingProxyHandler instead, that forwards the request body
+#    while it is received (set its `max_body_size` option to accept
+#    bodies larger than 100MB).
+# 2. to protect the hub from a flood of requests to a port, limit the
+#    requests of each user and token with the `rate_limit` (requests per
+#    second) and `max_concurrent_requests` options (they can also be
+#    set per spawner, e.g. c.TokenizedDockerSpawner.proxy_rate_limit).
+# 3. to route the requests from the proxy of JupyterHub straight to the
+#    containers, without passing through the hub, set
+#    c.TokenizedDockerSpawner.proxy_route_ports = proxy_ports and
+#    c.JupyterHub.proxy_class = 'jhproxy.hubproxy.ConfigurableHTTPProxy'.
+#    configurable-http-proxy does not check the proxy tokens: the routes
+#    are only added for the users that allow all the requests, not with
+#    the "random" tokens above, unless a proxy in front asks the
+#    jhproxy.ProxyAuthHandler before forwarding each request (then set
+#    c.TokenizedDockerSpawner.proxy_route_forward_auth = True, see the
+#    README).
+# 4. to proxy a single port with its own options, use a ProxyHandler,
+#    e.g. (r'/proxy5000/([^/]+)(/.*)', ProxyHandler, dict(proxy_port=5000)).
+extra_handlers.append((r'/proxy(\d+)/([^/]+)(/.*)', MultiPortProxyHandler))
 c.JupyterHub.extra_handlers = extra_handlers
 
 ##########################################################################
@@ -1,3 +1,5 @@
-from .proxy import ProxyHandler, ProxyTokenHandler
+from .proxy import (MultiPortProxyHandler, MultiPortStreamingProxyHandler,
+                    ProxyAuthHandler, ProxyHandler, ProxyTokenAdminHandler,
+                    ProxyTokenHandler, StreamingProxyHandler)
 
 __version__ = "0.1.1"
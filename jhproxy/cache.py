@@ -0,0 +1,227 @@
+from jhproxy.metrics import stats_collector
+import collections
+import time
+
+
+def parse_cache_control(value):
+    """
+    Parse the value of a Cache-Control header into a dictionary
+    {directive: value}, with lowercase directives (value is None for
+    directives without argument).
+    """
+    directives = {}
+    for directive in value.split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def _get_seconds(directives, name):
+    """Return the value of a directive like max-age in seconds, or None."""
+    try:
+        return int(directives[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CachedResponse(object):
+    """
+    A response of the upstream, stored in a `ResponseCache`.
+    """
+
+    def __init__(self, key, code, reason, headers, body, ttl): # pylint: disable=too-many-arguments
+        self.key = key
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.etag = headers.get('Etag')
+        self.set_ttl(ttl)
+        self.size = len(body) + sum(
+            len(k) + len(v) for k, v in headers.get_all())
+
+    def is_fresh(self):
+        """Return True if the response can be served without revalidation."""
+        return time.monotonic() < self.expires
+
+    def refresh(self, headers):
+        """
+        Update the headers with the ones of a 304 response of the upstream
+        (confirming that the response did not change).
+        """
+        for header in ('Cache-Control', 'Date', 'Etag', 'Expires', 'Vary'):
+            if header in headers:
+                self.headers[header] = headers[header]
+        self.etag = self.headers.get('Etag')
+
+    def set_ttl(self, ttl):
+        """Keep the response fresh for ttl more seconds."""
+        self.expires = time.monotonic() + ttl
+
+
+class ResponseCache(object):
+    """
+    An in-process cache of the responses to the proxied GET requests,
+    honoring the Cache-Control headers of the upstream.
+
+    The cache is shared by all the users, so the callers pass a key that
+    identifies the request (user, proxy port, path, query and token scope),
+    to which the request headers listed in the Vary header of the response
+    are added.
+    The least recently used responses are evicted once the total size goes
+    over `max_size` bytes; responses larger than `max_entry_size` are not
+    cached, and none is considered fresh for more than `max_ttl` seconds.
+    Stale responses with an ETag are kept, to be revalidated with a
+    conditional request to the upstream.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=1024 * 1024,
+                 max_ttl=3600):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.max_ttl = max_ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        # Names of the request headers in the Vary of the responses, and
+        # number of stored responses (one per variant), for each key
+        self._vary = {}
+        self._variants = collections.Counter()
+
+    @staticmethod
+    def is_cacheable_request(method, request_headers):
+        """
+        Return True if the response to this request can be looked up in
+        (and stored to) the cache.
+        """
+        if method != 'GET' or 'Range' in request_headers:
+            return False
+        directives = parse_cache_control(
+            request_headers.get('Cache-Control', ''))
+        return 'no-store' not in directives
+
+    @staticmethod
+    def wants_revalidation(request_headers):
+        """Return True if the client asks not to get a cached response."""
+        directives = parse_cache_control(
+            request_headers.get('Cache-Control', ''))
+        return 'no-cache' in directives or directives.get('max-age') == '0'
+
+    def get_ttl(self, code, headers, request_headers):
+        """
+        Return for how many seconds the response can be served from the
+        cache (0: it must be revalidated first), or None if the response
+        must not be cached.
+        """
+        if code != 200 or 'Set-Cookie' in headers:
+            return None
+        if headers.get('Vary', '').strip() == '*':
+            return None
+        directives = parse_cache_control(headers.get('Cache-Control', ''))
+        if 'no-store' in directives or 'private' in directives:
+            return None
+        if ('Authorization' in request_headers and 'public' not in directives
+                and 's-maxage' not in directives):
+            return None
+
+        ttl = _get_seconds(directives, 's-maxage')
+        if ttl is None:
+            ttl = _get_seconds(directives, 'max-age')
+        if ttl is None or 'no-cache' in directives:
+            ttl = 0
+        try:
+            ttl -= int(headers.get('Age', 0))
+        except ValueError:
+            pass
+        ttl = max(0, min(ttl, self.max_ttl))
+        if not ttl and 'Etag' not in headers:
+            # Could never be served without revalidation
+            return None
+        return ttl
+
+    def _get_full_key(self, key, request_headers):
+        vary = self._vary.get(key, ())
+        return key + tuple(request_headers.get(name) for name in vary)
+
+    def get(self, key, request_headers):
+        """
+        Return the CachedResponse for the request, or None. The returned
+        response might be stale: check it with `CachedResponse.is_fresh`.
+        """
+        full_key = self._get_full_key(key, request_headers)
+        entry = self._entries.get(full_key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if not entry.is_fresh() and entry.etag is None:
+            self._remove(full_key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(full_key)
+        if entry.is_fresh():
+            self.hits += 1
+        else:
+            # To revalidate: a miss, unless the upstream answers with a 304
+            self.misses += 1
+        return entry
+
+    def set(self, key, request_headers, code, reason, headers, body, ttl):
+        """
+        Store a response (with the ttl returned by `get_ttl`) in the cache.
+        """
+        if len(body) > self.max_entry_size:
+            return
+        vary = tuple(sorted(
+            name.strip().lower()
+            for name in headers.get('Vary', '').split(',') if name.strip()))
+        full_key = key + tuple(request_headers.get(name) for name in vary)
+        if full_key in self._entries:
+            self._remove(full_key)
+        if vary:
+            self._vary[key] = vary
+        else:
+            self._vary.pop(key, None)
+
+        entry = CachedResponse(key, code, reason, headers, body, ttl)
+        self._entries[full_key] = entry
+        self._variants[key] += 1
+        self.size += entry.size
+        while self.size > self.max_size and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, full_key):
+        entry = self._entries.pop(full_key)
+        self.size -= entry.size
+        self._variants[entry.key] -= 1
+        if not self._variants[entry.key]:
+            del self._variants[entry.key]
+            self._vary.pop(entry.key, None)
+
+    def clear(self):
+        """Remove all the responses from the cache."""
+        self._entries.clear()
+        self._vary.clear()
+        self._variants.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return a dictionary with the cache counters and size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'size': self.size,
+        }
+
+
+# Process-wide cache, used by the handlers with the `cache_responses` option
+response_cache = ResponseCache()
+stats_collector.register('response_cache', response_cache.stats,
+                         "Cache of the upstream responses")
@@ -0,0 +1,115 @@
+from tornado import simple_httpclient
+from tornado.ioloop import IOLoop
+from jhproxy.metrics import stats_collector
+import sys
+
+# Clients shared by all the handlers of the process,
+# by (IOLoop, backend, max_clients)
+_clients = {}
+
+
+class _BackpressureHTTPConnection(simple_httpclient._HTTPConnection): # pylint: disable=protected-access
+    """
+    HTTP connection that gives backpressure to the `streaming_callback`.
+
+    If the `streaming_callback` returns a Future (e.g. the one returned by
+    `RequestHandler.flush()`), the next chunk is not read from the upstream
+    until the Future is resolved, so that a slow client does not make
+    the whole upstream response pile up in memory.
+    """
+
+    def data_received(self, chunk):
+        if self._should_follow_redirect():
+            # We're going to follow a redirect so just discard the body.
+            return None
+        if self.request.streaming_callback is not None:
+            return self.request.streaming_callback(chunk)
+        self.chunks.append(chunk)
+        return None
+
+
+class StreamingAsyncHTTPClient(simple_httpclient.SimpleAsyncHTTPClient):
+    """
+    A SimpleAsyncHTTPClient where the `streaming_callback` can apply
+    backpressure (see `_BackpressureHTTPConnection`).
+    """
+
+    def _connection_class(self):
+        return _BackpressureHTTPConnection
+
+
+def get_upstream_client(backend='simple', max_clients=100):
+    """
+    Return the client used to fetch the upstream responses.
+
+    Clients are shared by all the handlers of the process: there is a
+    single instance for each backend and max_clients (the number of
+    requests that are run concurrently, the others wait in a queue).
+
+    The backend can be:
+    * 'simple': tornado's SimpleAsyncHTTPClient, without dependencies.
+      It opens a new connection for each request (there is no keep-alive),
+      and it applies backpressure to streamed responses.
+    * 'curl': tornado's CurlAsyncHTTPClient (requires `pycurl`). libcurl
+      keeps the connections to each upstream alive and reuses them for the
+      next requests; streamed responses are only paused after 1MB is waiting
+      to be passed to the handler, and request bodies cannot be streamed
+      (no `body_producer`).
+
+    max_clients is shared by all the requests of the client, whatever their
+    user and upstream.
+
+    Buffered (non-streamed) responses are still limited to 100MB, while
+    there is no limit to the size of streamed responses, as they are never
+    kept in memory.
+    """
+    key = (IOLoop.current(), backend, max_clients)
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+
+    if backend == 'simple':
+        client = StreamingAsyncHTTPClient(
+            force_instance=True, max_clients=max_clients,
+            max_body_size=sys.maxsize)
+    elif backend == 'curl':
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        client = CurlAsyncHTTPClient(
+            force_instance=True, max_clients=max_clients,
+            max_body_size=sys.maxsize)
+    else:
+        raise RuntimeError(
+            "The upstream client backend was set to an unknown value '{}'"
+            .format(backend))
+    _clients[key] = client
+    return client
+
+
+def get_upstream_client_stats():
+    """
+    Return the occupancy of the upstream clients: a list of dictionaries
+    with the backend, the maximum number of concurrent requests
+    (`max_clients`), the number of `active` requests and of the `queued`
+    ones, waiting for a free slot.
+    """
+    stats = []
+    for (_, backend, max_clients), client in _clients.items():
+        if backend == 'curl':
+            active = max_clients - len(client._free_list) # pylint: disable=protected-access
+            queued = len(client._requests) # pylint: disable=protected-access
+        else:
+            active = len(client.active)
+            queued = len(client.queue)
+        stats.append({
+            'backend': backend,
+            'max_clients': max_clients,
+            'active': active,
+            'queued': queued,
+        })
+    return stats
+
+
+stats_collector.register('upstream_client', get_upstream_client_stats,
+                         "Occupancy of the upstream clients",
+                         labels=('backend', 'max_clients'))
@@ -0,0 +1,176 @@
+"""
+Coalescing of the identical GET requests proxied at the same time (e.g. the
+viewers of a dashboard all loading it at once): the first one is sent to the
+upstream, and the ones that arrive before its response starts wait for it,
+and get its response streamed to them as well, instead of sending their own
+request.
+
+Requests are identical if they are for the same user, proxy port, path,
+query and token scope, with the same Accept-Encoding, Authorization, Cookie
+and conditional headers. A waiting request sends its own request after all
+if the response cannot be shared with it (see `is_shareable`), or if the
+first request fails before getting a response.
+
+The response is read from the upstream as fast as the slowest client (the
+first one and the followers) flushes it, so at most one chunk per client is
+kept in memory. The first request keeps reading the upstream for its
+followers if its own client disconnects.
+"""
+from tornado import gen
+from tornado.concurrent import Future
+from jhproxy.cache import parse_cache_control
+from jhproxy.metrics import stats_collector
+
+# The request headers that are part of the key of a request, besides the
+# Accept-Encoding (already in the cache key of the handlers)
+KEY_HEADERS = ('Authorization', 'Cookie', 'If-None-Match',
+               'If-Modified-Since')
+
+
+def get_key(cache_key, request_headers):
+    """Return the key of a request, from its cache key and its headers."""
+    return cache_key + tuple(request_headers.get(name) for name in KEY_HEADERS)
+
+
+def is_shareable(headers, request_headers, other_request_headers):
+    """
+    Return True if the response (its headers) to a request can also be sent
+    for another request with the same key.
+    """
+    if 'Set-Cookie' in headers:
+        return False
+    directives = parse_cache_control(headers.get('Cache-Control', ''))
+    if 'private' in directives or 'no-store' in directives:
+        return False
+    for name in headers.get('Vary', '').split(','):
+        name = name.strip()
+        if name == '*':
+            return False
+        if name and (request_headers.get(name) !=
+                     other_request_headers.get(name)):
+            return False
+    return True
+
+
+class Flight(object):
+    """
+    A request sent to the upstream, whose response is shared with the
+    followers: the identical requests that arrive before the response
+    starts.
+    """
+
+    def __init__(self, coalescer, key, request_headers):
+        self.key = key
+        self.request_headers = request_headers
+        self._coalescer = coalescer
+        self._followers = []
+        self._started = False
+
+    def follow(self, on_headers, on_chunk):
+        """
+        Share the response with a follower: `on_headers(code, reason,
+        headers)` is called when the response starts (and returns False if
+        the follower does not take it), then `on_chunk(chunk)` for each chunk
+        of the body, that returns a Future resolved once the chunk is flushed
+        to the client of the follower.
+
+        Return a future resolved with True once the response has been
+        shared, or False if the follower must send its own request; it is
+        failed with the error of the upstream if the response is cut short.
+        """
+        future = Future()
+        self._followers.append((on_headers, on_chunk, future))
+        return future
+
+    def start(self, code, reason, headers):
+        """Start the response of the followers (no new one can follow)."""
+        self._coalescer.end(self)
+        self._started = True
+        followers = []
+        for on_headers, on_chunk, future in self._followers:
+            if on_headers(code, reason, headers):
+                followers.append((on_headers, on_chunk, future))
+            else:
+                future.set_result(False)
+        self._followers = followers
+
+    @gen.coroutine
+    def write(self, chunk, flushed=None):
+        """
+        Send a chunk of the body to the followers, and wait until they have
+        flushed it; the followers whose flush fails (e.g. their client
+        disconnected) are dropped, with the error.
+
+        flushed is the Future of the flush of the chunk to the client of the
+        request in flight: its error is only raised (to stop reading the
+        upstream) if no follower is left.
+        """
+        followers = list(self._followers)
+        flushes = [on_chunk(chunk) for _, on_chunk, _ in followers]
+        for follower, flush in zip(followers, flushes):
+            try:
+                yield flush
+            except Exception as exc: # pylint: disable=broad-except
+                if follower in self._followers:
+                    self._followers.remove(follower)
+                    follower[2].set_exception(exc)
+        if flushed is not None:
+            try:
+                yield flushed
+            except Exception: # pylint: disable=broad-except
+                if not self._followers:
+                    raise
+
+    def finish(self, error=None):
+        """End the response of the followers (with the error, if any)."""
+        self._coalescer.end(self)
+        for _, _, future in self._followers:
+            if not self._started:
+                future.set_result(False)
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                self._coalescer.hits += 1
+                future.set_result(True)
+        self._followers = []
+
+
+class RequestCoalescer(object):
+    """
+    The requests in flight that can be followed, by key.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.flights = 0
+        self._flights = {}
+
+    def join(self, key):
+        """Return the Flight of the key that can be followed, or None."""
+        return self._flights.get(key)
+
+    def begin(self, key, request_headers):
+        """Return a new Flight for the key, that others can follow."""
+        flight = self._flights[key] = Flight(self, key, request_headers)
+        self.flights += 1
+        return flight
+
+    def end(self, flight):
+        """Stop new requests from following the flight."""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self):
+        """Return a dictionary with the coalescing counters."""
+        return {
+            'in_flight': len(self._flights),
+            'flights': self.flights,
+            'hits': self.hits,
+        }
+
+
+# Process-wide coalescer, used by the handlers with the `coalesce_requests`
+# option
+request_coalescer = RequestCoalescer()
+stats_collector.register('request_coalescer', request_coalescer.stats,
+                         "Coalescing of the identical requests")
@@ -0,0 +1,177 @@
+"""
+Compression of the proxied responses, on the fly (see the
+`compress_responses` option of `jhproxy.ProxyHandler`).
+
+Brotli is used only if the `brotli` package is installed; gzip is always
+available.
+"""
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression levels, favouring speed: the responses are compressed while
+# they are streamed
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+# The content types worth compressing (besides text/*)
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/atom+xml',
+    'application/xhtml+xml',
+    'application/wasm',
+    'image/svg+xml',
+])
+
+
+def is_compressible(content_type):
+    """Return True if the responses of the content type are compressible."""
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return (content_type.startswith('text/')
+            or content_type in COMPRESSIBLE_TYPES
+            or content_type.endswith('+json')
+            or content_type.endswith('+xml'))
+
+
+def parse_accept_encoding(value):
+    """
+    Parse the value of an Accept-Encoding header into a dictionary
+    {encoding: q}, with lowercase encodings.
+    """
+    encodings = {}
+    for item in value.split(','):
+        encoding, _, params = item.strip().partition(';')
+        if not encoding:
+            continue
+        q = 1.
+        for param in params.split(';'):
+            name, _, arg = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    q = float(arg)
+                except ValueError:
+                    q = 0.
+        encodings[encoding.strip().lower()] = q
+    return encodings
+
+
+def negotiate_encoding(accept_encoding, encodings=('br', 'gzip')):
+    """
+    Return the first of the encodings (that is available) accepted by the
+    client, or None.
+    """
+    accepted = parse_accept_encoding(accept_encoding or '')
+    for encoding in encodings:
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionBudget(object):
+    """
+    The CPU time that can be spent compressing the responses, shared by
+    all the handlers of the process.
+
+    The budget is a fraction of a CPU core (e.g. 0.5: half a second of
+    compression per second), refilled continuously up to one second's
+    worth. New responses are compressed only while some budget is left;
+    the responses being compressed are never interrupted, so the budget can
+    go negative, and it is then repaid before compressing again.
+    """
+
+    def __init__(self):
+        self.exceeded = 0
+        self._available = None
+        self._last = time.monotonic()
+
+    def _refill(self, cpu_fraction):
+        now = time.monotonic()
+        if self._available is None:
+            self._available = cpu_fraction
+        else:
+            self._available = min(
+                cpu_fraction,
+                self._available + (now - self._last) * cpu_fraction)
+        self._last = now
+
+    def available(self, cpu_fraction):
+        """
+        Return True if a new response can be compressed, with a budget of
+        cpu_fraction (None: no limit).
+        """
+        if cpu_fraction is None:
+            return True
+        self._refill(cpu_fraction)
+        if self._available > 0:
+            return True
+        self.exceeded += 1
+        return False
+
+    def spend(self, seconds, cpu_fraction):
+        """Take CPU seconds spent compressing from the budget."""
+        if cpu_fraction is None:
+            return
+        self._refill(cpu_fraction)
+        self._available -= seconds
+
+
+# Process-wide budget shared by all the proxy handlers
+compression_budget = CompressionBudget()
+
+
+class Compressor(object):
+    """
+    Compress a response body, chunk by chunk: each chunk is flushed, so the
+    client receives the data as soon as the upstream sends it.
+
+    The CPU time spent is taken from the `compression_budget`.
+    """
+
+    def __init__(self, encoding, cpu_budget=None):
+        self.encoding = encoding
+        self.cpu_budget = cpu_budget
+        self.cpu_time = 0.
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif encoding == 'gzip':
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        else:
+            raise RuntimeError(
+                "The compression encoding was set to an unknown value '{}'"
+                .format(encoding))
+
+    def _spend(self, start):
+        seconds = time.thread_time() - start
+        self.cpu_time += seconds
+        compression_budget.spend(seconds, self.cpu_budget)
+
+    def compress(self, data):
+        """Return the compressed data (flushed)."""
+        start = time.thread_time()
+        if self.encoding == 'br':
+            data = self._compressor.process(data) + self._compressor.flush()
+        else:
+            data = (self._compressor.compress(data) +
+                    self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._spend(start)
+        return data
+
+    def finish(self):
+        """Return the end of the compressed data."""
+        start = time.thread_time()
+        if self.encoding == 'br':
+            data = self._compressor.finish()
+        else:
+            data = self._compressor.flush()
+        self._spend(start)
+        return data
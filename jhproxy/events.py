@@ -0,0 +1,234 @@
+"""
+Keep `jhproxy.routes.port_map` up to date from the docker events, so that
+the host ports of the containers are found without calling docker for the
+requests, and the mappings of a container are dropped as soon as it dies
+(e.g. before it is restarted on new random host ports).
+
+The events are read by a background thread, which lists the running
+containers (again after each reconnection, as events might have been
+missed), and inspects the containers when they start or are connected to a
+network; the port map itself is only updated in the thread of the IOLoop.
+Only the containers with the labels of the spawners (see
+`TokenizedDockerSpawner.proxy_container_labels`) are tracked: the other
+containers of the docker host are neither listed nor inspected.
+"""
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from jhproxy.health import upstream_health
+from jhproxy.routes import port_map, route_cache
+from jhproxy.warmup import upstream_warmup
+from jhproxy.metrics import stats_collector
+import threading
+import time
+
+# The events of the containers (and of their networks) that change their
+# port mappings
+CONTAINER_START_ACTIONS = ('start', )
+CONTAINER_END_ACTIONS = ('die', 'destroy')
+NETWORK_ACTIONS = ('connect', 'disconnect')
+
+# The label of the containers started by `TokenizedDockerSpawner`
+CONTAINER_LABEL = 'org.jupyterhub.jhproxy'
+
+
+def ports_from_list(container):
+    """
+    Return the port mappings of a container returned by `containers`, in
+    the format of `inspect_container`.
+    """
+    ports = {}
+    for port in container.get('Ports') or []:
+        if 'PublicPort' not in port:
+            continue
+        key = '{}/{}'.format(port['PrivatePort'], port.get('Type', 'tcp'))
+        ports.setdefault(key, []).append({
+            'HostIp': port.get('IP', ''),
+            'HostPort': str(port['PublicPort']),
+        })
+    return ports
+
+
+class DockerEventWatcher(object):
+    """
+    Read the docker events of the containers with the given labels, and
+    update the port map with them.
+
+    The docker client is only used in the background thread; `get_events`
+    and `list_containers` can be overridden to use another event source.
+    """
+
+    def __init__(self, port_map, retry_delay=1, max_retry_delay=60):
+        self.port_map = port_map
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.events = 0
+        self.errors = 0
+        self.labels = {}
+        self._client = None
+        self._loop = None
+        self._thread = None
+        self._stream = None
+        self._stopped = False
+
+    @property
+    def running(self):
+        """True if the background thread is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, client, labels=None):
+        """
+        Start watching the events of the containers with the labels (a
+        dictionary {label: value}; None to watch all the containers) with
+        the docker client, in a background thread (nothing is done if it is
+        already running). It must be called from the thread of the IOLoop.
+        """
+        if self.running:
+            return
+        self.labels = dict(labels or {})
+        self._client = client
+        self._loop = IOLoop.current()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='jhproxy-docker-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching the events."""
+        self._stopped = True
+        stream = self._stream
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+
+    def get_events(self):
+        """Return an iterator on the (decoded) docker events."""
+        return self._client.events(
+            decode=True,
+            filters={
+                'type': ['container', 'network'],
+                'event': list(CONTAINER_START_ACTIONS + CONTAINER_END_ACTIONS +
+                              NETWORK_ACTIONS),
+            })
+
+    def list_containers(self):
+        """
+        Return the running containers with the labels, as returned by
+        `containers`.
+        """
+        if not self.labels:
+            return self._client.containers()
+        return self._client.containers(filters={'label': [
+            '{}={}'.format(label, value)
+            for label, value in sorted(self.labels.items())
+        ]})
+
+    def has_labels(self, attributes):
+        """
+        Return True if the attributes of the actor of a container event
+        (which include the labels of the container) have the labels.
+        """
+        return all(attributes.get(label) == value
+                   for label, value in self.labels.items())
+
+    def inspect(self, container_id):
+        """Return the port mappings of a container, or None if it is gone."""
+        try:
+            inspection = self._client.inspect_container(container_id)
+        except Exception as exc: # pylint: disable=broad-except
+            app_log.debug("Cannot inspect the container %s: %s",
+                          container_id, exc)
+            return None
+        if not inspection.get('State', {}).get('Running', True):
+            return None
+        return inspection.get('NetworkSettings', {}).get('Ports') or {}
+
+    def _run(self):
+        delay = self.retry_delay
+        while not self._stopped:
+            try:
+                # Subscribe before listing the containers, so that no event
+                # is missed in between
+                self._stream = self.get_events()
+                self.sync()
+                delay = self.retry_delay
+                for event in self._stream:
+                    if self._stopped:
+                        break
+                    self.handle_event(event)
+            except Exception as exc: # pylint: disable=broad-except
+                if self._stopped:
+                    break
+                self.errors += 1
+                app_log.warning(
+                    "Error reading the docker events (%s), retrying in %ss",
+                    exc, delay)
+            finally:
+                self._stream = None
+            if self._stopped:
+                break
+            # The events might be missed until the next sync
+            self._loop.add_callback(self.port_map.clear)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def sync(self):
+        """Replace the port map with the running containers."""
+        ports_by_container = {
+            container['Id']: ports_from_list(container)
+            for container in self.list_containers()
+        }
+        self._loop.add_callback(self.port_map.replace, ports_by_container)
+
+    def handle_event(self, event):
+        """Update the port map with a docker event."""
+        self.events += 1
+        event_type = event.get('Type')
+        action = event.get('Action', event.get('status'))
+        actor = event.get('Actor', {})
+        if event_type == 'container':
+            # The events cannot be filtered by label on the docker side:
+            # the label filter would also drop the network events, whose
+            # attributes are the ones of the network
+            if not self.has_labels(actor.get('Attributes') or {}):
+                return
+            container_id = actor.get('ID') or event.get('id')
+            if action in CONTAINER_END_ACTIONS:
+                self._loop.add_callback(self._drop, container_id)
+                return
+            if action not in CONTAINER_START_ACTIONS:
+                return
+        elif event_type == 'network' and action in NETWORK_ACTIONS:
+            container_id = (actor.get('Attributes') or {}).get('container')
+            # Only the containers already known (i.e. running) are
+            # inspected again
+            if container_id not in self.port_map:
+                return
+        else:
+            return
+
+        ports = self.inspect(container_id)
+        if ports is None:
+            self._loop.add_callback(self._drop, container_id)
+        else:
+            self._loop.add_callback(self.port_map.set, container_id, ports)
+
+    def _drop(self, container_id):
+        self.port_map.drop(container_id)
+        route_cache.invalidate_container(container_id)
+        upstream_health.reset_container(container_id)
+        upstream_warmup.reset_container(container_id)
+
+    def stats(self):
+        """Return a dictionary with the event counters."""
+        return {
+            'running': self.running,
+            'events': self.events,
+            'errors': self.errors,
+        }
+
+
+# Process-wide watcher of the port map, started by `TokenizedDockerSpawner`
+# (see its `watch_docker_events` option)
+docker_events = DockerEventWatcher(port_map)
+stats_collector.register('docker_events', docker_events.stats,
+                         "Watcher of the docker events")
@@ -0,0 +1,138 @@
+"""
+The headers forwarded between the clients and the upstreams.
+
+The hop-by-hop headers (RFC 7230, section 6.1), that only apply to one
+connection, are never forwarded, nor the ones listed in the Connection
+header. The requests are also stripped of the credentials meant for the
+hub and jhproxy (the `X-Proxy-Token` header and the `jupyterhub-*`
+cookies), and of the `X-Forwarded-*` headers sent by the client, that the
+handlers set themselves.
+
+The names are compared as normalized by tornado's `HTTPHeaders`, so the
+sets below are case-insensitive at the cost of a frozenset lookup.
+"""
+from tornado import httputil
+import functools
+
+HOP_BY_HOP_HEADERS = frozenset([
+    'Connection',
+    'Keep-Alive',
+    'Proxy-Authenticate',
+    'Proxy-Authorization',
+    'Proxy-Connection',
+    'Te',
+    'Trailer',
+    'Transfer-Encoding',
+    'Upgrade',
+])
+
+FORWARDED_HEADERS = frozenset([
+    'Forwarded',
+    'X-Forwarded-For',
+    'X-Forwarded-Host',
+    'X-Forwarded-Port',
+    'X-Forwarded-Prefix',
+    'X-Forwarded-Proto',
+    'X-Real-Ip',
+])
+
+# The headers of the requests that are not forwarded to the upstreams (the
+# body is de-chunked, and the 100-continue already sent, by tornado)
+REQUEST_SKIPPED_HEADERS = (HOP_BY_HOP_HEADERS |
+                           frozenset(['Expect', 'X-Proxy-Token']))
+
+# The same, for the websocket handshakes (whose Connection and Upgrade
+# headers are for the upstream)
+WEBSOCKET_SKIPPED_HEADERS = (
+    REQUEST_SKIPPED_HEADERS - frozenset(['Connection', 'Upgrade']))
+
+# (websocket, forwarded) -> the skipped headers of the requests, where
+# forwarded is True if the X-Forwarded-* headers are set by the handler
+_REQUEST_SKIPPED_HEADERS = {
+    (False, False): REQUEST_SKIPPED_HEADERS,
+    (False, True): REQUEST_SKIPPED_HEADERS | FORWARDED_HEADERS,
+    (True, False): WEBSOCKET_SKIPPED_HEADERS,
+    (True, True): WEBSOCKET_SKIPPED_HEADERS | FORWARDED_HEADERS,
+}
+
+# The headers of the upstream responses that are not forwarded to the
+# clients (the body is re-framed by tornado)
+RESPONSE_SKIPPED_HEADERS = HOP_BY_HOP_HEADERS | frozenset(['Content-Length'])
+
+# The same, for the responses to HEAD requests (without a body: the
+# Content-Length is the one of the body that a GET would return)
+HEAD_RESPONSE_SKIPPED_HEADERS = HOP_BY_HOP_HEADERS
+
+_NO_HEADERS = frozenset()
+
+# Prefix of the names of the cookies of the hub
+HUB_COOKIE_PREFIX = 'jupyterhub-'
+
+
+@functools.lru_cache(maxsize=64)
+def _get_listed_headers(connection):
+    """Return the (normalized) names listed in a Connection header."""
+    return frozenset(
+        '-'.join(word.capitalize() for word in name.strip().split('-'))
+        for name in connection.split(',') if name.strip())
+
+
+def strip_hub_cookies(value):
+    """
+    Return the value of a Cookie header without the cookies of the hub
+    (None if there is no other cookie).
+    """
+    if HUB_COOKIE_PREFIX not in value:
+        return value
+    cookies = [
+        cookie for cookie in (cookie.strip() for cookie in value.split(';'))
+        if cookie and not cookie.startswith(HUB_COOKIE_PREFIX)
+    ]
+    return '; '.join(cookies) or None
+
+
+def copy_headers(headers, target, skipped):
+    """
+    Add the headers that are not skipped (nor listed in the Connection
+    header, unless it is forwarded itself, as for the websocket handshakes)
+    to the target `HTTPHeaders`, in one pass.
+
+    The values, already parsed by tornado, are set as they are: `add` (and
+    `add_header`) would validate them again.
+    """
+    listed = _NO_HEADERS
+    if 'Connection' in skipped and 'Connection' in headers:
+        listed = _get_listed_headers(headers['Connection'])
+    for name in headers:
+        if name in skipped or name in listed:
+            continue
+        values = headers.get_list(name)
+        if name in target:
+            for value in values:
+                target.add(name, value)
+        else:
+            target[name] = values[0]
+            for value in values[1:]:
+                target.add(name, value)
+    return target
+
+
+def get_request_headers(headers, websocket=False, forwarded=True):
+    """
+    Return the headers of a client request (a websocket handshake if
+    websocket is True) to forward to the upstream, as new `HTTPHeaders`.
+
+    If forwarded is True, the X-Forwarded-* headers of the client are
+    dropped, for the caller to set its own.
+    """
+    upstream_headers = copy_headers(
+        headers, httputil.HTTPHeaders(),
+        _REQUEST_SKIPPED_HEADERS[websocket, forwarded])
+    if HUB_COOKIE_PREFIX in upstream_headers.get('Cookie', ''):
+        cookies = [strip_hub_cookies(cookie)
+                   for cookie in upstream_headers.get_list('Cookie')]
+        del upstream_headers['Cookie']
+        for cookie in cookies:
+            if cookie is not None:
+                upstream_headers.add('Cookie', cookie)
+    return upstream_headers
@@ -0,0 +1,97 @@
+"""
+Health of the upstreams (a container and a port inside it), with a circuit
+breaker: once the connections to an upstream have failed `threshold` times
+in a row (e.g. nothing listens on the port), the proxy handlers answer its
+requests with a 503 error right away, without looking up its host port nor
+connecting to it.
+
+After a delay, one request is let through to probe the upstream: the
+circuit closes again if it connects, otherwise the delay doubles (up to
+`max_delay`). The state of a container is dropped when it is (re)started or
+dies, so a new server is never failed fast.
+"""
+from jhproxy.metrics import stats_collector
+import time
+
+
+class UpstreamHealth(object):
+    """
+    The consecutive connection failures of the upstreams, keyed by
+    (container_id, proxy_port).
+
+    `allow` tells if a request can be sent to an upstream, `record` reports
+    the outcome of the connection.
+    """
+
+    def __init__(self):
+        self.rejected = 0
+        self.opened = 0
+        # container_id -> {proxy_port: [failures, delay, open until]}
+        self._upstreams = {}
+
+    def allow(self, container_id, proxy_port):
+        """
+        Return 0 if a request can be sent to the upstream, otherwise the
+        number of seconds until it is probed again.
+
+        Once the delay of an open circuit has elapsed, the next request is
+        allowed as a probe, and the following ones are rejected for another
+        delay (or until the probe connects).
+        """
+        state = self._upstreams.get(container_id, {}).get(proxy_port)
+        if state is None or not state[2]:
+            return 0
+        now = time.monotonic()
+        if now < state[2]:
+            self.rejected += 1
+            return state[2] - now
+        state[2] = now + state[1]
+        return 0
+
+    def record(self, container_id, proxy_port, failed, threshold=5, delay=1,
+               max_delay=60):
+        """
+        Record the outcome of a connection to the upstream: a success closes
+        its circuit, the threshold-th failure in a row opens it for delay
+        seconds, and each further failure doubles the delay (up to
+        max_delay).
+        """
+        ports = self._upstreams.get(container_id)
+        if not failed:
+            if ports is not None and ports.pop(proxy_port, None) is not None:
+                if not ports:
+                    del self._upstreams[container_id]
+            return
+        if ports is None:
+            ports = self._upstreams[container_id] = {}
+        state = ports.get(proxy_port)
+        if state is None:
+            state = ports[proxy_port] = [0, delay, 0]
+        state[0] += 1
+        if state[0] < threshold:
+            return
+        if state[2]:
+            state[1] = min(state[1] * 2, max_delay)
+        else:
+            self.opened += 1
+            state[1] = min(delay, max_delay)
+        state[2] = time.monotonic() + state[1]
+
+    def reset_container(self, container_id):
+        """Forget the state of the upstreams of a container."""
+        self._upstreams.pop(container_id, None)
+
+    def stats(self):
+        """Return a dictionary with the open circuits and the counters."""
+        return {
+            'open': sum(1 for ports in self._upstreams.values()
+                        for state in ports.values() if state[2]),
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+# Process-wide health of the upstreams, shared by all the proxy handlers
+upstream_health = UpstreamHealth()
+stats_collector.register('upstream_health', upstream_health.stats,
+                         "Circuit breakers of the upstreams")
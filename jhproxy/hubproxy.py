@@ -0,0 +1,114 @@
+"""
+Routes pushed by `TokenizedDockerSpawner` to the proxy of JupyterHub
+(configurable-http-proxy, Traefik, ...), so that the proxied requests go
+from the proxy straight to the containers, without passing through the hub.
+
+JupyterHub removes from its proxy the routes it does not know about, so
+the hub must use a proxy class that leaves the pushed routes alone, e.g.:
+
+```
+c.JupyterHub.proxy_class = 'jhproxy.hubproxy.ConfigurableHTTPProxy'
+```
+
+or, for another proxy implementation, a subclass with `PushedRoutesMixin`
+first in its bases.
+"""
+from jupyterhub import proxy
+from jupyterhub.utils import url_path_join
+from tornado import gen
+from tornado.escape import url_escape
+import functools
+import re
+
+# Path of the pushed routes, under the base URL of the hub
+DEFAULT_ROUTE_TEMPLATE = '/proxy{port}/{username}/'
+
+
+def get_route_path(template, base_url, proxy_port, username):
+    """Return the path of the route of a port of a user."""
+    return url_path_join(
+        base_url,
+        template.format(port=proxy_port,
+                        username=url_escape(username, plus=False)))
+
+
+@functools.lru_cache(maxsize=16)
+def compile_route_template(template, base_url):
+    """
+    Return a regex matching the paths of the routes (and anything below
+    them), with the 'port' and the (escaped) 'username' groups.
+    """
+    pattern = re.escape(url_path_join(base_url, template))
+    pattern = pattern.replace(re.escape('{port}'), r'(?P<port>\d+)')
+    pattern = pattern.replace(re.escape('{username}'), r'(?P<username>[^/]+)')
+    return re.compile(pattern)
+
+
+class PushedRoutesMixin(object):
+    """
+    Mixin for the `jupyterhub.proxy.Proxy` classes: hide the routes pushed
+    by the spawners (the ones with a 'jhproxy' key in their data) from the
+    consistency checks of the hub, which would otherwise delete them.
+
+    The checks still delete the pushed routes of the users whose server is
+    not running anymore (e.g. stopped while the hub was down), or that
+    must not be pushed anymore (e.g. the server now requires a token), and
+    add again the missing ones of the running servers (e.g. after a restart
+    of the proxy).
+    """
+
+    @gen.coroutine
+    def get_all_routes(self):
+        routes = yield super().get_all_routes()
+        raise gen.Return({
+            routespec: route
+            for routespec, route in routes.items()
+            if 'jhproxy' not in route['data']
+        })
+
+    @gen.coroutine
+    def check_routes(self, user_dict, service_dict, routes=None):
+        yield super().check_routes(user_dict, service_dict, routes)
+
+        all_routes = yield super().get_all_routes()
+        pushed = {}
+        for routespec, route in all_routes.items():
+            username = route['data'].get('jhproxy')
+            if username is not None:
+                pushed.setdefault(username, set()).add(routespec)
+
+        futures = []
+        for user in user_dict.values():
+            spawner = user.spawner
+            user_routes = pushed.pop(user.name, set())
+            if spawner.pending:
+                # The routes are being added or deleted by the spawner
+                continue
+            if not spawner.ready:
+                pushed[user.name] = user_routes
+                continue
+            ports = getattr(spawner, 'proxy_route_ports', None)
+            if not ports or not spawner.can_push_proxy_routes():
+                pushed[user.name] = user_routes
+                continue
+            missing = [
+                port for port in ports
+                if spawner.get_proxy_routespec(port) not in user_routes
+            ]
+            if missing:
+                self.log.warning("Adding missing jhproxy routes for %s: %s",
+                                 user.name, missing)
+                futures.append(spawner.add_proxy_routes(missing))
+
+        # The routes of the users not running (or not known anymore), or
+        # that must not be pushed
+        for username, routespecs in pushed.items():
+            for routespec in routespecs:
+                self.log.warning("Deleting stale jhproxy route %s of %s",
+                                 routespec, username)
+                futures.append(self.delete_route(routespec))
+        yield futures
+
+
+class ConfigurableHTTPProxy(PushedRoutesMixin, proxy.ConfigurableHTTPProxy):
+    """The configurable-http-proxy of JupyterHub, with pushed routes."""
@@ -0,0 +1,95 @@
+from jhproxy.metrics import stats_collector
+import collections
+import time
+
+# Seconds after which to retry, when the rate is 0 (the bucket is never
+# refilled)
+BLOCKED_RETRY_AFTER = 60
+
+
+class RateLimiter(object):
+    """
+    Rate limits (token buckets) and caps on the concurrent requests, for
+    the proxied requests.
+
+    Limits are applied per key: the handlers use (username, proxy_port,
+    token scope), so that the clients of a token (or all the anonymous
+    clients of a port open to all) share the same limits.
+
+    The buckets that are full again (i.e. of keys that have not been used
+    for a while) are dropped once there are more than `max_buckets`, so the
+    memory used stays bounded.
+    """
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self.rejected = 0
+        # key -> [available tokens, last update, rate, burst]
+        self._buckets = {}
+        self._in_flight = collections.Counter()
+
+    def acquire(self, key, rate, burst=None):
+        """
+        Take a token from the bucket of the key, refilled with `rate` tokens
+        per second up to `burst` tokens (default: max(1, rate)). With a rate
+        of 0, only the burst is allowed.
+
+        Return 0 if the request is allowed, otherwise the number of seconds
+        until a token is available.
+        """
+        if burst is None:
+            burst = max(1., rate)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[key] = [burst, now, rate, burst]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1:] = [now, rate, burst]
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        self.rejected += 1
+        if rate <= 0:
+            return BLOCKED_RETRY_AFTER
+        return (1 - bucket[0]) / rate
+
+    def _prune(self, now):
+        """Drop the buckets that are full again."""
+        for key, (tokens, last, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - last) * rate >= burst:
+                del self._buckets[key]
+
+    def start(self, key, max_concurrent):
+        """
+        Count a request of the key as in flight, unless there are already
+        max_concurrent. Return True if the request is allowed (it must then
+        be ended with `end`).
+        """
+        if self._in_flight[key] >= max_concurrent:
+            self.rejected += 1
+            return False
+        self._in_flight[key] += 1
+        return True
+
+    def end(self, key):
+        """End a request started with `start`."""
+        self._in_flight[key] -= 1
+        if self._in_flight[key] <= 0:
+            del self._in_flight[key]
+
+    def stats(self):
+        """Return a dictionary with the number of keys and rejections."""
+        return {
+            'buckets': len(self._buckets),
+            'in_flight_keys': len(self._in_flight),
+            'rejected': self.rejected,
+        }
+
+
+# Process-wide limiter shared by all the proxy handlers
+rate_limiter = RateLimiter()
+stats_collector.register('rate_limiter', rate_limiter.stats,
+                         "Rate and concurrency limiter of the requests")
@@ -0,0 +1,156 @@
+"""
+Prometheus metrics of the proxy.
+
+They are registered in the default registry of `prometheus_client`, next
+to the metrics of JupyterHub, so they are exported by the `/hub/metrics`
+endpoint of the hub running the handlers.
+All the metrics are prefixed by `jhproxy_`.
+
+The counters of the process-wide objects (caches, indexes, upstream
+clients, ...) are exported by `stats_collector`, from their `stats()`.
+"""
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# Buckets (in seconds) for the durations of the requests and of their phases:
+# from cached lookups (sub-millisecond) to slow containers
+duration_buckets = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10, 30, 60, float("inf")
+]
+
+REQUEST_DURATION_SECONDS = Histogram(
+    'request_duration_seconds',
+    'Duration of the proxied requests (websockets excluded)',
+    ['proxy_port'],
+    buckets=duration_buckets,
+    namespace='jhproxy',
+)
+
+# Phases of a proxied request:
+# - auth: resolution of the user and check of the proxy token
+# - port_lookup: lookup of the host port mapped to the proxy port
+#   (cached, or by inspecting the docker container)
+# - fetch: request to the upstream, including the streaming of the body
+PHASE_DURATION_SECONDS = Histogram(
+    'phase_duration_seconds',
+    'Duration of each phase of the proxied requests',
+    ['phase'],
+    buckets=duration_buckets,
+    namespace='jhproxy',
+)
+
+RESPONSES = Counter(
+    'responses_total',
+    'Responses to the proxied requests, by status code',
+    ['proxy_port', 'code'],
+    namespace='jhproxy',
+)
+
+REQUEST_BYTES = Counter(
+    'request_bytes_total',
+    'Bytes of the request bodies (and websocket traffic) sent to the upstreams',
+    ['proxy_port'],
+    namespace='jhproxy',
+)
+
+RESPONSE_BYTES = Counter(
+    'response_bytes_total',
+    'Bytes of the response bodies (and websocket traffic) sent to the clients',
+    ['proxy_port'],
+    namespace='jhproxy',
+)
+
+UPSTREAM_CIRCUIT_OPEN = Counter(
+    'upstream_circuit_open_total',
+    'Requests failed fast because the connections to the upstream kept '
+    'failing',
+    ['proxy_port'],
+    namespace='jhproxy',
+)
+
+UPSTREAM_ERRORS = Counter(
+    'upstream_errors_total',
+    'Requests to the upstreams that failed without an HTTP response',
+    ['proxy_port', 'error'],
+    namespace='jhproxy',
+)
+
+REQUESTS_IN_FLIGHT = Gauge(
+    'requests_in_flight',
+    'Proxied requests (and open websockets) currently being handled',
+    ['proxy_port'],
+    namespace='jhproxy',
+)
+
+COALESCED_REQUESTS = Counter(
+    'coalesced_requests_total',
+    'Requests answered with the response of an identical request in flight',
+    ['proxy_port'],
+    namespace='jhproxy',
+)
+
+COMPRESSED_RESPONSES = Counter(
+    'compressed_responses_total',
+    'Responses compressed by the proxy, by encoding',
+    ['proxy_port', 'encoding'],
+    namespace='jhproxy',
+)
+
+COMPRESSION_CPU_SECONDS = Counter(
+    'compression_cpu_seconds_total',
+    'CPU time spent compressing the responses',
+    namespace='jhproxy',
+)
+
+COMPRESSION_BUDGET_EXCEEDED = Counter(
+    'compression_budget_exceeded_total',
+    'Responses sent uncompressed because the CPU budget was used up',
+    namespace='jhproxy',
+)
+
+
+class StatsCollector(object):
+    """
+    Export the values returned by the `stats()` of the process-wide objects
+    as gauges, read when the metrics are collected (so they cost nothing
+    per request).
+    """
+
+    def __init__(self):
+        self._stats = []
+
+    def register(self, name, stats, documentation, labels=()):
+        """
+        Export the numbers of the dictionary returned by stats() as the
+        gauges `jhproxy_<name>_<key>`. stats() can also return a list of
+        dictionaries, the values of their labels keys telling them apart.
+        """
+        self._stats.append((name, stats, documentation, tuple(labels)))
+
+    def collect(self):
+        """Yield the gauges (called by `prometheus_client`)."""
+        for name, stats, documentation, labels in self._stats:
+            results = stats()
+            if isinstance(results, dict):
+                results = [results]
+            families = {}
+            for result in results:
+                label_values = [str(result[label]) for label in labels]
+                for key, value in result.items():
+                    if key in labels or not isinstance(value, (int, float)):
+                        continue
+                    family = families.get(key)
+                    if family is None:
+                        family = families[key] = GaugeMetricFamily(
+                            'jhproxy_{}_{}'.format(name, key),
+                            '{}: {}'.format(documentation, key),
+                            labels=labels)
+                    family.add_metric(label_values, value)
+            for family in families.values():
+                yield family
+
+
+# Registered in the default registry, next to the metrics above
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
@@ -1,11 +1,80 @@
 from dockerspawner import DockerSpawner
+from jupyterhub import orm
 from jupyterhub.handlers.base import BaseHandler
-from tornado.escape import xhtml_escape
+from tornado.escape import url_unescape, xhtml_escape
 from tornado import gen
-from tornado import httpclient, httputil
-from tornado.web import authenticated
+from tornado import httpclient, httputil, queues
+from tornado.iostream import StreamClosedError
+from tornado.simple_httpclient import HTTPTimeoutError
+from tornado.tcpclient import TCPClient
+from tornado.web import authenticated, stream_request_body
+from jhproxy.cache import parse_cache_control, response_cache
+from jhproxy.client import get_upstream_client
+from jhproxy.coalesce import get_key, is_shareable, request_coalescer
+from jhproxy.compress import (Compressor, compression_budget, is_compressible,
+                              negotiate_encoding)
+from jhproxy.headers import (HEAD_RESPONSE_SKIPPED_HEADERS,
+                             RESPONSE_SKIPPED_HEADERS, copy_headers,
+                             get_request_headers)
+from jhproxy.health import upstream_health
+from jhproxy.hubproxy import DEFAULT_ROUTE_TEMPLATE, compile_route_template
+from jhproxy.limits import rate_limiter
+from jhproxy.metrics import (
+    COALESCED_REQUESTS, COMPRESSED_RESPONSES, COMPRESSION_BUDGET_EXCEEDED,
+    COMPRESSION_CPU_SECONDS, PHASE_DURATION_SECONDS, REQUEST_BYTES, REQUEST_DURATION_SECONDS,
+    REQUESTS_IN_FLIGHT, RESPONSE_BYTES, RESPONSES, UPSTREAM_CIRCUIT_OPEN,
+    UPSTREAM_ERRORS)
+from jhproxy.relay import open_websockets, relay
+from jhproxy.routes import (get_host_port, port_policy, route_cache,
+                            user_routes)
 from jhproxy.spawners import TokenizedDockerSpawner
+from jhproxy.tracing import CLIENT, NO_SPAN, tracer
+from jhproxy.warmup import upstream_warmup
+import errno
 import json
+import math
+import time
+
+
+def _is_connection_refused(error):
+    """Return True if the error is a refused connection to the upstream."""
+    if isinstance(error, ConnectionRefusedError):
+        return True
+    return getattr(error, 'errno', None) == errno.ECONNREFUSED
+
+
+def _is_connect_error(error):
+    """
+    Return True if the error is a failed connection to the upstream
+    (refused, unreachable, or timed out while connecting).
+    """
+    if _is_connection_refused(error):
+        return True
+    if getattr(error, 'errno', None) in (errno.EHOSTUNREACH,
+                                         errno.ENETUNREACH):
+        return True
+    # The websocket connections (TCPClient), and the simple client
+    if isinstance(error, gen.TimeoutError):
+        return True
+    if isinstance(error, HTTPTimeoutError):
+        return 'connecting' in str(error)
+    # CURLE_COULDNT_CONNECT, with the 'curl' upstream client
+    return type(error).__name__ == 'CurlError' and error.errno == 7
+
+
+def _get_error_label(error):
+    """
+    Return the label of an upstream error in the metrics: 'refused',
+    'timeout' or 'other'.
+    """
+    if _is_connection_refused(error):
+        return 'refused'
+    if isinstance(error, (TimeoutError, gen.TimeoutError, HTTPTimeoutError)):
+        return 'timeout'
+    # CURLE_OPERATION_TIMEDOUT, with the 'curl' upstream client
+    if type(error).__name__ == 'CurlError' and error.errno == 28:
+        return 'timeout'
+    return 'other'
 
 
 class ProxyBaseHandler(BaseHandler):
@@ -29,38 +98,69 @@ class ProxyBaseHandler(BaseHandler):
 
     # Get the global port
     proxy_port = None
+    # Seconds to cache the host port mappings (None: use the default of
+    # the route cache, 0: disable caching)
+    route_cache_ttl = None
 
-    def initialize(self, proxy_port=None): # pylint: disable=arguments-differ
+    def initialize(self, proxy_port=None, route_cache_ttl=None): # pylint: disable=arguments-differ
         """
         Set the value of the port (inside the docker container) 
         that we want to proxy out.
+
+        Optionally, set for how many seconds the host port mapped to it
+        is cached.
         """
         self.proxy_port = proxy_port
+        self.route_cache_ttl = route_cache_ttl
 
     @gen.coroutine
-    def get_proxied_port(self, spawner):
+    def get_proxied_port(self, spawner, span=NO_SPAN):
         """
         Return the port on the host that maps to the proxy_port in the docker
         container.
+
+        The mapping is cached in `jhproxy.routes.route_cache`, so docker
+        is inspected only the first time (or after the container changes).
+        The docker calls are traced as children of the span.
         """
-        ## Get the port
-        inspection = yield spawner.docker("inspect_container",
-                                          spawner.container_id)
-        port_mappings = inspection.get('NetworkSettings', {}).get('Ports', {})
+        host_port = yield get_host_port(spawner, self.proxy_port,
+                                        ttl=self.route_cache_ttl, span=span)
+        raise gen.Return(host_port)
 
-        self.log.debug("Port mappings:{}".format(str(port_mappings)))
+    @gen.coroutine
+    def get_user_route(self, username):
+        """
+        Given a username, return the UserRoute (with the docker spawner
+        and the expected token) from `jhproxy.routes.user_routes`.
+        Only if the user is not indexed yet (or its route is stale), it is
+        looked up in the database.
 
-        port_routes = port_mappings.get('{}/tcp'.format(self.proxy_port), [])
-        host_port = None
-        for port_route in port_routes:
-            if port_route.get('HostIp', '') == spawner.host_ip:
-                host_port = port_route.get('HostPort', '')
-                try:
-                    host_port = int(host_port)
-                except ValueError:
-                    host_port = None
-                break
-        raise gen.Return(host_port)
+        Return None if not found.
+        """
+        route = user_routes.get(username)
+        if route is not None and not self.is_route_current(route):
+            user_routes.remove(username)
+            route = None
+        if route is None:
+            spawner = self.get_spawner_from_username(username)
+            if spawner is not None:
+                route = user_routes.add(username, spawner)
+        raise gen.Return(route)
+
+    def is_route_current(self, route):
+        """
+        Return True if the spawner of an indexed route is still the one of
+        its user, as known by the hub (the user was not deleted, nor
+        created again, and the spawner was not replaced), without querying
+        the database.
+        """
+        user = getattr(route.spawner, 'user', None)
+        user_id = getattr(user, 'id', None)
+        if user_id is None:
+            return True
+        # Only the users in memory, and the spawners already created
+        return (dict.get(self.users, user_id) is user and dict.get(
+            user.spawners, route.spawner.name) is route.spawner)
 
     def get_spawner_from_username(self, username):
         """
@@ -68,8 +168,19 @@ class ProxyBaseHandler(BaseHandler):
 
         Return None if not found.
         """
-        user = self.user_from_username(username)
-        self.log.debug("User: {}".format(str(user)))
+        user = self.find_user(username)
+        self.log.debug("User: %s", user)
+        if user is None:
+            return None
+        return self.get_spawner_from_user(user)
+
+    @staticmethod
+    def get_spawner_from_user(user):
+        """
+        Return the (docker) spawner of a user.
+
+        Return None if the user has none.
+        """
         spawners = user.spawners.values()
         spawner = None
         # Get the first DockerSpawner
@@ -86,24 +197,50 @@ class ProxyTokenHandler(ProxyBaseHandler):
     All requests need to be authenticated (user need to be logged into 
     jupyterhub in the same browser).
 
-    * GET request: return the current token
-    * POST request: change the token
+    * GET request: return the current token (or list the tokens)
+    * POST request: change the token, or create/revoke a named token
     """
 
     @authenticated
+    @gen.coroutine
     def get(self): # pylint: disable=arguments-differ
         """
         Get the current token.
 
-        Return a JSON value with the token (typically `null`, or a string)
+        Return a JSON value with the token (typically `null`, or a string).
+        Tokens are stored hashed: if the token was generated before the hub
+        was restarted, it cannot be shown anymore and a 404 code is returned
+        (as well as if there is no default token, but only named ones), with
+        a message telling why.
+
+        With the `list` query argument (`?list`), return instead a JSON
+        object `{"mode": <mode>, "tokens": [{"name": <name>, "expires":
+        <timestamp or null>}, ...]}` with the mode ('disabled', 'allow_all'
+        or 'tokens') and the names and expiries of the tokens (not the
+        tokens themselves).
         """
-        spawner = self.get_spawner_from_username(self.current_user.name)
+        route = yield self.get_user_route(self.current_user.name)
         #self.write(xhtml_escape(str(spawner)))
         #self.write("<br>")
-        if spawner is None:
+        if route is None:
             self.set_status(503)
             self.write("Spawner not available")
             return
+        spawner = route.spawner
+
+        if self.get_argument('list', None) is not None:
+            if not isinstance(spawner, TokenizedDockerSpawner):
+                # As for the token of a standard DockerSpawner
+                result = {'mode': 'allow_all', 'tokens': []}
+            else:
+                spawner.proxy_tokens.prune()
+                result = {
+                    'mode': spawner.proxy_tokens.mode,
+                    'tokens': spawner.proxy_tokens.describe(),
+                }
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(result))
+            return
 
         try:
             proxy_token = spawner.proxy_token
@@ -111,10 +248,15 @@ class ProxyTokenHandler(ProxyBaseHandler):
             ## E.g. if we are using a standard DockerSpawner
             ## Then the proxy_token is set to an empty string
             proxy_token = ""
+        except LookupError as exc:
+            self.set_status(404)
+            self.write(str(exc))
+            return
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(proxy_token))
 
     @authenticated
+    @gen.coroutine
     def post(self): # pylint: disable=arguments-differ
         """
         Ask to change the token.
@@ -124,18 +266,30 @@ class ProxyTokenHandler(ProxyBaseHandler):
             effectively disabling the proxy
           * "allow_all": sets the Token to `""`, effectively allowing the proxy 
             with no authorization check
-          * "random": regenerate a random token
+          * "random": regenerate a random token (the previous one is still
+            accepted for `TokenizedDockerSpawner.token_rotation_grace_period`
+            seconds)
 
         If the body in the POST request is not a valid value, a 400 code is returned.
         Otherwise, return a JSON value with the new token (typically `null`, or a string)
+
+        Alternatively, the body can be a JSON object to manage the named
+        tokens, that are accepted in addition to the default one:
+          * `{"action": "create", "name": <name>, "expires_in": <seconds>}`
+            creates a random token (`expires_in` is optional: without it,
+            the token does not expire), and returns
+            `{"name": <name>, "token": <token>}`
+          * `{"action": "revoke", "name": <name>}` revokes a token, and
+            returns `{"name": <name>}`
         """
-        spawner = self.get_spawner_from_username(self.current_user.name)
+        route = yield self.get_user_route(self.current_user.name)
         #self.write(xhtml_escape(str(spawner)))
         #self.write("<br>")
-        if spawner is None:
+        if route is None:
             self.set_status(503)
             self.write("Spawner not available")
             return
+        spawner = route.spawner
 
         if not isinstance(spawner, TokenizedDockerSpawner):
             self.set_status(500)
@@ -147,6 +301,9 @@ class ProxyTokenHandler(ProxyBaseHandler):
         body = self.request.body
         if not body:
             body = b''
+        if body.startswith(b'{'):
+            self._manage_named_token(spawner, body)
+            return
         if body == b"disabled":
             spawner.set_token(None)
         elif body == b"allow_all":
@@ -159,10 +316,184 @@ class ProxyTokenHandler(ProxyBaseHandler):
                 "Invalid action required in the POST body for the proxy-token endpoint: {}"
                 .format(body))
             return
+        spawner.save_proxy_state()
 
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(spawner.proxy_token))
 
+    def _manage_named_token(self, spawner, body):
+        """
+        Create or revoke a named token of the spawner, as asked by the JSON
+        body of a POST request.
+        """
+        try:
+            params = json.loads(body.decode('utf-8'))
+            name = params['name']
+            expires_in = params.get('expires_in')
+            if not isinstance(name, str) or not name:
+                raise ValueError("The name must be a non-empty string")
+            if expires_in is not None and not (isinstance(
+                    expires_in, (int, float)) and expires_in > 0):
+                raise ValueError("expires_in must be a positive number")
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            self.set_status(400)
+            self.write("Invalid JSON body for the proxy-token endpoint: {}"
+                       .format(xhtml_escape(str(exc))))
+            return
+
+        if params.get('action') == 'create':
+            try:
+                token = spawner.add_named_token(name, expires_in=expires_in)
+            except ValueError as exc:
+                self.set_status(400)
+                self.write(xhtml_escape(str(exc)))
+                return
+            result = {'name': name, 'token': token}
+        elif params.get('action') == 'revoke':
+            spawner.remove_named_token(name)
+            result = {'name': name}
+        else:
+            self.set_status(400)
+            self.write("Invalid action for the proxy-token endpoint: {}"
+                       .format(xhtml_escape(str(params.get('action')))))
+            return
+        spawner.save_proxy_state()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result))
+
+
+class ProxyTokenAdminHandler(ProxyBaseHandler):
+    """
+    Change the tokens of many users at once, e.g. to rotate or disable all
+    of them after an incident.
+    The requests need the 'admin:servers' scope on all the users (an admin
+    user logged into jupyterhub, or an API token with that scope).
+
+    * POST request: apply an action to the tokens of a list of users
+    """
+    # Accept the API tokens (`Authorization: token <token>`), not only the
+    # cookies of the logged-in users; the requests authenticated by a
+    # token are not checked for XSRF
+    _accept_token_auth = True
+    # Users whose spawner state is saved to the database in each commit
+    commit_batch_size = 100
+
+    def initialize(self, commit_batch_size=100, **kwargs): # pylint: disable=arguments-differ
+        """
+        Set how many spawner states are saved to the database in each
+        commit.
+        """
+        super().initialize(**kwargs)
+        self.commit_batch_size = commit_batch_size
+
+    @authenticated
+    @gen.coroutine
+    def post(self): # pylint: disable=arguments-differ
+        """
+        Change the tokens of the users.
+
+        Body: a JSON object `{"action": <action>, "users": [<username>, ...]}`,
+        where the action is one of the values of the body of a POST request
+        to `ProxyTokenHandler`:
+          * "disabled": disable the proxy for the users
+          * "allow_all": allow all the requests, with no authorization check
+          * "random": regenerate a random token for each user (the previous
+            one is still accepted for
+            `TokenizedDockerSpawner.token_rotation_grace_period` seconds)
+
+        The tokens of all the users are changed at once, before any other
+        request is handled; if any user cannot be changed (not found, not
+        allowed, or without a `TokenizedDockerSpawner`), none is, and a 404,
+        403 or 400 code is returned, with the list of these users.
+        Otherwise, return a JSON object `{"tokens": {<username>: <token>}}`
+        with the new tokens.
+        The states of the spawners are then saved to the database, in
+        batches of `commit_batch_size`.
+
+        The handlers of the hub apply the new tokens right away; the jhproxy
+        service (`jhproxy.service`) only once its cached routes expire
+        (after its `--route-ttl`), unless it is sent a SIGHUP.
+        """
+        try:
+            params = json.loads(self.request.body.decode('utf-8'))
+            action = params['action']
+            usernames = params['users']
+            if action not in ('disabled', 'allow_all', 'random'):
+                raise ValueError("Invalid action: {}".format(action))
+            if not isinstance(usernames, list) or not all(
+                    isinstance(name, str) for name in usernames):
+                raise ValueError("users must be a list of usernames")
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            self.set_status(400)
+            self.write("Invalid JSON body for the proxy-token admin "
+                       "endpoint: {}".format(xhtml_escape(str(exc))))
+            return
+
+        usernames = sorted(set(usernames))
+        orm_users = {
+            orm_user.name: orm_user
+            for orm_user in self.db.query(orm.User).filter(
+                orm.User.name.in_(usernames))
+        }
+        has_access = self.get_scope_filter('admin:servers')
+        spawners = []
+        errors = {404: [], 403: [], 400: []}
+        for name in usernames:
+            orm_user = orm_users.get(name)
+            if orm_user is None:
+                # Not routed anymore (e.g. deleted)
+                user_routes.remove(name)
+                errors[404].append(name)
+            elif not has_access(orm_user, kind='user'):
+                errors[403].append(name)
+            else:
+                spawner = self.get_spawner_from_user(self.users[orm_user])
+                if isinstance(spawner, TokenizedDockerSpawner):
+                    spawners.append(spawner)
+                else:
+                    errors[400].append(name)
+        for code, messages in ((404, "Users not found"),
+                               (403, "Action not allowed for the users"),
+                               (400, "No TokenizedDockerSpawner for the "
+                                "users")):
+            if errors[code]:
+                self.set_status(code)
+                self.write("{}: {}".format(
+                    messages, xhtml_escape(', '.join(errors[code]))))
+                return
+
+        # No other request can see only some of the changes (nor the routes
+        # of `jhproxy.routes.user_routes` of only some of the users)
+        tokens = {}
+        for spawner in spawners:
+            if action == 'disabled':
+                spawner.set_token(None)
+            elif action == 'allow_all':
+                spawner.set_token("")
+            else:
+                spawner.regenerate_random_token()
+            tokens[spawner.user.name] = spawner.proxy_token
+        self.log.info("Proxy tokens of %s users changed to %s by %s",
+                      len(spawners), action, self.current_user.name)
+
+        yield self.save_states(spawners)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'tokens': tokens}))
+
+    @gen.coroutine
+    def save_states(self, spawners):
+        """
+        Save the states of the spawners to the database, committing every
+        `commit_batch_size` spawners (and letting the other requests run in
+        between).
+        """
+        for start in range(0, len(spawners), self.commit_batch_size):
+            for spawner in spawners[start:start + self.commit_batch_size]:
+                spawner.save_proxy_state(commit=False)
+            self.db.commit()
+            yield gen.moment
+
 
 class ProxyHandler(ProxyBaseHandler):
     """
@@ -191,10 +522,17 @@ class ProxyHandler(ProxyBaseHandler):
       authorization checks, all requests are proxied.
     - If the token set in the spawner is a non-empty string: access enabled; 
       the HTTP headers are checked to see if there is a `X-Proxy-Token`
-      with the same value as the one stored in the spawner.
+      with the same value as the one stored in the spawner (or as one of its
+      other named tokens, that have not expired).
       If this is the case: the request is proxied, otherwise a 403 HTTP error
       is returned.
     
+    All the HTTP methods are proxied (except OPTIONS, answered directly for
+    the CORS preflight requests).
+    Websocket requests (with the same token checks) are proxied too: after
+    the handshake, the bytes are relayed as they are between the client and
+    the container.
+
     Other possible behaviors/error codes:
     - If the user specified in the URL is not found: a 404 error is returned
     - If the docker container is not configured to forward the `proxy_port` 
@@ -204,11 +542,276 @@ class ProxyHandler(ProxyBaseHandler):
       in a 500 error.
     """
 
+    # Stream the upstream response to the client as it arrives, instead
+    # of buffering it fully in memory first
+    stream_response = True
+    # Seconds after which an inactive websocket is closed (None: never)
+    websocket_idle_timeout = 3600
+    # Maximum number of websockets open at the same time for each user
+    # (None: no limit)
+    max_websockets_per_user = None
+    # The shared client used to fetch from the upstreams (see
+    # `jhproxy.client.get_upstream_client`), and its number of
+    # concurrent requests
+    upstream_client = 'simple'
+    upstream_max_clients = 100
+    # Timeouts (in seconds) for the requests to the upstreams
+    connect_timeout = 20
+    request_timeout = 600
+    # Cache the responses to GET requests in `jhproxy.cache.response_cache`
+    cache_responses = False
+    # Requests per second (None: no limit), and burst, allowed for each
+    # user, proxy port and token; and maximum number of concurrent requests
+    # (None: no limit). The limits set in the spawner take precedence.
+    rate_limit = None
+    rate_burst = None
+    max_concurrent_requests = None
+    # Compress the compressible responses of at least compress_min_size
+    # bytes (or of unknown size) with the first of compress_encodings that
+    # the client accepts, spending at most compress_cpu_budget of a CPU core
+    # (None: no limit)
+    compress_responses = False
+    compress_min_size = 1024
+    compress_encodings = ('br', 'gzip')
+    compress_cpu_budget = None
+    # Fail fast (503) the requests to an upstream (a port of a container)
+    # after circuit_breaker_threshold connection failures in a row (None:
+    # never), probing it again after circuit_breaker_delay seconds, doubled
+    # after each failed probe up to circuit_breaker_max_delay
+    circuit_breaker_threshold = 5
+    circuit_breaker_delay = 1
+    circuit_breaker_max_delay = 60
+    # Share the response of a GET request with the identical ones that
+    # arrive while it is in flight (see `jhproxy.coalesce`). The setting of
+    # the spawner takes precedence.
+    coalesce_requests = True
+    # Replace the X-Forwarded-For/Host/Proto headers of the client with the
+    # ones seen by the hub (otherwise, forward them as they are)
+    forwarded_headers = True
+    # Hold the requests to an upstream being warmed up (see
+    # `jhproxy.warmup`) for at most warmup_wait seconds (None: never)
+    warmup_wait = 30
+
+    _cache_key = None
+    _coalesce_requests = False
+    _flight = None
+    _compressor = None
+    _span = NO_SPAN
+    _request_bytes = 0
+    _response_bytes = 0
+    _revalidating = None
+    _cache_chunks = None
+    _in_flight = False
+    _limit_key = None
+
+    def initialize(self, stream_response=True, websocket_idle_timeout=3600, # pylint: disable=arguments-differ,too-many-arguments
+                   max_websockets_per_user=None, upstream_client='simple',
+                   upstream_max_clients=100, connect_timeout=20,
+                   request_timeout=600, cache_responses=False, rate_limit=None,
+                   rate_burst=None, max_concurrent_requests=None,
+                   compress_responses=False, compress_min_size=1024,
+                   compress_encodings=('br', 'gzip'), compress_cpu_budget=None,
+                   circuit_breaker_threshold=5, circuit_breaker_delay=1,
+                   circuit_breaker_max_delay=60, coalesce_requests=True,
+                   forwarded_headers=True, warmup_wait=30, **kwargs):
+        """
+        Set the proxy_port (and the other options of `ProxyBaseHandler`).
+
+        If stream_response is True (default), the response body is forwarded
+        chunk by chunk, otherwise it is first read fully in memory.
+
+        Websockets are closed after websocket_idle_timeout seconds without
+        traffic, and at most max_websockets_per_user can be open at the same
+        time for the same user (further ones get a 429 error).
+
+        Requests are sent to the upstream with a client shared by the whole
+        process: upstream_client selects its backend, upstream_max_clients
+        how many requests it runs concurrently, for all the users and ports
+        together (the other requests wait in a queue, so a few slow
+        upstreams can delay the requests to all the others).
+        connect_timeout and request_timeout apply to each request.
+        The 'simple' backend (default, without dependencies) opens a new
+        connection to the upstream for each request, with no keep-alive;
+        'curl' (requires `pycurl`) keeps the connections alive and reuses
+        them, but only pauses a streamed response once 1MB is waiting to be
+        sent to a slow client. The request bodies streamed by the
+        `StreamingProxyHandler` are always sent with the 'simple' backend.
+
+        If cache_responses is True, the responses to GET requests are cached
+        in memory (see `jhproxy.cache.ResponseCache`), as allowed by their
+        Cache-Control headers.
+
+        The requests for each user, proxy port and token are limited to
+        rate_limit per second (with bursts of rate_burst requests, by default
+        max(1, rate_limit)), and to max_concurrent_requests at the same time.
+        Further requests get a 429 error, with a Retry-After header. These
+        limits can also be set per spawner (see `TokenizedDockerSpawner`).
+
+        The upstream responses are forwarded with their encoding. If
+        compress_responses is True, the ones that are not encoded and are
+        compressible (text, JSON, ...) are compressed on the fly, if at least
+        compress_min_size bytes long (or of unknown length), with the first
+        of compress_encodings ('br', if `brotli` is installed, and 'gzip')
+        accepted by the client. While the compressions of the process have
+        used more than compress_cpu_budget (a fraction of a CPU core, e.g.
+        0.5), new responses are sent uncompressed.
+
+        After circuit_breaker_threshold failed connections in a row to the
+        same port of a container (e.g. nothing listens on it), its requests
+        get a 503 error right away (see `jhproxy.health.UpstreamHealth`),
+        until a probe connects: one request is let through after
+        circuit_breaker_delay seconds, then after twice as long after each
+        failure, up to circuit_breaker_max_delay. None disables it.
+
+        If coalesce_requests is True, the identical GET requests (same user,
+        port, URL, token and headers) proxied at the same time share one
+        request to the upstream, and its response (see
+        `jhproxy.coalesce`). It can also be set per spawner.
+
+        The requests are forwarded without their hop-by-hop headers and the
+        credentials of the hub (see `jhproxy.headers`). If forwarded_headers
+        is True, the X-Forwarded-For, X-Forwarded-Host and X-Forwarded-Proto
+        headers are set to the client, host and protocol of the request as
+        seen by the hub, instead of the ones sent by the client.
+
+        The requests to a port being warmed up after its container started
+        (see `jhproxy.warmup` and the `proxy_warmup_ports` of the spawner)
+        wait for it to be ready, for at most warmup_wait seconds, before
+        being proxied. None disables it.
+        """
+        super().initialize(**kwargs)
+        self.stream_response = stream_response
+        self.websocket_idle_timeout = websocket_idle_timeout
+        self.max_websockets_per_user = max_websockets_per_user
+        self.upstream_client = upstream_client
+        self.upstream_max_clients = upstream_max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.cache_responses = cache_responses
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.max_concurrent_requests = max_concurrent_requests
+        self.compress_responses = compress_responses
+        self.compress_min_size = compress_min_size
+        self.compress_encodings = compress_encodings
+        self.compress_cpu_budget = compress_cpu_budget
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_delay = circuit_breaker_delay
+        self.circuit_breaker_max_delay = circuit_breaker_max_delay
+        self.coalesce_requests = coalesce_requests
+        self.forwarded_headers = forwarded_headers
+        self.warmup_wait = warmup_wait
+
+    @gen.coroutine
+    def prepare(self):
+        """Count the request as in flight, in the metrics."""
+        yield super().prepare()
+        self._port_label = self.get_port_label()
+        REQUESTS_IN_FLIGHT.labels(self._port_label).inc()
+        self._in_flight = True
+        self._span = tracer.start_span(
+            'proxy', self.request.headers, attributes={
+                'http.request.method': self.request.method,
+                'url.path': self.request.path,
+                'jhproxy.proxy_port': self._port_label,
+            })
+
+    def get_port_label(self):
+        """Return the value of the proxy_port label of the metrics."""
+        return str(self.proxy_port)
+
+    def check_xsrf_cookie(self):
+        """
+        Do not check the XSRF token of the hub (`xsrf_cookies` is set since
+        JupyterHub 4.1): the proxied requests are authorized by the proxy
+        tokens, and the clients of the containers do not know the `_xsrf`
+        of the hub, so their POST, PUT, PATCH and DELETE requests would get
+        a 403 error.
+        """
+
+    def _end_in_flight(self):
+        """
+        Stop counting the request as in flight (once: the request might end
+        both when the handler finishes and when a websocket is closed).
+
+        Return True if it was counted.
+        """
+        if not self._in_flight:
+            return False
+        self._in_flight = False
+        REQUESTS_IN_FLIGHT.labels(self._port_label).dec()
+        return True
+
+    def on_finish(self):
+        """Record the status and the duration of the request."""
+        self._end_limits()
+        if self._end_in_flight():
+            RESPONSES.labels(self._port_label, str(self.get_status())).inc()
+            REQUEST_DURATION_SECONDS.labels(self._port_label).observe(
+                self.request.request_time())
+        self._end_span()
+        # The request failed while the identical ones were waiting for it
+        self._end_flight(RuntimeError("The coalesced request failed"))
+        super().on_finish()
+
+    def _end_span(self):
+        """End the span of the request, with its status and its bytes."""
+        span = self._span
+        span.set_attribute('http.response.status_code', self.get_status())
+        span.set_attribute('jhproxy.request_bytes', self._request_bytes)
+        span.set_attribute('jhproxy.response_bytes', self._response_bytes)
+        if self.get_status() >= 500:
+            span.set_error(self._reason)
+        span.end()
+
+    def _count_request_bytes(self, size):
+        """Count bytes sent to the upstream."""
+        self._request_bytes += size
+        REQUEST_BYTES.labels(self._port_label).inc(size)
+
+    def _count_response_bytes(self, size):
+        """Count bytes sent to the client."""
+        self._response_bytes += size
+        RESPONSE_BYTES.labels(self._port_label).inc(size)
+
     @gen.coroutine
     def get(self, username, proxy_path=''): # pylint: disable=arguments-differ
         '''Manage proxy redirection, optionally with authorization (depending
         on the spawner).'''
+        upstream = yield self.get_upstream(username, proxy_path)
+        if upstream is None:
+            return
+        route, host_port = upstream
+        spawner = route.spawner
+
+        # Ok, we are authenticated: proxy the request
+        if self.is_websocket_request():
+            error = yield self.proxy_websocket(
+                username, route.host_ip, host_port, proxy_path)
+            self.check_upstream_error(spawner, error)
+            return
+
+        response = yield self.proxy( # pylint: disable=not-callable
+            uri='http://{}'.format(route.host_ip),
+            port=host_port,
+            proxied_path=proxy_path)
+        if response is not None:
+            self.check_upstream_error(spawner, response.error)
 
+    # All methods are proxied in the same way (OPTIONS is instead answered
+    # directly, for the CORS preflight requests)
+    post = put = delete = patch = head = get
+
+    @gen.coroutine
+    def get_upstream(self, username, proxy_path):
+        '''
+        Find the spawner of the user and the host port to proxy to, and
+        check the authorization of the request.
+
+        Return a tuple (route, host_port), with the `UserRoute` of the user,
+        if the request can be proxied;
+        otherwise, set the error status and message and return None.
+        '''
         if self.proxy_port is None:
             self.set_status(500)
             self.write(
@@ -217,32 +820,96 @@ class ProxyHandler(ProxyBaseHandler):
             )
             return
 
-        self.log.debug('Username: {}; Port: {}; Proxy path: {}'.format(
-            username, self.proxy_port, proxy_path))
+        self.log.debug('Username: %s; Port: %s; Proxy path: %s',
+                       username, self.proxy_port, proxy_path)
 
-        spawner = self.get_spawner_from_username(username)
-        if spawner is None:
-            self.log.debug(
-                "No DockerSpawner found (only DockerSpawner supported)")
-            self.set_status(404)
-            self.write("Not found or not available")
+        auth_start = time.perf_counter()
+        auth_span = self._span.child('auth',
+                                     attributes={'enduser.id': username})
+        try:
+            route = yield self.get_user_route(username)
+            if route is None:
+                self.log.debug(
+                    "No DockerSpawner found (only DockerSpawner supported)")
+                self.set_status(404)
+                self.write("Not found or not available")
+                return
+            if not self.is_port_allowed(route):
+                self.log.debug("Port %s not allowed for %s", self.proxy_port,
+                               username)
+                self.set_status(404)
+                self.write("Not found or not available")
+                return
+            spawner = route.spawner
+
+            token_scope = self.authorize(route)
+            if token_scope is None:
+                return
+        finally:
+            auth_span.set_attribute('http.response.status_code',
+                                    self.get_status())
+            auth_span.end()
+
+        PHASE_DURATION_SECONDS.labels('auth').observe(
+            time.perf_counter() - auth_start)
+
+        # Rejected requests cost no docker nor upstream work
+        if not self.check_limits(route, username, token_scope):
+            return
+        yield self.wait_upstream_warmup(spawner)
+        if not self.check_upstream_health(spawner):
             return
 
         ## Get the port
-        host_port = yield self.get_proxied_port(spawner)
+        lookup_start = time.perf_counter()
+        lookup_span = self._span.child('port_lookup')
+        host_port = None
+        try:
+            host_port = yield self.get_proxied_port(spawner, lookup_span)
+        except Exception as exc:
+            lookup_span.set_error(exc)
+            raise
+        finally:
+            lookup_span.set_attribute('jhproxy.host_port', host_port)
+            lookup_span.end()
+        PHASE_DURATION_SECONDS.labels('port_lookup').observe(
+            time.perf_counter() - lookup_start)
 
         if host_port is None:
             self.set_status(503)
             self.write("Not port mapping enabled in the docker container")
             return
-        self.log.debug("Host port:{}".format(str(host_port)))
+        self.log.debug("Host port:%s", host_port)
 
-        if isinstance(spawner, TokenizedDockerSpawner):
-            expected_token = spawner.proxy_token
-        else:
-            # If this is not a TokenizedDockerSpawner: then we always
-            # allow the request
-            expected_token = ""
+        # Responses cached for this request can only be shared with the
+        # requests of the same user, authorized by the same token (its
+        # digest, or "" if no token is needed)
+        self._proxy_user = username
+        self._token_scope = token_scope
+        self._coalesce_requests = (route.coalesce_requests
+                                   if route.coalesce_requests is not None
+                                   else self.coalesce_requests)
+        raise gen.Return((route, host_port))
+
+    def is_port_allowed(self, route):
+        '''
+        Return True if the proxy_port can be proxied for the route: always,
+        unless the spawner restricts its ports.
+        '''
+        return (route.allowed_ports is None or
+                self.proxy_port in route.allowed_ports)
+
+    def authorize(self, route):
+        '''
+        Check the proxy token of the request against the tokens of the route.
+
+        Return the scope of the token (its digest, or "" if no token is
+        needed) if the request is authorized; otherwise, set a 403 error and
+        return None.
+        '''
+        # If this is not a TokenizedDockerSpawner: then we always
+        # allow the request (the tokens are in the 'allow_all' mode)
+        tokens = route.proxy_tokens
 
         # We pop the header, to avoid to expose it to the service inside
         # the docker container
@@ -252,84 +919,875 @@ class ProxyHandler(ProxyBaseHandler):
         # do not want to pass a token.
         if proxy_token is None:
             proxy_token = ""
-        if expected_token is None:
+        if tokens.mode == 'disabled':
             self.set_status(403)
             self.write("Unauthorized access (disabled)")
-            return
+            return None
 
         # Actual authentication check
-        # If the expected_token is "", it means 'allow all' and
-        # therefore the check is skipped completely, even
-        # if a different token is passed
-        if expected_token != "":
-            if proxy_token != expected_token:
+        # In the 'allow_all' mode the check is skipped completely, even
+        # if a token is passed
+        token_scope = ""
+        if tokens.mode != 'allow_all':
+            token_scope = tokens.verify(proxy_token)
+            if token_scope is None:
                 self.set_status(403)
                 self.write("Unauthorized access")
-                return
+                return None
+        return token_scope
 
-        # Ok, we are authenticated: proxy the request
-        yield self.proxy( # pylint: disable=not-callable
-            uri='http://{}'.format(spawner.host_ip),
-            port=host_port,
-            proxied_path=proxy_path)
+    def check_limits(self, route, username, token_scope):
+        '''
+        Apply the rate limit and the cap on the concurrent requests of the
+        user, proxy port and token (the ones of the spawner, if set,
+        otherwise the ones of the handler).
+
+        Return True if the request can be proxied; otherwise, set a 429
+        error (with a Retry-After header) and return False.
+        '''
+        key = (username, self.proxy_port, token_scope)
+
+        rate_limit = route.rate_limit
+        rate_burst = route.rate_burst
+        if rate_limit is None:
+            rate_limit = self.rate_limit
+            rate_burst = self.rate_burst
+        if rate_limit is not None:
+            wait = rate_limiter.acquire(key, rate_limit, rate_burst)
+            if wait:
+                self.set_status(429)
+                self.set_header('Retry-After', str(int(math.ceil(wait))))
+                self.write("Too many requests")
+                return False
+
+        max_concurrent = route.max_concurrent_requests
+        if max_concurrent is None:
+            max_concurrent = self.max_concurrent_requests
+        if max_concurrent is not None:
+            if not rate_limiter.start(key, max_concurrent):
+                self.set_status(429)
+                self.set_header('Retry-After', '1')
+                self.write("Too many concurrent requests")
+                return False
+            self._limit_key = key
+        return True
+
+    def _end_limits(self):
+        '''Release the slot of the request among the concurrent ones.'''
+        if self._limit_key is not None:
+            rate_limiter.end(self._limit_key)
+            self._limit_key = None
+
+    def check_upstream_health(self, spawner):
+        '''
+        Return True if the upstream of the spawner can be connected to;
+        otherwise (its circuit is open), set a 503 error (with a
+        Retry-After header) and return False.
+        '''
+        if self.circuit_breaker_threshold is None:
+            return True
+        wait = upstream_health.allow(spawner.container_id, self.proxy_port)
+        if not wait:
+            return True
+        UPSTREAM_CIRCUIT_OPEN.labels(self._port_label).inc()
+        self.set_status(503)
+        self.set_header('Retry-After', str(int(math.ceil(wait))))
+        self.write("Service not available on port {}".format(self.proxy_port))
+        return False
 
     @gen.coroutine
-    def proxy(self,uri, port, proxied_path): # pylint: disable=arguments-differ
+    def wait_upstream_warmup(self, spawner):
+        '''
+        Hold the request while the upstream of the spawner is warmed up
+        (for at most warmup_wait seconds).
+        '''
+        if (not self.warmup_wait or not upstream_warmup.warming(
+                spawner.container_id, self.proxy_port)):
+            return
+        warmup_start = time.perf_counter()
+        warmup_span = self._span.child('warmup')
+        try:
+            ready = yield upstream_warmup.wait(
+                spawner.container_id, self.proxy_port, self.warmup_wait)
+            warmup_span.set_attribute('jhproxy.upstream_ready', ready)
+        finally:
+            warmup_span.end()
+        PHASE_DURATION_SECONDS.labels('warmup').observe(
+            time.perf_counter() - warmup_start)
+
+    def check_upstream_error(self, spawner, error):
+        '''
+        Act on the error (or None) of the request to the upstream of the
+        spawner.
+        '''
+        # Nothing is listening on the (possibly stale) host port anymore,
+        # e.g. the container was restarted outside of the spawner: drop the
+        # cached mapping so that the next request inspects docker again
+        if _is_connection_refused(error):
+            route_cache.invalidate(spawner, self.proxy_port)
+        if self.circuit_breaker_threshold is not None:
+            upstream_health.record(
+                spawner.container_id, self.proxy_port,
+                _is_connect_error(error),
+                threshold=self.circuit_breaker_threshold,
+                delay=self.circuit_breaker_delay,
+                max_delay=self.circuit_breaker_max_delay)
+
+    def get_upstream_headers(self, websocket=False):
+        '''
+        Return the headers of the request (a websocket handshake if
+        websocket is True) to send to the upstream, without the hop-by-hop
+        headers nor the credentials of the hub (see `jhproxy.headers`),
+        and with the X-Forwarded-* headers if forwarded_headers is True.
+        '''
+        headers = get_request_headers(self.request.headers, websocket,
+                                      self.forwarded_headers)
+        if self.forwarded_headers:
+            headers['X-Forwarded-For'] = self.request.remote_ip
+            headers['X-Forwarded-Host'] = self.request.host
+            headers['X-Forwarded-Proto'] = self.request.protocol
+        return headers
+
+    def is_websocket_request(self):
+        '''Return True if the client asks to upgrade to a websocket.'''
+        return self.request.headers.get("Upgrade", "").lower() == 'websocket'
+
+    @gen.coroutine
+    def proxy_websocket(self, username, host_ip, host_port, proxied_path):
+        '''
+        Proxy a websocket: the handshake request is sent to the upstream,
+        then the client connection is detached from tornado and the bytes
+        are relayed in both directions, without parsing the frames (the
+        upstream answers the handshake itself).
+
+        Return the error if the connection to the upstream failed, or None.
+        '''
+        if (self.max_websockets_per_user is not None and
+                open_websockets[username] >= self.max_websockets_per_user):
+            self.set_status(429)
+            self.write("Too many open websockets")
+            return
+
+        try:
+            upstream = yield TCPClient().connect(
+                host_ip, host_port, timeout=self.connect_timeout)
+        except (IOError, StreamClosedError, gen.TimeoutError) as exc:
+            UPSTREAM_ERRORS.labels(self._port_label,
+                                   _get_error_label(exc)).inc()
+            self.set_status(500)
+            self.write("{}".format(xhtml_escape(str(exc))))
+            raise gen.Return(exc)
+
+        path = proxied_path
+        if self.request.query:
+            path += '?' + self.request.query
+        lines = ['{} {} HTTP/1.1'.format(self.request.method, path)]
+        for header, v in self.get_upstream_headers(websocket=True).get_all():
+            lines.append('{}: {}'.format(header, v))
+        lines.extend(['', ''])
+
+        client = self.detach()
+        # A websocket is not counted among the concurrent requests
+        self._end_limits()
+        open_websockets[username] += 1
+        try:
+            yield upstream.write('\r\n'.join(lines).encode('latin1'))
+            sent, received = yield relay(
+                client, upstream, idle_timeout=self.websocket_idle_timeout)
+            self._count_request_bytes(sent)
+            self._count_response_bytes(received)
+        except StreamClosedError:
+            pass
+        finally:
+            client.close()
+            upstream.close()
+            # A detached request is never finished by tornado
+            self._end_in_flight()
+            self._end_span()
+            open_websockets[username] -= 1
+            if not open_websockets[username]:
+                del open_websockets[username]
+        self.log.debug("Websocket of %s to port %s closed",
+                       username, self.proxy_port)
+
+    def _set_upstream_headers(self, code, reason, headers):
         """
-        Proxy the request.
+        Set the status and the headers of the upstream response.
         """
-        if 'Proxy-Connection' in self.request.headers:
-            del self.request.headers['Proxy-Connection']
+        self.set_status(code, reason)
 
-        if self.request.headers.get("Upgrade", "").lower() == 'websocket':
-            self.set_status(500)
-            self.write("Not enabled for websocket")
+        # clear tornado default headers
+        self._headers = httputil.HTTPHeaders()
+
+        # Set the CORS headers
+        self._set_proxy_custom_headers()
+
+        # The body is forwarded with its encoding, but re-framed by tornado
+        # (without a body, for HEAD: keep the length of the body that a GET
+        # would return)
+        copy_headers(headers, self._headers,
+                     HEAD_RESPONSE_SKIPPED_HEADERS
+                     if self.request.method == 'HEAD'
+                     else RESPONSE_SKIPPED_HEADERS)
+
+        if self._cache_key is not None:
+            self.set_header('X-Proxy-Cache', 'MISS')
+
+        self._compressor = self._get_compressor(code, headers)
+
+    def _get_compressor(self, code, headers):
+        """
+        Return the `jhproxy.compress.Compressor` of the response with the
+        given status and upstream headers, and set its headers; or None if
+        it is sent as it is.
+        """
+        if (not self.compress_responses or self.request.method == 'HEAD'
+                or code < 200 or code in (204, 304)
+                or 'Content-Encoding' in headers
+                or not is_compressible(headers.get('Content-Type', ''))
+                or 'no-transform' in parse_cache_control(
+                    headers.get('Cache-Control', ''))):
+            return None
+        length = headers.get('Content-Length', '')
+        if length.isdigit() and int(length) < self.compress_min_size:
+            return None
+
+        # The response depends on the encodings accepted by the client
+        vary = self._headers.get('Vary')
+        if not vary:
+            self.set_header('Vary', 'Accept-Encoding')
+        elif vary.strip() != '*' and 'accept-encoding' not in vary.lower():
+            self.set_header('Vary', vary + ', Accept-Encoding')
+
+        encoding = negotiate_encoding(
+            self.request.headers.get('Accept-Encoding'),
+            self.compress_encodings)
+        if encoding is None:
+            return None
+        if not compression_budget.available(self.compress_cpu_budget):
+            COMPRESSION_BUDGET_EXCEEDED.inc()
+            return None
+
+        self.set_header('Content-Encoding', encoding)
+        # The compressed body is not byte-for-byte the one of the upstream
+        etag = self._headers.get('Etag')
+        if etag and not etag.startswith('W/'):
+            self.set_header('Etag', 'W/' + etag)
+        COMPRESSED_RESPONSES.labels(self._port_label, encoding).inc()
+        return Compressor(encoding, self.compress_cpu_budget)
+
+    def _write_body(self, chunk):
+        """Write a chunk of the response body, compressed if needed."""
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+        if chunk:
+            self._count_response_bytes(len(chunk))
+            self.write(chunk)
+
+    def _finish_body(self):
+        """Write the end of the compressed response body, if compressed."""
+        compressor = self._compressor
+        if compressor is None:
             return
+        self._compressor = None
+        chunk = compressor.finish()
+        COMPRESSION_CPU_SECONDS.inc(compressor.cpu_time)
+        if chunk:
+            self._count_response_bytes(len(chunk))
+            self.write(chunk)
 
-        body = self.request.body
-        if not body:
-            if self.request.method == 'POST':
-                body = b''
+    def _write_cached_response(self, entry, cache_status):
+        """
+        Write a response from the cache (answering a 304 if the client
+        already has it).
+        """
+        self._set_upstream_headers(entry.code, entry.reason, entry.headers)
+        self.set_header('X-Proxy-Cache', cache_status)
+        if self.check_etag_header():
+            self.set_status(304)
+            self._compressor = None
+        else:
+            self._write_body(entry.body)
+            self._finish_body()
+
+    def _on_upstream_header(self, line):
+        """
+        Collect the upstream response headers, one line at a time, and
+        send them to the client as soon as they are complete.
+        """
+        if line.startswith('HTTP/'):
+            # Start line (can be repeated, e.g. after a '100 Continue')
+            self._upstream_start_line = httputil.parse_response_start_line(
+                line.strip())
+            self._upstream_headers = httputil.HTTPHeaders()
+        elif line.strip():
+            self._upstream_headers.parse_line(line)
+        elif self._upstream_start_line.code >= 200:
+            # Empty line: end of the (final) headers
+            if self._revalidating is not None:
+                if self._upstream_start_line.code == 304:
+                    # The cached response is still valid: it is written
+                    # once the request is finished
+                    return
+            if (self._cache_key is not None and
+                    self._upstream_start_line.code == 200):
+                self._cache_chunks = []
+                self._cache_size = 0
+            self._set_upstream_headers(self._upstream_start_line.code,
+                                       self._upstream_start_line.reason,
+                                       self._upstream_headers)
+            if self._flight is not None:
+                self._flight.start(self._upstream_start_line.code,
+                                   self._upstream_start_line.reason,
+                                   self._upstream_headers)
+            self.flush()
+
+    def _on_upstream_chunk(self, chunk):
+        """
+        Forward a chunk of the upstream response body to the client.
+
+        The upstream is not read further until the chunk has been flushed,
+        so that at most one chunk per connection is kept in memory.
+        """
+        if self._cache_chunks is not None:
+            # Keep a copy to store in the cache, unless it gets too large
+            self._cache_size += len(chunk)
+            if self._cache_size > response_cache.max_entry_size:
+                self._cache_chunks = None
             else:
-                body = None
+                self._cache_chunks.append(chunk)
+        self._write_body(chunk)
+        if self._flight is not None:
+            # The followers still get the body if this client disconnects
+            return self._flight.write(chunk, self.flush())
+        return self.flush()
+
+    @gen.coroutine
+    def _follow(self, flight, request_headers):
+        """
+        Wait for the response of an identical request in flight, and send it
+        to the client as well.
+
+        Return True if it was sent, or False if the response cannot be
+        shared with this request, which must then be sent to the upstream.
+        """
+        def on_headers(code, reason, headers):
+            if not is_shareable(headers, flight.request_headers,
+                                request_headers):
+                return False
+            self._set_upstream_headers(code, reason, headers)
+            self.flush()
+            return True
+
+        def on_chunk(chunk):
+            self._write_body(chunk)
+            return self.flush()
+
+        try:
+            shared = yield flight.follow(on_headers, on_chunk)
+        except Exception as exc: # pylint: disable=broad-except
+            # As for the request in flight: the body is truncated
+            self.log.warning("Error while streaming a coalesced response: %s",
+                             exc)
+            self.request.connection.close()
+            raise gen.Return(True)
+        if shared:
+            COALESCED_REQUESTS.labels(self._port_label).inc()
+            self._span.set_attribute('jhproxy.coalesced', True)
+            self._finish_body()
+        raise gen.Return(shared)
+
+    def _end_flight(self, error=None):
+        """
+        End the response of the requests following this one (once), with
+        the error, if any.
+        """
+        flight, self._flight = self._flight, None
+        if flight is not None:
+            flight.finish(error)
+
+    @gen.coroutine
+    def proxy(self,uri, port, proxied_path, body_producer=None): # pylint: disable=arguments-differ
+        """
+        Proxy the request.
+
+        If a body_producer is passed, it is used to send the request body
+        to the upstream, instead of `self.request.body`.
+
+        Return the response of the upstream (None if the request was
+        not forwarded).
+        """
+        # A new copy: with a streamed body, tornado still needs the original
+        # headers to read it
+        headers = self.get_upstream_headers()
+
+        if body_producer is not None:
+            body = None
+        else:
+            body = self.request.body
+            if not body:
+                if self.request.method in ('POST', 'PUT', 'PATCH'):
+                    body = b''
+                else:
+                    body = None
+            if body:
+                self._count_request_bytes(len(body))
 
         client_uri = '{uri}:{port}{path}'.format(
             uri=uri, port=port, path=proxied_path)
         if self.request.query:
             client_uri += '?' + self.request.query
 
-        client = httpclient.AsyncHTTPClient()
+        backend = self.upstream_client
+        if body_producer is not None:
+            # The curl client of tornado cannot stream the request body
+            backend = 'simple'
+        client = get_upstream_client(backend, self.upstream_max_clients)
+
+        self._cache_key = None
+        self._revalidating = None
+        self._cache_chunks = None
+        request_key = None
+        if response_cache.is_cacheable_request(self.request.method, headers):
+            # The body is cached as encoded by the upstream, that might
+            # depend on the encodings accepted by the client
+            request_key = (self._proxy_user, self.proxy_port, proxied_path,
+                           self.request.query, self._token_scope,
+                           headers.get('Accept-Encoding', ''))
+        if self.cache_responses and request_key is not None:
+            self._cache_key = request_key
+            cached = response_cache.get(self._cache_key, headers)
+            if cached is not None:
+                if (cached.is_fresh() and
+                        not response_cache.wants_revalidation(headers)):
+                    self._span.set_attribute('jhproxy.cache', 'HIT')
+                    self._write_cached_response(cached, 'HIT')
+                    return
+                if cached.etag is not None:
+                    # Ask the upstream if the cached response is still valid
+                    self._revalidating = cached
+                    headers['If-None-Match'] = cached.etag
+                    if 'If-Modified-Since' in headers:
+                        del headers['If-Modified-Since']
 
-        self.log.debug("client_uri: {}".format(client_uri))
+        if (self._coalesce_requests and request_key is not None and
+                body_producer is None and self._revalidating is None):
+            key = get_key(request_key, headers)
+            flight = request_coalescer.join(key)
+            if flight is not None:
+                shared = yield self._follow(flight, headers)
+                if shared:
+                    return
+            self._flight = request_coalescer.begin(key, headers)
+
+        self.log.debug("client_uri: %s", client_uri)
+
+        # The upstream continues the trace of the request (if it is traced)
+        fetch_span = self._span.child('fetch', CLIENT, attributes={
+            'http.request.method': self.request.method,
+            'url.full': client_uri,
+        })
+        traceparent = fetch_span.traceparent()
+        if traceparent is not None:
+            headers['traceparent'] = traceparent
+
+        if self.stream_response:
+            self._upstream_start_line = None
+            self._upstream_headers = None
+            stream_kwargs = dict(
+                header_callback=self._on_upstream_header,
+                streaming_callback=self._on_upstream_chunk)
+        else:
+            stream_kwargs = {}
 
         req = httpclient.HTTPRequest(
             client_uri,
             method=self.request.method,
             body=body,
-            headers=self.request.headers,
-            follow_redirects=False)
+            body_producer=body_producer,
+            headers=headers,
+            follow_redirects=False,
+            # Forward the body with its encoding (the Accept-Encoding of the
+            # client is forwarded as it is)
+            decompress_response=False,
+            # e.g. a body in a DELETE request: just forward it
+            allow_nonstandard_methods=True,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout,
+            **stream_kwargs)
 
-        response = yield client.fetch(req, raise_error=False)
+        fetch_start = time.perf_counter()
+        try:
+            response = yield client.fetch(req, raise_error=False)
+        except Exception as exc: # pylint: disable=broad-except
+            # Errors without an HTTP response (connection refused, timeouts,
+            # client disconnected, ...) are raised even with raise_error=False
+            response = httpclient.HTTPResponse(req, 599, error=exc)
+        PHASE_DURATION_SECONDS.labels('fetch').observe(
+            time.perf_counter() - fetch_start)
+        fetch_span.set_attribute('http.response.status_code', response.code)
+        if response.error and type(response.error) is not httpclient.HTTPError:
+            fetch_span.set_error(response.error)
+        fetch_span.end()
 
         # Return a 500 error for all non-HTTP errors
         if response.error and type(response.error) is not httpclient.HTTPError:
-            self.set_status(500)
-            self.write("{}".format(xhtml_escape(str(response.error))))
+            UPSTREAM_ERRORS.labels(self._port_label,
+                                   _get_error_label(response.error)).inc()
+            self._end_flight(response.error)
+            if self._headers_written:
+                # The response was already being streamed to the client:
+                # we cannot change the status anymore, so we close the
+                # connection to signal that the body is truncated
+                self.log.warning("Error while streaming %s: %s",
+                                 client_uri, response.error)
+                self.request.connection.close()
+            else:
+                self.set_status(500)
+                self.write("{}".format(xhtml_escape(str(response.error))))
+        elif self._revalidating is not None and response.code == 304:
+            cached = self._revalidating
+            cached.refresh(response.headers)
+            cached.set_ttl(response_cache.get_ttl(
+                cached.code, cached.headers, headers) or 0)
+            response_cache.revalidations += 1
+            self._span.set_attribute('jhproxy.cache', 'REVALIDATED')
+            self._write_cached_response(cached, 'REVALIDATED')
         else:
-            self.set_status(response.code, response.reason)
+            body = None
+            if not self.stream_response:
+                if self._cache_key is not None and response.code == 200:
+                    body = response.body
+                self._set_upstream_headers(response.code, response.reason,
+                                           response.headers)
+                if self._flight is not None:
+                    self._flight.start(response.code, response.reason,
+                                       response.headers)
+                if response.body:
+                    self._write_body(response.body)
+                    if self._flight is not None:
+                        yield self._flight.write(response.body)
+            elif self._cache_chunks is not None:
+                body = b''.join(self._cache_chunks)
+            self._finish_body()
+            self._end_flight()
+            if body is not None:
+                ttl = response_cache.get_ttl(response.code, response.headers,
+                                             headers)
+                if ttl is not None:
+                    response_cache.set(self._cache_key, headers, response.code,
+                                       response.reason, response.headers,
+                                       body, ttl)
+
+        raise gen.Return(response)
+
+
+# Queued instead of a chunk of the body, when the client disconnects
+_CLIENT_CLOSED = object()
+
+
+@stream_request_body
+class StreamingProxyHandler(ProxyHandler):
+    """
+    A ProxyHandler that streams the request body to the upstream, chunk by
+    chunk as it is received, instead of reading it fully in memory first.
+    Use it for services that receive large uploads (POST/PUT/PATCH). As
+    for the ProxyHandler, the XSRF token of the hub is not checked.
+
+    It is configured as the ProxyHandler, e.g.:
 
-            # clear tornado default headers
-            self._headers = httputil.HTTPHeaders()
+    ```
+    (r'/proxy/([^/]+)(/.*)', StreamingProxyHandler,
+     dict(proxy_port=5000, max_body_size=10 * 1024**3))
+    ```
+
+    Additional options:
+    - `max_body_size`: the largest request body accepted, in bytes (if not
+      specified, the default of the tornado HTTP server is used, i.e. 100MB).
+    - `body_queue_size`: how many received chunks can wait to be sent to the
+      upstream; when the queue is full, the hub stops reading from the
+      client until the upstream catches up.
+    """
+    max_body_size = None
+    body_queue_size = 16
+
+    _body_received = False
+    _aborted = False
 
-            # Set the CORS headers
-            self._set_proxy_custom_headers()
+    def initialize(self, max_body_size=None, body_queue_size=16, **kwargs): # pylint: disable=arguments-differ
+        super().initialize(**kwargs)
+        self.max_body_size = max_body_size
+        self.body_queue_size = body_queue_size
+        self._body_chunks = None
+        self._upstream_future = None
+
+    @gen.coroutine
+    def prepare(self):
+        """
+        Check the request and start proxying it as soon as the headers are
+        received, so that the body can be forwarded while it arrives.
+        """
+        yield super().prepare()
+        if self._finished:
+            return
 
-            # reset the headers
-            for header, v in response.headers.get_all():
-                if header not in ('Content-Length', 'Transfer-Encoding',
-                                  'Content-Encoding', 'Connection'):
-                    # some header appear multiple times, eg 'Set-Cookie'
-                    self.add_header(header, v)
+        if self.max_body_size is not None:
+            self.request.connection.set_max_body_size(self.max_body_size)
+
+        username, proxy_path = self.path_args[0], self.path_args[1]
+        upstream = yield self.get_upstream(username, proxy_path)
+        if upstream is None:
+            self.finish()
+            return
+        route, host_port = upstream
+        self._route = route
+        self._host_port = host_port
+
+        if self.is_websocket_request():
+            # Proxied in get(), once tornado is done with the request
+            return
+
+        if (self.request.method in ('POST', 'PUT', 'PATCH') or
+                'Content-Length' in self.request.headers or
+                'Transfer-Encoding' in self.request.headers):
+            self._body_chunks = queues.Queue(maxsize=self.body_queue_size)
+            body_producer = self._produce_body
+        else:
+            body_producer = None
+        self._upstream_future = self.proxy( # pylint: disable=not-callable
+            uri='http://{}'.format(route.host_ip),
+            port=host_port,
+            proxied_path=proxy_path,
+            body_producer=body_producer)
+        self._upstream_future.add_done_callback(self._discard_body)
+
+    def _discard_body(self, future=None): # pylint: disable=unused-argument
+        """
+        Stop queueing the body (e.g. the upstream failed or answered
+        before reading all of it), and release any chunk still waiting.
+        """
+        body_chunks, self._body_chunks = self._body_chunks, None
+        if body_chunks is None:
+            return
+        while True:
+            try:
+                body_chunks.get_nowait()
+            except queues.QueueEmpty:
+                break
+
+    def data_received(self, chunk):
+        """
+        Queue a chunk of the request body to be sent to the upstream.
+
+        The returned Future resolves when there is room in the queue: tornado
+        waits for it before reading more from the client (flow control).
+        """
+        if self._body_chunks is None:
+            # Not proxied (e.g. unauthorized), or no body expected
+            return None
+        self._count_request_bytes(len(chunk))
+        return self._body_chunks.put(chunk)
+
+    @gen.coroutine
+    def _produce_body(self, write):
+        """
+        Send the queued chunks of the body to the upstream (failing if the
+        client disconnects before sending all of it).
+        """
+        body_chunks = self._body_chunks
+        while True:
+            chunk = yield body_chunks.get()
+            if chunk is None:
+                break
+            if chunk is _CLIENT_CLOSED:
+                raise StreamClosedError(
+                    real_error=RuntimeError("The client disconnected"))
+            yield write(chunk)
+
+    def on_connection_close(self):
+        """
+        If the client disconnects before sending all the body, abort the
+        request to the upstream.
+
+        tornado does not finish such requests: once the upstream request has
+        ended, `on_finish` is called here instead, to release the slot of the
+        request among the concurrent ones and stop counting it as in flight.
+        """
+        super().on_connection_close()
+        if (self._aborted or self._body_received or
+                self._upstream_future is None):
+            return
+        self._aborted = True
+        body_chunks = self._body_chunks
+        if body_chunks is not None:
+            # Drop the chunks waiting (and the ones being queued) to make
+            # room for the end of the body
+            while True:
+                try:
+                    body_chunks.get_nowait()
+                except queues.QueueEmpty:
+                    break
+            body_chunks.put_nowait(_CLIENT_CLOSED)
+        self._upstream_future.add_done_callback(
+            lambda future: self.on_finish())
+
+    @gen.coroutine
+    def get(self, username, proxy_path=''): # pylint: disable=arguments-differ
+        '''Wait for the request, started in `prepare`, to be proxied.'''
+        if self._upstream_future is None:
+            error = yield self.proxy_websocket(
+                username, self._route.host_ip, self._host_port, proxy_path)
+            self.check_upstream_error(self._route.spawner, error)
+            return
+
+        self._body_received = True
+        if self._body_chunks is not None:
+            # The body has been fully received: signal its end
+            yield self._body_chunks.put(None)
+        response = yield self._upstream_future
+        if response is not None:
+            self.check_upstream_error(self._route.spawner, response.error)
+
+    post = put = delete = patch = head = get
+
+
+class _MultiPortMixin(object):
+    """
+    Take the proxy port from the first group of the URL, and proxy it only
+    if allowed by the spawner of the user or by the port policy.
+    """
+    port_policy = port_policy
+
+    def initialize(self, port_policy=None, **kwargs): # pylint: disable=arguments-differ,redefined-outer-name
+        super().initialize(**kwargs)
+        if port_policy is not None:
+            self.port_policy = port_policy
+
+    @gen.coroutine
+    def prepare(self):
+        # The other methods get (username, proxy_path), as with one port
+        self.proxy_port = int(self.path_args[0])
+        self.path_args = self.path_args[1:]
+        yield super().prepare()
+
+    def get_port_label(self):
+        # Any number can be requested: the ports not in the policy share
+        # the same label
+        if self.port_policy.allows(self.proxy_port):
+            return str(self.proxy_port)
+        return 'other'
+
+    def is_port_allowed(self, route):
+        if route.allowed_ports is not None:
+            return self.proxy_port in route.allowed_ports
+        return self.port_policy.allows(self.proxy_port)
+
+
+class MultiPortProxyHandler(_MultiPortMixin, ProxyHandler):
+    r"""
+    A ProxyHandler for all the ports, with a single route: the port is the
+    first group of the URL regex, e.g.
+
+    ```
+    (r'/proxy/(\d+)/([^/]+)(/.*)', MultiPortProxyHandler)
+    ```
+
+    A port is proxied if it is in the `proxy_allowed_ports` of the spawner
+    of the user (see `TokenizedDockerSpawner`) or, if the spawner does not
+    set them, in the `jhproxy.routes.port_policy` (or in the `PortPolicy`
+    passed as the `port_policy` option). Other ports get a 404 error.
+    The policy can be changed without restarting the hub, e.g. with
+    `port_policy.set([5000, 6000])`, or `port_policy.watch(path)` to read
+    the ports from a JSON file whenever it changes.
+
+    The other options are the ones of the `ProxyHandler` (but `proxy_port`).
+    """
+
+
+@stream_request_body
+class MultiPortStreamingProxyHandler(_MultiPortMixin, StreamingProxyHandler):
+    """
+    A StreamingProxyHandler for all the ports, configured as the
+    `MultiPortProxyHandler`.
+    """
+
+
+class ProxyAuthHandler(ProxyHandler):
+    """
+    Authorize the requests to the routes pushed to the proxy of JupyterHub
+    by `TokenizedDockerSpawner` (see its `proxy_route_ports`), for the
+    proxies that ask an endpoint before forwarding each request, e.g.
+    `auth_request` in nginx or `ForwardAuth` in Traefik.
+
+    The original URI of the request is taken from the `X-Original-URI`
+    (nginx) or the `X-Forwarded-Uri` (Traefik) header, and matched against
+    the route template (the same as the `proxy_route_template` of the
+    spawners), e.g.:
+
+    ```
+    (r'/proxyauth', ProxyAuthHandler,
+     dict(route_template='/proxy{port}/{username}/'))
+    ```
+
+    The answer is 200 if the request can be forwarded, otherwise the same
+    error as the `ProxyHandler` would return (403, 404, 429), without
+    forwarding anything. The rate limits of the `ProxyHandler` apply, but
+    not the caps on the concurrent requests: the forwarded requests are not
+    seen by the hub. The metrics count the authorized requests for each
+    port in `jhproxy.routes.port_policy` (the other ports, taken from a
+    header that any client can set, share the 'other' label); their
+    durations are the ones of the authorization only.
+    """
+    route_template = DEFAULT_ROUTE_TEMPLATE
+
+    _auth_username = None
+
+    def initialize(self, route_template=DEFAULT_ROUTE_TEMPLATE, **kwargs): # pylint: disable=arguments-differ
+        super().initialize(**kwargs)
+        self.route_template = route_template
+
+    @gen.coroutine
+    def prepare(self):
+        """Find the port and the user of the original request."""
+        uri = (self.request.headers.get('X-Original-URI')
+               or self.request.headers.get('X-Forwarded-Uri', ''))
+        regex = compile_route_template(self.route_template,
+                                       self.settings.get('base_url', '/'))
+        match = regex.match(uri.split('?', 1)[0])
+        if match is not None:
+            self.proxy_port = int(match.group('port'))
+            self._auth_username = url_unescape(match.group('username'))
+        yield super().prepare()
+
+    def get_port_label(self):
+        # As for the multi-port handlers: any number can be requested
+        if self.proxy_port is None or port_policy.allows(self.proxy_port):
+            return str(self.proxy_port)
+        return 'other'
+
+    @gen.coroutine
+    def get(self): # pylint: disable=arguments-differ
+        '''Check if the original request can be forwarded.'''
+        username = self._auth_username
+        if username is None:
+            self.set_status(400)
+            self.write("Missing or unknown original URI")
+            return
+
+        route = yield self.get_user_route(username)
+        if route is None:
+            self.set_status(404)
+            self.write("Not found or not available")
+            return
+        token_scope = self.authorize(route)
+        if token_scope is None:
+            return
+        if not self.check_limits(route, username, token_scope):
+            return
+        # The forwarded request is not seen here
+        self._end_limits()
+        self.set_status(200)
 
-            if response.body:
-                self.write(response.body)
+    # The proxy might keep the method of the original request (the
+    # preflight OPTIONS requests are forwarded only with a valid token)
+    post = put = delete = patch = head = options = get
@@ -0,0 +1,69 @@
+from datetime import timedelta
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+import collections
+
+# Number of open (relayed) websockets per username, in this process
+open_websockets = collections.Counter()
+
+
+@gen.coroutine
+def _pipe(src, dst, activity, chunk_size):
+    """
+    Copy the bytes from src to dst until one of them is closed.
+
+    The next chunk is read only once the previous one has been written,
+    so at most one chunk is kept in memory.
+
+    Return the number of bytes copied.
+    """
+    copied = 0
+    try:
+        while True:
+            chunk = yield src.read_bytes(chunk_size, partial=True)
+            activity[0] = IOLoop.current().time()
+            yield dst.write(chunk)
+            copied += len(chunk)
+    except StreamClosedError:
+        pass
+    finally:
+        src.close()
+        dst.close()
+    raise gen.Return(copied)
+
+
+@gen.coroutine
+def relay(client, upstream, idle_timeout=None, chunk_size=65536):
+    """
+    Relay the bytes between two IOStreams (in both directions), until
+    one of the two sides closes its connection.
+
+    The frames are not parsed: after the websocket handshake, the bytes
+    are copied as they are. If idle_timeout (in seconds) is not None, both
+    connections are closed when no data has been relayed for that long.
+
+    Return a tuple with the number of bytes relayed from the client to the
+    upstream, and from the upstream to the client.
+    """
+    activity = [IOLoop.current().time()]
+    pipes = gen.multi([
+        _pipe(client, upstream, activity, chunk_size),
+        _pipe(upstream, client, activity, chunk_size),
+    ])
+    if idle_timeout is None:
+        copied = yield pipes
+        raise gen.Return(tuple(copied))
+
+    while not pipes.done():
+        remaining = activity[0] + idle_timeout - IOLoop.current().time()
+        if remaining <= 0:
+            client.close()
+            upstream.close()
+            break
+        try:
+            yield gen.with_timeout(timedelta(seconds=remaining), pipes)
+        except gen.TimeoutError:
+            pass
+    copied = yield pipes
+    raise gen.Return(tuple(copied))
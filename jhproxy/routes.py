@@ -0,0 +1,398 @@
+from tornado import gen
+from tornado.log import app_log
+from jhproxy.tokens import TokenSet
+from jhproxy.tracing import CLIENT, NO_SPAN
+from jhproxy.metrics import stats_collector
+import json
+import os
+import time
+
+
+class RouteCache(object):
+    """
+    Cache of the host ports that docker maps to the ports inside the
+    containers, to avoid a call to `inspect_container` for every request.
+
+    Entries are keyed by (spawner, container_id, proxy_port): a new container
+    (even for the same spawner) never reuses an old entry. Entries expire
+    after `ttl` seconds, and are explicitly invalidated when the spawner
+    starts or stops a container, or when the connection to the mapped port
+    is refused.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._routes = {}
+
+    def get(self, spawner, proxy_port):
+        """
+        Return the cached host port for the proxy_port of the spawner
+        container, or None if not cached (or expired).
+        """
+        key = (spawner, spawner.container_id, proxy_port)
+        try:
+            host_port, expires = self._routes[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires < time.monotonic():
+            del self._routes[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return host_port
+
+    def set(self, spawner, proxy_port, host_port, ttl=None):
+        """
+        Cache the host port for the proxy_port of the spawner container.
+
+        If ttl is not specified, the default `ttl` of the cache is used;
+        a ttl of 0 disables caching.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if not ttl:
+            return
+        key = (spawner, spawner.container_id, proxy_port)
+        self._routes[key] = (host_port, time.monotonic() + ttl)
+
+    def invalidate(self, spawner=None, proxy_port=None):
+        """
+        Drop the cached routes of a spawner (all its ports if proxy_port
+        is None). If spawner is None, the whole cache is cleared.
+        """
+        if spawner is None:
+            self._routes.clear()
+            return
+        for key in list(self._routes):
+            if key[0] is spawner and proxy_port in (None, key[2]):
+                del self._routes[key]
+
+    def invalidate_container(self, container_id):
+        """Drop the cached routes of a container (of any spawner)."""
+        for key in list(self._routes):
+            if key[1] == container_id:
+                del self._routes[key]
+
+    def stats(self):
+        """Return a dictionary with the cache counters and size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._routes),
+        }
+
+
+# Process-wide cache shared by all the proxy handlers and spawners
+route_cache = RouteCache()
+stats_collector.register('route_cache', route_cache.stats,
+                         "Cache of the host ports of the containers")
+
+
+class PortMap(object):
+    """
+    The port mappings of the running containers (as in the
+    `NetworkSettings.Ports` of `inspect_container`), by container id.
+
+    It is kept up to date from the docker events by
+    `jhproxy.events.DockerEventWatcher`: the containers are added when they
+    start, and dropped as soon as they die, so the host ports of the
+    containers it knows are found without calling docker, and never stale.
+    The other containers are looked up with `route_cache` and docker.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._ports = {}
+
+    def __contains__(self, container_id):
+        return container_id in self._ports
+
+    def get(self, container_id):
+        """Return the port mappings of the container, or None if unknown."""
+        ports = self._ports.get(container_id)
+        if ports is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ports
+
+    def set(self, container_id, ports):
+        """Set the port mappings of a (running) container."""
+        self._ports[container_id] = ports
+
+    def drop(self, container_id):
+        """Forget a container (e.g. when it dies)."""
+        self._ports.pop(container_id, None)
+
+    def replace(self, ports_by_container):
+        """Replace all the containers, e.g. after listing them again."""
+        self._ports = dict(ports_by_container)
+
+    def clear(self):
+        """Forget all the containers."""
+        self._ports.clear()
+
+    def stats(self):
+        """Return a dictionary with the map counters and size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._ports),
+        }
+
+
+# Process-wide map, filled by the docker event watcher (if started)
+port_map = PortMap()
+stats_collector.register('port_map', port_map.stats,
+                         "Map of the host ports from the docker events")
+
+
+def find_host_port(port_mappings, proxy_port, host_ip):
+    """
+    Return the host port mapped on host_ip to the proxy_port, in the port
+    mappings of a container (None if not mapped).
+    """
+    port_routes = port_mappings.get('{}/tcp'.format(proxy_port)) or []
+    for port_route in port_routes:
+        if port_route.get('HostIp', '') == host_ip:
+            try:
+                return int(port_route.get('HostPort', ''))
+            except ValueError:
+                return None
+    return None
+
+
+@gen.coroutine
+def get_host_port(spawner, proxy_port, ttl=None, span=NO_SPAN):
+    """
+    Return the port on the host that maps to the proxy_port in the docker
+    container of the spawner (None if it is not mapped).
+
+    The mappings of the containers known from the docker events are in
+    `port_map`; the other ones are cached in `route_cache` (for ttl seconds,
+    by default the ttl of the cache), so docker is inspected only the first
+    time (or after the container changes). The inspection of the container
+    is traced as a child of the span.
+    """
+    # The containers known from the docker events
+    port_mappings = port_map.get(spawner.container_id)
+    if port_mappings is not None:
+        span.set_attribute('jhproxy.port_source', 'events')
+        raise gen.Return(find_host_port(port_mappings, proxy_port,
+                                        spawner.host_ip))
+
+    host_port = route_cache.get(spawner, proxy_port)
+    if host_port is not None:
+        span.set_attribute('jhproxy.port_source', 'cache')
+        raise gen.Return(host_port)
+
+    span.set_attribute('jhproxy.port_source', 'docker')
+    docker_span = span.child('docker.inspect_container', CLIENT,
+                             attributes={'container.id': spawner.container_id})
+    try:
+        inspection = yield spawner.docker("inspect_container",
+                                          spawner.container_id)
+    except Exception as exc:
+        docker_span.set_error(exc)
+        raise
+    finally:
+        docker_span.end()
+    port_mappings = inspection.get('NetworkSettings', {}).get('Ports', {})
+
+    app_log.debug("Port mappings:%s", port_mappings)
+
+    host_port = find_host_port(port_mappings, proxy_port, spawner.host_ip)
+    if host_port is not None:
+        route_cache.set(spawner, proxy_port, host_port, ttl=ttl)
+    raise gen.Return(host_port)
+
+
+# The modification time of a file not read yet
+_UNREAD = object()
+
+
+class PortPolicy(object):
+    """
+    The ports inside the containers that the multi-port handlers (e.g.
+    `jhproxy.MultiPortProxyHandler`) proxy, unless the spawner of the user
+    sets its own (`TokenizedDockerSpawner.proxy_allowed_ports`).
+
+    The ports are kept in a frozenset, so they are checked in constant time;
+    they can be changed at any time with `set`, or read from a JSON file
+    (a list of ports) with `watch`, which is read again whenever it is
+    modified (checked at most every reload_interval seconds).
+    """
+
+    def __init__(self, ports=(), reload_interval=5):
+        self.ports = frozenset(int(port) for port in ports)
+        self.reload_interval = reload_interval
+        self.path = None
+        self._mtime = _UNREAD
+        self._next_check = 0
+
+    def set(self, ports):
+        """Replace the allowed ports."""
+        self.ports = frozenset(int(port) for port in ports)
+
+    def watch(self, path):
+        """
+        Read the allowed ports from a JSON file, now and whenever it
+        changes.
+        """
+        self.path = path
+        self._mtime = _UNREAD
+        self._next_check = 0
+        self.reload()
+
+    def reload(self):
+        """
+        Read the file again if it was modified (on errors, the current ports
+        are kept).
+        """
+        self._next_check = time.monotonic() + self.reload_interval
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        # Unchanged (or still missing): the errors are reported only once
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path) as ports_file:
+                self.set(json.load(ports_file))
+        except (OSError, TypeError, ValueError) as exc:
+            app_log.error("Cannot read the allowed ports from %s: %s",
+                          self.path, exc)
+            return
+        app_log.info("Allowed proxy ports: %s", sorted(self.ports))
+
+    def allows(self, port):
+        """Return True if the port can be proxied."""
+        if self.path is not None and time.monotonic() >= self._next_check:
+            self.reload()
+        return port in self.ports
+
+
+# Process-wide policy of the multi-port handlers
+port_policy = PortPolicy()
+
+# The tokens of the spawners that do not hold any
+_ALLOW_ALL = TokenSet(mode='allow_all')
+
+
+class UserRoute(object):
+    """
+    What is needed to proxy the requests for a user: the spawner,
+    the IP of the docker host, the proxy tokens, the limits of the
+    requests, the ports that can be proxied and the coalescing of the
+    requests (None if not set in the spawner).
+    """
+    __slots__ = ('spawner', 'host_ip', 'proxy_tokens', 'rate_limit',
+                 'rate_burst', 'max_concurrent_requests', 'allowed_ports',
+                 'coalesce_requests')
+
+    def __init__(self, spawner):
+        self.spawner = spawner
+        self.update()
+
+    def update(self):
+        """
+        Copy again the host IP, the tokens, the limits, the ports and the
+        coalescing setting from the spawner.
+        """
+        self.host_ip = self.spawner.host_ip
+        # A standard DockerSpawner has no tokens: always allow the requests
+        self.proxy_tokens = getattr(self.spawner, 'proxy_tokens', _ALLOW_ALL)
+        self.rate_limit = getattr(self.spawner, 'proxy_rate_limit', None)
+        self.rate_burst = getattr(self.spawner, 'proxy_rate_burst', None)
+        self.max_concurrent_requests = getattr(
+            self.spawner, 'proxy_max_concurrent_requests', None)
+        allowed_ports = getattr(self.spawner, 'proxy_allowed_ports', None)
+        self.allowed_ports = (frozenset(allowed_ports)
+                              if allowed_ports is not None else None)
+        self.coalesce_requests = getattr(self.spawner,
+                                         'proxy_coalesce_requests', None)
+
+
+class UserRouteIndex(object):
+    """
+    In-memory index username -> UserRoute, so that the proxied requests
+    do not need to look up the user in the database.
+
+    Routes are added when a username is first resolved (from the database)
+    by the handlers, kept up to date by `TokenizedDockerSpawner` when it
+    starts and when its tokens change, and dropped when it stops. The
+    handlers also drop the routes whose user is not known by the hub
+    anymore (e.g. deleted).
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._routes = {}
+
+    def get(self, username):
+        """Return the UserRoute of the user, or None if not indexed."""
+        route = self._routes.get(username)
+        if route is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return route
+
+    def add(self, username, spawner):
+        """Index the spawner of the user, and return its UserRoute."""
+        route = UserRoute(spawner)
+        self._routes[username] = route
+        return route
+
+    def update(self, spawner):
+        """
+        Update the route of the user of the spawner, if the spawner is the
+        indexed one; drop the route if the indexed spawner is not one of
+        the user anymore (e.g. the user was deleted and created again), so
+        that the next request resolves it again.
+        """
+        user = getattr(spawner, 'user', None)
+        if user is None:
+            return
+        route = self._routes.get(user.name)
+        if route is None:
+            return
+        if route.spawner is spawner:
+            route.update()
+        elif getattr(route.spawner, 'user', None) is not user or not any(
+                other is route.spawner
+                for other in dict.values(getattr(user, 'spawners', {}))):
+            del self._routes[user.name]
+
+    def remove(self, username=None, spawner=None):
+        """
+        Drop the route of a user (all the routes if username is None); if a
+        spawner is passed, only if it is the indexed one.
+        """
+        if username is None:
+            self._routes.clear()
+            return
+        route = self._routes.get(username)
+        if route is not None and spawner in (None, route.spawner):
+            del self._routes[username]
+
+    def stats(self):
+        """Return a dictionary with the index counters and size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._routes),
+        }
+
+
+# Process-wide index shared by all the proxy handlers and spawners
+user_routes = UserRouteIndex()
+stats_collector.register('user_routes', user_routes.stats,
+                         "Index of the routes of the users")
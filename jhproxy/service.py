@@ -0,0 +1,415 @@
+"""
+Run the proxy as a JupyterHub service, in its own process(es), instead of
+mounting the handlers in the hub with `c.JupyterHub.extra_handlers`: the
+proxied traffic then does not share the event loop (and the CPU core) of
+the hub.
+
+The service finds the spawners through the Hub REST API: the state of the
+default server of each user holds the id of its docker container and the
+(hashed) proxy tokens. The routes are cached for `--route-ttl` seconds,
+and docker is inspected directly to find the host ports.
+
+A change of the tokens in the hub (e.g. with the `ProxyTokenAdminHandler`)
+is therefore seen by the service only once the cached routes expire; send
+a SIGHUP to the service (all its processes) to drop them right away.
+
+Register it in `jupyterhub_config.py` as a managed service, e.g.:
+
+```
+c.JupyterHub.services = [{
+    'name': 'jhproxy',
+    'url': 'http://127.0.0.1:10101',
+    'command': ['jhproxy-service', '--proxy-port', '5000'],
+}]
+c.JupyterHub.load_roles = [{
+    'name': 'jhproxy',
+    'scopes': ['read:users', 'read:servers', 'admin:server_state'],
+    'services': ['jhproxy'],
+}]
+```
+
+and the ports are proxied at `/services/jhproxy/<PORT>/<USER>/`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from jupyterhub.handlers.base import BaseHandler
+from jupyterhub.utils import url_path_join
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from tornado import gen, httpclient, httpserver, netutil, process, web
+from tornado.escape import url_escape
+from tornado.ioloop import IOLoop
+from tornado.log import app_log, enable_pretty_logging
+from tornado.web import stream_request_body
+from jhproxy.events import CONTAINER_LABEL, docker_events
+from jhproxy.proxy import (MultiPortProxyHandler,
+                           MultiPortStreamingProxyHandler, ProxyHandler,
+                           StreamingProxyHandler, _is_connection_refused)
+from jhproxy.routes import PortPolicy, UserRoute, route_cache
+from jhproxy.tokens import TokenSet
+from jhproxy.tracing import FileExporter, OTLPExporter, tracer
+import argparse
+import functools
+import json
+import logging
+import os
+import signal
+import time
+from urllib.parse import urlparse
+
+
+class ServiceSpawner(object):
+    """
+    The parts of a (Tokenized)DockerSpawner used by the proxy handlers,
+    rebuilt from the state of the spawner returned by the Hub REST API.
+    """
+    # Shared by all the instances, as in DockerSpawner
+    _client = None
+    _executor = None
+
+    def __init__(self, username, host_ip):
+        self.username = username
+        self.host_ip = host_ip
+        self.container_id = None
+        self.proxy_tokens = TokenSet()
+
+    def load_state(self, state):
+        """Update the container and the tokens from the spawner state."""
+        container_id = state.get('object_id') or state.get('container_id')
+        if container_id != self.container_id:
+            route_cache.invalidate(self)
+            self.container_id = container_id
+        if 'proxy_tokens' in state:
+            self.proxy_tokens.load_state(state['proxy_tokens'])
+        elif 'proxy_token' in state:
+            # State saved by a previous version, with the token itself
+            self.proxy_tokens.set_default_token(state['proxy_token'])
+        else:
+            # A standard DockerSpawner: always allow the requests
+            self.proxy_tokens.clear('allow_all')
+
+    @classmethod
+    def get_client(cls):
+        """Return the docker client, configured from the environment."""
+        if cls._client is None:
+            import docker
+            from docker.utils import kwargs_from_env
+            cls._client = docker.APIClient(version='auto',
+                                           **kwargs_from_env())
+        return cls._client
+
+    @property
+    def client(self):
+        """The docker client, configured from the environment."""
+        return self.get_client()
+
+    def _docker(self, method, *args, **kwargs):
+        return getattr(self.client, method)(*args, **kwargs)
+
+    def docker(self, method, *args, **kwargs):
+        """Call a method of the docker client in a background thread."""
+        cls = self.__class__
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(4)
+        return IOLoop.current().run_in_executor(
+            cls._executor,
+            functools.partial(self._docker, method, *args, **kwargs))
+
+
+class HubRoutes(object):
+    """
+    The routes of the users, built from the Hub REST API and cached for
+    ttl seconds (including the users without a running server).
+
+    Concurrent lookups for the same user share the same request to the
+    hub; if the hub cannot be reached once the route has expired, the
+    requests are refused (503), rather than authorized with tokens that
+    might have been revoked meanwhile.
+    """
+
+    def __init__(self, api_url, api_token, host_ip, ttl=30,
+                 max_entries=10000):
+        self.api_url = api_url
+        self.api_token = api_token
+        self.host_ip = host_ip
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # username -> (UserRoute or None, expires)
+        self._routes = {}
+        # username -> Future of the pending request to the hub
+        self._pending = {}
+        # username -> ServiceSpawner, kept so that the routes cached in
+        # `route_cache` stay valid across refreshes
+        self._spawners = {}
+
+    @gen.coroutine
+    def get(self, username):
+        """Return the UserRoute of the user, or None if not available."""
+        entry = self._routes.get(username)
+        if entry is not None and entry[1] > time.monotonic():
+            raise gen.Return(entry[0])
+        future = self._pending.get(username)
+        if future is None:
+            future = self._pending[username] = self._fetch(username)
+            future.add_done_callback(
+                lambda _: self._pending.pop(username, None))
+        route = yield future
+        raise gen.Return(route)
+
+    @gen.coroutine
+    def _fetch(self, username):
+        """Build the route of the user from the Hub REST API."""
+        try:
+            response = yield httpclient.AsyncHTTPClient().fetch(
+                url_path_join(self.api_url, 'users', url_escape(username)),
+                headers={'Authorization': 'token {}'.format(self.api_token)},
+                raise_error=False)
+            error = response.error
+        except Exception as exc: # pylint: disable=broad-except
+            # e.g. the hub is not reachable
+            response = None
+            error = exc
+        if response is not None and response.code == 404:
+            route = None
+        elif error:
+            raise web.HTTPError(
+                503, "Cannot get the user %s from the hub: %s", username,
+                error)
+        else:
+            route = self._get_route(
+                username, json.loads(response.body.decode('utf-8')))
+
+        if len(self._routes) >= self.max_entries:
+            self._prune()
+        self._routes[username] = (route, time.monotonic() + self.ttl)
+        raise gen.Return(route)
+
+    def _get_route(self, username, user_model):
+        """Return the route for the model of a user, or None."""
+        server = user_model.get('servers', {}).get('')
+        if server is None:
+            # No running server
+            self._drop_spawner(username)
+            return None
+        if 'state' not in server:
+            app_log.error(
+                "The state of the server of %s is not available: the "
+                "service needs the 'admin:server_state' scope", username)
+            return None
+        spawner = self._spawners.get(username)
+        if spawner is None:
+            spawner = self._spawners[username] = ServiceSpawner(
+                username, self.host_ip)
+        spawner.load_state(server['state'] or {})
+        return UserRoute(spawner)
+
+    def _prune(self):
+        """Drop the expired routes."""
+        now = time.monotonic()
+        for username, (_, expires) in list(self._routes.items()):
+            if expires <= now:
+                del self._routes[username]
+                if username not in self._pending:
+                    self._drop_spawner(username)
+
+    def _drop_spawner(self, username):
+        spawner = self._spawners.pop(username, None)
+        if spawner is not None:
+            route_cache.invalidate(spawner)
+
+    def invalidate(self, username=None):
+        """Drop the cached route of a user (all of them if None)."""
+        if username is None:
+            self._routes.clear()
+        else:
+            self._routes.pop(username, None)
+
+
+class _HublessHandler(BaseHandler):
+    """
+    Replace the methods of the JupyterHub BaseHandler that need to run
+    inside the hub (database, cookies, templates) with the tornado ones.
+
+    It goes after the proxy handlers in the bases of the service handlers,
+    so that it comes before BaseHandler in their method resolution order.
+    """
+
+    def prepare(self):
+        pass
+
+    def finish(self, *args, **kwargs):
+        return web.RequestHandler.finish(self, *args, **kwargs)
+
+    def set_default_headers(self):
+        web.RequestHandler.set_default_headers(self)
+
+    def write_error(self, status_code, **kwargs):
+        web.RequestHandler.write_error(self, status_code, **kwargs)
+
+
+class _ServiceRoutesMixin(object):
+    """Find the routes of the users with `HubRoutes`."""
+
+    def initialize(self, hub_routes, **kwargs): # pylint: disable=arguments-differ
+        super().initialize(**kwargs)
+        self.hub_routes = hub_routes
+
+    @gen.coroutine
+    def get_user_route(self, username):
+        route = yield self.hub_routes.get(username)
+        raise gen.Return(route)
+
+    def check_upstream_error(self, spawner, error):
+        super().check_upstream_error(spawner, error)
+        # The container might have been restarted: ask the hub again
+        if _is_connection_refused(error):
+            self.hub_routes.invalidate(spawner.username)
+
+
+class ServiceProxyHandler(_ServiceRoutesMixin, ProxyHandler, _HublessHandler):
+    """The ProxyHandler of the service."""
+
+
+@stream_request_body
+class ServiceStreamingProxyHandler(_ServiceRoutesMixin, StreamingProxyHandler,
+                                   _HublessHandler):
+    """The StreamingProxyHandler of the service."""
+
+
+class ServiceMultiPortProxyHandler(_ServiceRoutesMixin, MultiPortProxyHandler,
+                                   _HublessHandler):
+    """The MultiPortProxyHandler of the service."""
+
+
+@stream_request_body
+class ServiceMultiPortStreamingProxyHandler(_ServiceRoutesMixin,
+                                            MultiPortStreamingProxyHandler,
+                                            _HublessHandler):
+    """The MultiPortStreamingProxyHandler of the service."""
+
+
+class MetricsHandler(web.RequestHandler):
+    """Export the Prometheus metrics of this process."""
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+
+def main(argv=None):
+    """Run the jhproxy service."""
+    service_url = urlparse(os.environ.get('JUPYTERHUB_SERVICE_URL', ''))
+    parser = argparse.ArgumentParser(
+        description="Proxy the ports of the DockerSpawner containers, as "
+        "a JupyterHub service")
+    parser.add_argument('--ip', default=service_url.hostname or '127.0.0.1',
+                        help="IP to listen on (default: from "
+                        "JUPYTERHUB_SERVICE_URL)")
+    parser.add_argument('--port', type=int,
+                        default=service_url.port or 10101,
+                        help="port to listen on (default: from "
+                        "JUPYTERHUB_SERVICE_URL)")
+    parser.add_argument('--prefix',
+                        default=os.environ.get('JUPYTERHUB_SERVICE_PREFIX',
+                                               '/'),
+                        help="URL prefix of the service")
+    parser.add_argument('--proxy-port', type=int, action='append',
+                        default=[], dest='proxy_ports',
+                        help="port inside the containers to proxy, at "
+                        "<prefix>/<port>/<user>/ (repeatable)")
+    parser.add_argument('--allowed-ports-file',
+                        help="JSON file with the list of the ports to proxy "
+                        "(replacing the --proxy-port ones), read again when "
+                        "it changes")
+    parser.add_argument('--host-ip', default='127.0.0.1',
+                        help="the DockerSpawner.host_ip of the hub")
+    parser.add_argument('--route-ttl', type=float, default=30,
+                        help="seconds to cache the routes from the hub")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="number of processes (0: one per CPU)")
+    parser.add_argument('--streaming', action='store_true',
+                        help="stream the request bodies to the upstreams "
+                        "(StreamingProxyHandler)")
+    parser.add_argument('--handler-options', type=json.loads, default={},
+                        help="JSON object with other options of the "
+                        "handlers, e.g. '{\"rate_limit\": 10}'")
+    parser.add_argument('--watch-docker-events', action='store_true',
+                        help="keep the port mappings of the containers up "
+                        "to date from the docker events")
+    parser.add_argument('--container-label', default='{}=true'.format(
+                            CONTAINER_LABEL),
+                        help="label (<name>=<value>) of the containers "
+                        "whose docker events are watched, as in the "
+                        "TokenizedDockerSpawner.proxy_container_labels of "
+                        "the hub")
+    parser.add_argument('--trace-file',
+                        help="file to append the spans of the traced "
+                        "requests to (one JSON object per line)")
+    parser.add_argument('--otlp-endpoint',
+                        help="OTLP/HTTP endpoint to send the spans to, e.g. "
+                        "http://collector:4318/v1/traces")
+    parser.add_argument('--trace-sample-rate', type=float, default=0.01,
+                        help="fraction of the requests to trace (besides "
+                        "the ones traced by the caller)")
+    parser.add_argument('--log-level', default='INFO',
+                        help="logging level")
+    options = parser.parse_args(argv)
+    if not options.proxy_ports and not options.allowed_ports_file:
+        parser.error("at least a --proxy-port or an --allowed-ports-file "
+                     "is needed")
+    if options.trace_file and options.otlp_endpoint:
+        parser.error("--trace-file and --otlp-endpoint are exclusive")
+
+    api_url = os.environ.get('JUPYTERHUB_API_URL')
+    api_token = os.environ.get('JUPYTERHUB_API_TOKEN')
+    if not api_url or not api_token:
+        parser.error("JUPYTERHUB_API_URL and JUPYTERHUB_API_TOKEN must be "
+                     "set (they are when run as a JupyterHub managed "
+                     "service)")
+
+    app_log.setLevel(getattr(logging, options.log_level.upper()))
+    enable_pretty_logging()
+
+    sockets = netutil.bind_sockets(options.port, options.ip)
+    if options.processes != 1:
+        process.fork_processes(options.processes)
+
+    if options.watch_docker_events:
+        label, _, value = options.container_label.partition('=')
+        docker_events.start(ServiceSpawner.get_client(),
+                            labels={label: value})
+    if options.trace_file:
+        tracer.configure(sample_rate=options.trace_sample_rate,
+                         exporter=FileExporter(options.trace_file))
+    elif options.otlp_endpoint:
+        tracer.configure(sample_rate=options.trace_sample_rate,
+                         exporter=OTLPExporter(options.otlp_endpoint))
+    hub_routes = HubRoutes(api_url, api_token, options.host_ip,
+                           ttl=options.route_ttl)
+    port_policy = PortPolicy(options.proxy_ports)
+    if options.allowed_ports_file:
+        port_policy.watch(options.allowed_ports_file)
+    handler_class = (ServiceMultiPortStreamingProxyHandler
+                     if options.streaming else ServiceMultiPortProxyHandler)
+    kwargs = dict(options.handler_options)
+    kwargs.update(port_policy=port_policy, hub_routes=hub_routes)
+    handlers = [
+        (url_path_join(options.prefix, 'metrics'), MetricsHandler),
+        (url_path_join(options.prefix, r'(\d+)/([^/]+)(/.*)'),
+         handler_class, kwargs),
+    ]
+
+    def invalidate_routes():
+        app_log.info("SIGHUP received: dropping the cached routes")
+        hub_routes.invalidate()
+
+    IOLoop.current().asyncio_loop.add_signal_handler(signal.SIGHUP,
+                                                     invalidate_routes)
+
+    server = httpserver.HTTPServer(web.Application(handlers))
+    server.add_sockets(sockets)
+    app_log.info("jhproxy service listening on %s:%s%s", options.ip,
+                 options.port, options.prefix)
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
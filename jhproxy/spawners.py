@@ -1,7 +1,16 @@
-from traitlets import Unicode
+from tornado import gen
+from tornado.ioloop import IOLoop
+from traitlets import (Bool, Dict, Float, Integer, List, TraitError,
+                       Unicode, observe, validate)
+from jhproxy.events import CONTAINER_LABEL, docker_events
+from jhproxy.health import upstream_health
+from jhproxy.hubproxy import DEFAULT_ROUTE_TEMPLATE, get_route_path
+from jhproxy.routes import get_host_port, port_map, route_cache, user_routes
+from jhproxy.tokens import (DEFAULT_TOKEN, PREVIOUS_TOKEN, TokenSet,
+                            generate_token)
+from jhproxy.warmup import upstream_warmup
 import dockerspawner
-import random
-import string
+import time
 
 
 class TokenizedDockerSpawner(dockerspawner.DockerSpawner):
@@ -47,51 +56,492 @@ class TokenizedDockerSpawner(dockerspawner.DockerSpawner):
           value of `TokenizedDockerSpahwer.default_startup_behavior`.
         """)
 
+    token_rotation_grace_period = Float(
+        0,
+        config=True,
+        help="""Seconds during which the previous token is still accepted,
+        after the token is regenerated.
+
+        With a grace period, the clients can switch to the new token
+        gradually, instead of all being rejected (and retrying) at the same
+        time. With 0 (default), the previous token is revoked immediately.
+        """)
+
+    max_proxy_tokens = Integer(
+        10,
+        config=True,
+        help="""The maximum number of named tokens of each spawner
+        (including the default one).
+        """)
+
+    proxy_rate_limit = Float(
+        None,
+        allow_none=True,
+        config=True,
+        help="""Requests per second allowed to the proxied ports, for
+        each port and token (or for all the clients without a token, if the
+        proxy allows all the requests).
+
+        If None (default), the `rate_limit` of the handler is used. It must
+        be positive: to block the requests, disable the proxy token instead.
+        """)
+
+    proxy_rate_burst = Integer(
+        None,
+        allow_none=True,
+        min=1,
+        config=True,
+        help="""Requests allowed in a burst, above `proxy_rate_limit`
+        (if None, max(1, proxy_rate_limit)).
+        """)
+
+    proxy_max_concurrent_requests = Integer(
+        None,
+        allow_none=True,
+        config=True,
+        help="""Requests to the proxied ports handled at the same time,
+        for each port and token (websockets excluded).
+
+        If None (default), the `max_concurrent_requests` of the handler
+        is used.
+        """)
+
+    proxy_allowed_ports = List(
+        Integer(),
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help="""Ports inside the container that the multi-port handlers
+        (e.g. `jhproxy.MultiPortProxyHandler`) proxy; the handlers with a
+        fixed `proxy_port` proxy it only if it is in the list.
+
+        If None (default), the `jhproxy.routes.port_policy` applies.
+        It can be changed while the server is running.
+        """)
+
+    proxy_coalesce_requests = Bool(
+        None,
+        allow_none=True,
+        config=True,
+        help="""Share the response of a GET request to the proxied ports
+        with the identical requests proxied at the same time (see
+        `jhproxy.coalesce`). Set it to False for the services whose responses
+        must never be shared, even within a token.
+
+        If None (default), the `coalesce_requests` of the handler is used.
+        """)
+
+    proxy_route_ports = List(
+        Integer(),
+        config=True,
+        help="""Ports inside the container for which a route is added to
+        the proxy of JupyterHub when the container starts (and removed when
+        it stops), at `proxy_route_template`.
+
+        The requests then go from the proxy of JupyterHub straight to the
+        container, without passing through the hub: the hub must use
+        `jhproxy.hubproxy.ConfigurableHTTPProxy` (or another proxy class
+        with `jhproxy.hubproxy.PushedRoutesMixin`).
+
+        The proxy of JupyterHub does not check the proxy tokens, so the
+        routes are only added while all the requests are allowed (the
+        'allow_all' mode), and removed as soon as the tokens change
+        otherwise; unless `proxy_route_forward_auth` is set.
+        """)
+
+    proxy_route_forward_auth = Bool(
+        False,
+        config=True,
+        help="""Set it to True if the proxy of JupyterHub asks the
+        `jhproxy.ProxyAuthHandler` before forwarding each request (e.g.
+        nginx `auth_request`, Traefik `ForwardAuth`): the routes of
+        `proxy_route_ports` are then added whatever the tokens, as the
+        tokens are checked by the proxy.
+        """)
+
+    proxy_route_template = Unicode(
+        DEFAULT_ROUTE_TEMPLATE,
+        config=True,
+        help="""Path (under the base URL of the hub) of the routes of
+        `proxy_route_ports`, with the `{port}` and `{username}` fields.
+        """)
+
+    proxy_warmup_ports = List(
+        Integer(),
+        config=True,
+        help="""Ports inside the container that are warmed up when the
+        container starts (see `jhproxy.warmup`): their host ports are
+        resolved right away, and they are polled in the background until
+        the services answer.
+
+        Meanwhile, the proxy handlers hold the requests to these ports
+        (for at most their `warmup_wait` seconds), instead of failing them
+        while the services are still booting.
+        """)
+
+    proxy_warmup_timeout = Float(
+        60,
+        config=True,
+        help="""Seconds after which the warm-up of a port gives up (the
+        requests are then proxied as usual).
+        """)
+
+    proxy_warmup_interval = Float(
+        0.5,
+        config=True,
+        help="""Seconds between two polls of a port being warmed up.""")
+
+    proxy_warmup_path = Unicode(
+        '/',
+        config=True,
+        help="""Path polled on the ports being warmed up: a port is ready
+        when it answers with a status below 500.
+        """)
+
+    watch_docker_events = Bool(
+        True,
+        config=True,
+        help="""Keep the port mappings of the containers up to date from the
+        docker events (see `jhproxy.events`), instead of inspecting the
+        containers when their ports are first proxied.
+
+        The events are read by a background thread of the hub, started when
+        a server is started or polled. Only the containers with the
+        `proxy_container_labels` are tracked; the other ones (e.g. started
+        before the labels were added) are inspected.
+        """)
+
+    proxy_container_labels = Dict(
+        {CONTAINER_LABEL: 'true'},
+        config=True,
+        help="""Labels added to the containers, with which the docker events
+        of the containers of the spawners are told apart from the ones of
+        the other containers of the docker host.
+
+        Give them a different value in each hub sharing a docker host.
+        """)
+
+    _proxy_tokens = None
+
+    @validate('proxy_rate_limit')
+    def _validate_proxy_rate_limit(self, proposal):
+        rate_limit = proposal['value']
+        if rate_limit is not None and rate_limit <= 0:
+            raise TraitError("proxy_rate_limit must be positive, got {}"
+                             .format(rate_limit))
+        return rate_limit
+
+    @observe('proxy_allowed_ports')
+    def _proxy_allowed_ports_changed(self, change): # pylint: disable=unused-argument
+        user_routes.update(self)
+
+    @gen.coroutine
+    def start(self, *args, **kwargs):
+        """
+        Start the container; the host ports are (re)assigned by docker,
+        so the cached port mappings of this spawner are dropped (and its
+        route in `jhproxy.routes.user_routes` is updated), as well as the
+        health of its upstreams (`jhproxy.health.upstream_health`).
+
+        The warm-up of `proxy_warmup_ports` is then started, and the routes
+        of `proxy_route_ports` are added to the proxy of JupyterHub.
+        """
+        self._watch_docker_events()
+        route_cache.invalidate(self)
+        port_map.drop(self.container_id)
+        upstream_health.reset_container(self.container_id)
+        upstream_warmup.reset_container(self.container_id)
+        result = yield super().start(*args, **kwargs)
+        route_cache.invalidate(self)
+        port_map.drop(self.container_id)
+        upstream_health.reset_container(self.container_id)
+        user_routes.update(self)
+        if self.proxy_warmup_ports:
+            upstream_warmup.start(self, self.proxy_warmup_ports,
+                                  timeout=self.proxy_warmup_timeout,
+                                  interval=self.proxy_warmup_interval,
+                                  path=self.proxy_warmup_path)
+        yield self.add_proxy_routes()
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def stop(self, *args, **kwargs):
+        """
+        Stop the container and drop the cached port mappings of this spawner
+        (and its route in `jhproxy.routes.user_routes`), after
+        removing its routes from the proxy of JupyterHub and stopping the
+        warm-up of its ports.
+        """
+        upstream_warmup.reset_container(self.container_id)
+        yield self.delete_proxy_routes()
+        try:
+            yield super().stop(*args, **kwargs)
+        finally:
+            route_cache.invalidate(self)
+            user_routes.remove(self.user.name, self)
+
+    @gen.coroutine
+    def poll(self):
+        """
+        Check if the container is running (and start watching the docker
+        events, e.g. for the servers still running after a restart of the
+        hub).
+        """
+        self._watch_docker_events()
+        status = yield super().poll()
+        raise gen.Return(status)
+
+    def docker(self, method, *args, **kwargs):
+        """
+        Call a method of the docker client, in a thread; the containers are
+        created with the `proxy_container_labels`.
+        """
+        if method == 'create_container' and self.proxy_container_labels:
+            labels = kwargs.get('labels') or {}
+            if isinstance(labels, (list, tuple)):
+                # Labels without values
+                labels = {label: '' for label in labels}
+            kwargs['labels'] = dict(labels, **self.proxy_container_labels)
+        return super().docker(method, *args, **kwargs)
+
+    def _watch_docker_events(self):
+        if not self.watch_docker_events or docker_events.running:
+            return
+        try:
+            docker_events.start(self.client,
+                                labels=self.proxy_container_labels)
+        except Exception: # pylint: disable=broad-except
+            self.log.exception("Cannot watch the docker events")
+
+    def _get_hub_proxy(self):
+        """Return the `jupyterhub.proxy.Proxy` of the hub (or None)."""
+        settings = getattr(self.user, 'settings', None) or {}
+        return settings.get('proxy')
+
+    def get_proxy_routespec(self, proxy_port):
+        """Return the routespec of a port of `proxy_route_ports`."""
+        settings = getattr(self.user, 'settings', None) or {}
+        return get_route_path(self.proxy_route_template,
+                              settings.get('base_url', '/'), proxy_port,
+                              self.user.name)
+
+    @gen.coroutine
+    def add_proxy_routes(self, proxy_ports=None):
+        """
+        Add the routes of the ports (by default, `proxy_route_ports`) to the
+        proxy of JupyterHub, pointing to the host ports mapped to them.
+
+        The errors are logged: the ports can still be reached through the
+        `ProxyHandler`s of the hub.
+        """
+        if proxy_ports is None:
+            proxy_ports = self.proxy_route_ports
+        hub_proxy = self._get_hub_proxy()
+        if not proxy_ports or hub_proxy is None:
+            return
+        if not self.can_push_proxy_routes():
+            self.log.info(
+                "No route added for %s: the proxy of JupyterHub does not "
+                "check the proxy tokens", self.user.name)
+            return
+        for proxy_port in proxy_ports:
+            routespec = self.get_proxy_routespec(proxy_port)
+            try:
+                host_port = yield get_host_port(self, proxy_port)
+                if host_port is None:
+                    self.log.warning(
+                        "Port %s of the container of %s is not mapped, "
+                        "no route added", proxy_port, self.user.name)
+                    continue
+                yield hub_proxy.add_route(
+                    routespec, 'http://{}:{}'.format(self.host_ip, host_port),
+                    {'jhproxy': self.user.name, 'proxy_port': proxy_port})
+            except Exception: # pylint: disable=broad-except
+                self.log.exception("Failed to add the route %s", routespec)
+
+    def can_push_proxy_routes(self):
+        """
+        Return True if the routes of `proxy_route_ports` can be added to the
+        proxy of JupyterHub: only if all the requests are allowed, unless
+        the proxy checks the tokens (`proxy_route_forward_auth`).
+        """
+        return (self.proxy_route_forward_auth or
+                self.proxy_tokens.mode == 'allow_all')
+
+    def _proxy_tokens_changed(self, previous_mode):
+        """
+        Update the route of this spawner in `jhproxy.routes.user_routes`
+        after a change of the tokens, and add (or remove) the routes of
+        `proxy_route_ports` if the change allows (or forbids) them.
+        """
+        user_routes.update(self)
+        if not self.proxy_route_ports or self.proxy_route_forward_auth:
+            return
+        allowed = self.can_push_proxy_routes()
+        if allowed == (previous_mode == 'allow_all'):
+            return
+        if not allowed:
+            IOLoop.current().spawn_callback(self.delete_proxy_routes)
+        elif self.ready:
+            IOLoop.current().spawn_callback(self.add_proxy_routes)
+
+    @gen.coroutine
+    def delete_proxy_routes(self):
+        """
+        Remove the routes of `proxy_route_ports` from the proxy of
+        JupyterHub.
+        """
+        hub_proxy = self._get_hub_proxy()
+        if not self.proxy_route_ports or hub_proxy is None:
+            return
+        for proxy_port in self.proxy_route_ports:
+            routespec = self.get_proxy_routespec(proxy_port)
+            try:
+                yield hub_proxy.delete_route(routespec)
+            except Exception: # pylint: disable=broad-except
+                self.log.exception("Failed to delete the route %s", routespec)
+
+    @property
+    def proxy_tokens(self):
+        """
+        The `jhproxy.tokens.TokenSet` with the tokens of this spawner
+        (disabled until the state is loaded).
+        """
+        if self._proxy_tokens is None:
+            self._proxy_tokens = TokenSet()
+        return self._proxy_tokens
+
     @property
     def proxy_token(self):
         """
-        Return the current token.
+        Return the current token: `None` if disabled, `""` if all the
+        requests are allowed, otherwise the default token.
+
+        Raise a LookupError if the default token is not known: only its
+        digest is stored, so it can be shown only by the hub process that
+        generated it (or if there is no default token, but only named ones).
         """
-        return self._proxy_token
+        tokens = self.proxy_tokens
+        if tokens.mode == 'disabled':
+            return None
+        if tokens.mode == 'allow_all':
+            return ""
+        token = tokens.get_token(DEFAULT_TOKEN)
+        if token is None:
+            if DEFAULT_TOKEN not in tokens:
+                raise LookupError(
+                    "There is no default proxy token, only named ones "
+                    "(list them with ?list)")
+            raise LookupError(
+                "The proxy token was generated before the hub was restarted "
+                "and only its hash is stored, so it cannot be shown: "
+                "generate a new one")
+        return token
 
     def regenerate_random_token(self, length=40):
-        """Replace the token with a new, randomly generated one"""
-        self._proxy_token = ''.join(
-            random.choice(string.ascii_lowercase + string.digits)
-            for _ in range(length))
+        """
+        Replace the default token with a new, randomly generated one.
+
+        The previous token is still accepted for
+        `token_rotation_grace_period` seconds (as are the ones replaced by
+        the other rotations within the grace period, each until its own
+        expiry).
+        """
+        tokens = self.proxy_tokens
+        previous_mode = tokens.mode
+        if self.token_rotation_grace_period > 0:
+            tokens.prune()
+            tokens.rename(DEFAULT_TOKEN, tokens.get_free_name(PREVIOUS_TOKEN),
+                          expires=time.time() +
+                          self.token_rotation_grace_period)
+        tokens.add(DEFAULT_TOKEN, generate_token(length))
+        self._proxy_tokens_changed(previous_mode)
 
     def set_token(self, new_token):
-        """Set a token as chosen by the user"""
-        self._proxy_token = new_token
+        """
+        Set a token as chosen by the user (`None` to disable the proxy,
+        `""` to allow all the requests). All the other tokens are removed.
+        """
+        previous_mode = self.proxy_tokens.mode
+        self.proxy_tokens.set_default_token(new_token)
+        self._proxy_tokens_changed(previous_mode)
+
+    def add_named_token(self, name, expires_in=None, token=None):
+        """
+        Add a named token, valid for expires_in seconds (forever if None),
+        in addition to the other tokens. If token is None, a random one is
+        generated.
+
+        Return the token. Raise a ValueError if there are already
+        `max_proxy_tokens` tokens.
+        """
+        tokens = self.proxy_tokens
+        previous_mode = tokens.mode
+        tokens.prune()
+        if name not in tokens and len(tokens) >= self.max_proxy_tokens:
+            raise ValueError("Too many proxy tokens (the maximum is {})"
+                             .format(self.max_proxy_tokens))
+        expires = None
+        if expires_in is not None:
+            expires = time.time() + expires_in
+        token = tokens.add(name, token, expires=expires)
+        self._proxy_tokens_changed(previous_mode)
+        return token
+
+    def remove_named_token(self, name):
+        """Revoke the token with the given name."""
+        previous_mode = self.proxy_tokens.mode
+        self.proxy_tokens.remove(name)
+        self._proxy_tokens_changed(previous_mode)
+
+    def save_proxy_state(self, commit=True):
+        """
+        Save the state of the spawner, with its proxy tokens, to the
+        database (committing it, unless commit is False).
+
+        JupyterHub only saves the state when the server starts or stops:
+        the handlers that change the tokens save it right away, otherwise a
+        revoked token would be valid again after a restart of the hub.
+        """
+        if self.orm_spawner is None:
+            return
+        self.orm_spawner.state = self.get_state()
+        if commit:
+            self.db.commit()
 
     def get_state(self):
         """
-        Get the current state; store the proxy token in the DB.
+        Get the current state; store the mode and the digests of the proxy
+        tokens in the DB (never the tokens themselves).
 
         It is stored at shutdown
         """
         state = super().get_state()
-        state['proxy_token'] = self._proxy_token
+        state['proxy_tokens'] = self.proxy_tokens.get_state()
         return state
 
     def load_state(self, state):
         """
-        Load state from the database, including the proxy token from the DB
+        Load state from the database, including the proxy tokens from the DB
         """
         super().load_state(state)
-        if 'proxy_token' in state:
-            self._proxy_token = state['proxy_token']
+        if 'proxy_tokens' in state:
+            self.proxy_tokens.load_state(state['proxy_tokens'])
+        elif 'proxy_token' in state:
+            # State saved by a previous version, with the token itself
+            self.set_token(state['proxy_token'])
         else:
             if self.default_startup_behavior == "disabled":
-                self._proxy_token = None
+                self.set_token(None)
             elif self.default_startup_behavior == "allow_all":
-                self._proxy_token = ""
+                self.set_token("")
             elif self.default_startup_behavior == "random":
                 self.regenerate_random_token()
             else:
                 raise RuntimeError(
                     "The 'default_startup_behavior' was set to an unknown value '{}"
                     .format(self.default_startup_behavior))
+        user_routes.update(self)
 
     def clear_state(self):
         """
@@ -101,7 +551,7 @@ class TokenizedDockerSpawner(dockerspawner.DockerSpawner):
         if self.shutdown_behavior == "pass": # pylint: disable=no-else-return
             return
         elif self.shutdown_behavior == "disable":
-            self._proxy_token = None
+            self.set_token(None)
         else:
             raise RuntimeError(
                 "The 'shutdown_behavior' was set to an unknown value '{}".
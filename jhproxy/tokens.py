@@ -0,0 +1,197 @@
+import hashlib
+import random
+import string
+import time
+
+# Name of the token managed with `TokenizedDockerSpawner.set_token` and
+# `regenerate_random_token`, and prefix of the names of the previous ones
+# during their rotation grace period (one per rotation, e.g.
+# 'default-previous-1')
+DEFAULT_TOKEN = 'default'
+PREVIOUS_TOKEN = 'default-previous'
+
+_random = random.SystemRandom()
+
+
+def hash_token(token):
+    """Return the digest under which a token is stored."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def generate_token(length=40):
+    """Return a new random token."""
+    return ''.join(
+        _random.choice(string.ascii_lowercase + string.digits)
+        for _ in range(length))
+
+
+class TokenSet(object):
+    """
+    The proxy tokens of a spawner.
+
+    The mode decides how the requests are authorized:
+    * 'disabled': never (the proxy is disabled);
+    * 'allow_all': always, without checking any token;
+    * 'tokens': only with one of the tokens of the set.
+
+    Each token has a name and an optional expiry (a unix timestamp). Only
+    the digests of the tokens are stored: the tokens themselves are kept
+    in memory only for the ones created by this process, to be shown to the
+    user, and are never saved.
+    The tokens are verified by looking up the digest of the token passed
+    by the client, so the time taken does not depend on the token, nor on
+    the number of tokens in the set.
+    """
+
+    def __init__(self, mode='disabled'):
+        self.mode = mode
+        # name -> (digest, expires)
+        self._tokens = {}
+        # digest -> name
+        self._digests = {}
+        # name -> token, for the tokens created by this process
+        self._plain_tokens = {}
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, name):
+        return name in self._tokens
+
+    def add(self, name, token=None, expires=None):
+        """
+        Add (or replace) the token with the given name, and switch to the
+        'tokens' mode. If token is None, a random one is generated.
+
+        Return the token.
+        """
+        if token is None:
+            token = generate_token()
+        self.remove(name)
+        digest = hash_token(token)
+        # The same token under another name is replaced
+        self.remove(self._digests.get(digest))
+        self._tokens[name] = (digest, expires)
+        self._digests[digest] = name
+        self._plain_tokens[name] = token
+        self.mode = 'tokens'
+        return token
+
+    def rename(self, name, new_name, expires=None):
+        """
+        Rename a token (replacing the one called new_name), optionally
+        setting its expiry. Nothing is done if there is no such token.
+        """
+        if name not in self._tokens:
+            return
+        digest, old_expires = self._tokens.pop(name)
+        if expires is None:
+            expires = old_expires
+        plain_token = self._plain_tokens.pop(name, None)
+        self.remove(new_name)
+        self._tokens[new_name] = (digest, expires)
+        self._digests[digest] = new_name
+        if plain_token is not None:
+            self._plain_tokens[new_name] = plain_token
+
+    def get_free_name(self, prefix):
+        """Return the first name '<prefix>-<n>' not used by a token."""
+        number = 1
+        while '{}-{}'.format(prefix, number) in self._tokens:
+            number += 1
+        return '{}-{}'.format(prefix, number)
+
+    def remove(self, name):
+        """Remove the token with the given name, if any."""
+        try:
+            digest, _ = self._tokens.pop(name)
+        except KeyError:
+            return
+        del self._digests[digest]
+        self._plain_tokens.pop(name, None)
+
+    def clear(self, mode):
+        """Remove all the tokens, and switch to the given mode."""
+        self._tokens.clear()
+        self._digests.clear()
+        self._plain_tokens.clear()
+        self.mode = mode
+
+    def set_default_token(self, token):
+        """
+        Replace all the tokens with a default one; `None` switches to the
+        'disabled' mode, `""` to the 'allow_all' mode.
+        """
+        if token is None:
+            self.clear('disabled')
+        elif token == "":
+            self.clear('allow_all')
+        else:
+            self.clear('tokens')
+            self.add(DEFAULT_TOKEN, token)
+
+    def get_token(self, name):
+        """
+        Return the token with the given name, or None if it was not
+        created by this process (only its digest is known) or does not
+        exist.
+        """
+        return self._plain_tokens.get(name)
+
+    def verify(self, token):
+        """
+        Return the digest of the token if it is one of the (non-expired)
+        tokens of the set, otherwise None.
+        """
+        digest = hash_token(token)
+        name = self._digests.get(digest)
+        if name is None:
+            return None
+        expires = self._tokens[name][1]
+        if expires is not None and expires <= time.time():
+            self.remove(name)
+            return None
+        return digest
+
+    def prune(self):
+        """Remove the expired tokens."""
+        now = time.time()
+        for name, (_, expires) in list(self._tokens.items()):
+            if expires is not None and expires <= now:
+                self.remove(name)
+
+    def describe(self):
+        """
+        Return a list of dictionaries with the name and the expiry of the
+        tokens (the tokens themselves are not included).
+        """
+        return [{
+            'name': name,
+            'expires': expires
+        } for name, (_, expires) in sorted(self._tokens.items())]
+
+    def get_state(self):
+        """Return the mode and the digests of the tokens, to be persisted."""
+        self.prune()
+        return {
+            'mode': self.mode,
+            'tokens': {
+                name: {
+                    'digest': digest,
+                    'expires': expires
+                } for name, (digest, expires) in self._tokens.items()
+            },
+        }
+
+    def load_state(self, state):
+        """Replace the mode and the tokens with the ones of a saved state."""
+        plain_tokens = dict(self._plain_tokens)
+        self.clear(state.get('mode', 'disabled'))
+        for name, token in state.get('tokens', {}).items():
+            self._tokens[name] = (token['digest'], token.get('expires'))
+            self._digests[token['digest']] = name
+        # Tokens still known, if the state is loaded again by the same process
+        for name, token in plain_tokens.items():
+            if self._tokens.get(name, (None, ))[0] == hash_token(token):
+                self._plain_tokens[name] = token
+        self.prune()
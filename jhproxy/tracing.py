@@ -0,0 +1,307 @@
+"""
+Tracing of the proxied requests, with OpenTelemetry-compatible spans: the
+request, and its phases (auth, port lookup, docker inspection, upstream
+fetch). The trace context is read from and propagated to the upstreams
+with the W3C `traceparent` header.
+
+Tracing is disabled until the process-wide `tracer` is configured, e.g.
+in `jupyterhub_config.py`:
+
+```
+from jhproxy.tracing import OTLPExporter, tracer
+tracer.configure(sample_rate=0.01,
+                 exporter=OTLPExporter('http://collector:4318/v1/traces'))
+```
+
+or, to write the spans to a local file (one JSON object per line),
+`exporter=FileExporter('/var/log/jhproxy/spans.jsonl')`.
+
+Only a fraction (`sample_rate`) of the requests is traced, plus the ones
+whose `traceparent` says that the caller is tracing them; the spans are
+exported in batches, from the IOLoop, every `export_interval` seconds.
+"""
+from tornado import gen, httpclient
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+from jhproxy.metrics import stats_collector
+import json
+import random
+import re
+import time
+
+# Kinds of the spans (as in OTLP)
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+_TRACEPARENT = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def parse_traceparent(value):
+    """
+    Return (trace_id, span_id, sampled) from the value of a traceparent
+    header, or None if it is missing or invalid.
+    """
+    match = _TRACEPARENT.match((value or '').strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if (version == 'ff' or trace_id == '0' * 32 or span_id == '0' * 16):
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span(object):
+    """
+    A timed operation of a trace, with attributes.
+
+    Spans are created with `Tracer.start_span` (the root span of a
+    request) and `child`, and must be ended with `end`.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, kind=INTERNAL,
+                 attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def child(self, name, kind=INTERNAL, attributes=None):
+        """Start a span inside this one."""
+        return Span(self.tracer, name, self.trace_id, self.span_id, kind,
+                    attributes)
+
+    def set_attribute(self, name, value):
+        """Set an attribute of the span."""
+        self.attributes[name] = value
+
+    def set_error(self, error):
+        """Mark the span as failed, with a description of the error."""
+        self.error = str(error)
+
+    def traceparent(self):
+        """Return the traceparent header for the operations of this span."""
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def end(self):
+        """End the span (only the first call counts) and export it."""
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        self.tracer.add(self)
+
+    def to_otlp(self):
+        """Return the span in the OTLP JSON encoding."""
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': [{
+                'key': key,
+                'value': _attribute_value(value)
+            } for key, value in self.attributes.items() if value is not None],
+            'status': ({
+                'code': 2,
+                'message': self.error
+            } if self.error is not None else {}),
+        }
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class _NoSpan(object):
+    """The span of the requests that are not traced: does nothing."""
+    # pylint: disable=unused-argument
+
+    def child(self, name, kind=INTERNAL, attributes=None):
+        return self
+
+    def set_attribute(self, name, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def traceparent(self):
+        return None
+
+    def end(self):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class FileExporter(object):
+    """Append the spans to a file, one OTLP JSON span per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a') as spans_file:
+            for span in spans:
+                spans_file.write(json.dumps(span.to_otlp()) + '\n')
+
+
+class OTLPExporter(object):
+    """Send the spans to an OpenTelemetry collector, with OTLP/HTTP (JSON)."""
+
+    def __init__(self, endpoint, headers=None, timeout=10,
+                 service_name='jhproxy'):
+        self.endpoint = endpoint
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = 'application/json'
+        self.timeout = timeout
+        self.service_name = service_name
+
+    @gen.coroutine
+    def export(self, spans):
+        body = {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': [{
+                        'key': 'service.name',
+                        'value': _attribute_value(self.service_name),
+                    }],
+                },
+                'scopeSpans': [{
+                    'scope': {
+                        'name': 'jhproxy'
+                    },
+                    'spans': [span.to_otlp() for span in spans],
+                }],
+            }],
+        }
+        yield httpclient.AsyncHTTPClient().fetch(
+            self.endpoint, method='POST', headers=self.headers,
+            body=json.dumps(body), request_timeout=self.timeout)
+
+
+class Tracer(object):
+    """
+    Start the spans of the sampled requests, and export them in batches.
+
+    At most max_queue spans wait to be exported; the further ones are
+    dropped (and counted), e.g. if the collector is down.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.
+        self.exporter = None
+        self.export_interval = 5.
+        self.max_batch = 512
+        self.max_queue = 4096
+        self.exported = 0
+        self.dropped = 0
+        self._queue = []
+        self._periodic = None
+        self._exporting = False
+
+    @property
+    def enabled(self):
+        """True if spans are exported."""
+        return self.exporter is not None
+
+    def configure(self, sample_rate=None, exporter=None, export_interval=None,
+                  max_batch=None, max_queue=None):
+        """Set the options that are not None."""
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if exporter is not None:
+            self.exporter = exporter
+        if export_interval is not None:
+            self.export_interval = export_interval
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if max_queue is not None:
+            self.max_queue = max_queue
+
+    def start_span(self, name, headers=None, kind=SERVER, attributes=None):
+        """
+        Start the root span of a request, with the trace context of its
+        traceparent header (if any); return `NO_SPAN` if it is not sampled.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        context = parse_traceparent(headers.get('traceparent')
+                                    if headers is not None else None)
+        if context is not None:
+            trace_id, parent_id, sampled = context
+        else:
+            trace_id = '{:032x}'.format(random.getrandbits(128))
+            parent_id = None
+            sampled = False
+        if not sampled and random.random() >= self.sample_rate:
+            return NO_SPAN
+        return Span(self, name, trace_id, parent_id, kind, attributes)
+
+    def add(self, span):
+        """Queue an ended span to be exported."""
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+        if self._periodic is None:
+            self._periodic = PeriodicCallback(self.flush,
+                                              self.export_interval * 1000)
+            self._periodic.start()
+        if len(self._queue) >= self.max_batch:
+            IOLoop.current().add_callback(self.flush)
+
+    @gen.coroutine
+    def flush(self):
+        """Export the queued spans."""
+        if self._exporting:
+            return
+        self._exporting = True
+        try:
+            while self._queue:
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+                try:
+                    result = self.exporter.export(batch)
+                    if result is not None:
+                        yield result
+                    self.exported += len(batch)
+                except Exception as exc: # pylint: disable=broad-except
+                    self.dropped += len(batch)
+                    app_log.warning("Cannot export %s spans: %s", len(batch),
+                                    exc)
+        finally:
+            self._exporting = False
+
+    def stats(self):
+        """Return a dictionary with the span counters."""
+        return {
+            'queued': len(self._queue),
+            'exported': self.exported,
+            'dropped': self.dropped,
+        }
+
+
+# Process-wide tracer of the proxy handlers (disabled until configured)
+tracer = Tracer()
+stats_collector.register('tracer', tracer.stats,
+                         "Spans of the proxy handlers")
@@ -0,0 +1,147 @@
+"""
+Warm-up of the upstreams of the containers that just started: the host
+ports mapped to some ports of the container (the `proxy_warmup_ports` of
+`TokenizedDockerSpawner`) are resolved right away, then the ports are
+polled in the background until the service inside answers, e.g. while a
+dashboard is still booting.
+
+Meanwhile, the proxy handlers hold the requests to these ports (for at most
+their `warmup_wait` seconds) instead of failing them, and send them once the
+service is ready. An upstream is ready when it answers a GET of the warm-up
+path with a status below 500 (a 401 or a 404 is an answer: the service
+is up); the warm-up gives up after its timeout, and the requests are then
+proxied as usual.
+"""
+from datetime import timedelta
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from jhproxy.client import get_upstream_client
+from jhproxy.routes import get_host_port
+from jhproxy.metrics import stats_collector
+import time
+
+
+class UpstreamWarmup(object):
+    """
+    The upstreams being warmed up, keyed by (container_id, proxy_port), with
+    a Future resolved (with True if the upstream is ready) at the end of
+    their warm-up.
+    """
+
+    def __init__(self):
+        self.ready = 0
+        self.timeouts = 0
+        self.held = 0
+        # container_id -> {proxy_port: Future}
+        self._upstreams = {}
+
+    def start(self, spawner, proxy_ports, timeout=60, interval=0.5, path='/'):
+        """
+        Start warming up the ports of the container of the spawner, in the
+        background: resolve their host ports, then poll them every interval
+        seconds, for at most timeout seconds.
+        """
+        container_id = spawner.container_id
+        ports = self._upstreams.setdefault(container_id, {})
+        for proxy_port in proxy_ports:
+            if proxy_port in ports:
+                continue
+            future = ports[proxy_port] = Future()
+            IOLoop.current().spawn_callback(self._warm_up, spawner,
+                                            container_id, proxy_port, future,
+                                            timeout, interval, path)
+
+    def warming(self, container_id, proxy_port):
+        """Return True if the upstream is being warmed up."""
+        return proxy_port in self._upstreams.get(container_id, ())
+
+    @gen.coroutine
+    def wait(self, container_id, proxy_port, timeout):
+        """
+        Wait (for at most timeout seconds) until the warm-up of the upstream
+        ends.
+
+        Return True if the upstream is ready, False if it is not (yet).
+        """
+        future = self._upstreams.get(container_id, {}).get(proxy_port)
+        if future is None:
+            raise gen.Return(False)
+        self.held += 1
+        try:
+            ready = yield gen.with_timeout(timedelta(seconds=timeout), future)
+        except gen.TimeoutError:
+            ready = False
+        raise gen.Return(ready)
+
+    def reset_container(self, container_id):
+        """
+        Stop the warm-up of the upstreams of a container (e.g. it stopped),
+        releasing the requests held for them.
+        """
+        for future in self._upstreams.pop(container_id, {}).values():
+            if not future.done():
+                future.set_result(False)
+
+    @gen.coroutine
+    def _warm_up(self, spawner, container_id, proxy_port, future, timeout,
+                 interval, path):
+        deadline = time.monotonic() + timeout
+        ready = False
+        while not future.done() and time.monotonic() < deadline:
+            try:
+                host_port = yield get_host_port(spawner, proxy_port)
+                if host_port is not None:
+                    ready = yield self._probe(spawner.host_ip, host_port, path,
+                                              deadline - time.monotonic())
+            except Exception as exc: # pylint: disable=broad-except
+                app_log.debug("Cannot warm up port %s of %s: %s", proxy_port,
+                              container_id, exc)
+            if ready:
+                break
+            yield gen.sleep(interval)
+        if future.done():
+            # Reset: the container stopped, or started again
+            return
+        if ready:
+            self.ready += 1
+            app_log.debug("Port %s of %s is ready", proxy_port, container_id)
+        else:
+            self.timeouts += 1
+            app_log.warning("Port %s of %s not ready after %s seconds",
+                            proxy_port, container_id, timeout)
+        del self._upstreams[container_id][proxy_port]
+        if not self._upstreams[container_id]:
+            del self._upstreams[container_id]
+        future.set_result(ready)
+
+    @gen.coroutine
+    def _probe(self, host_ip, host_port, path, timeout):
+        """Return True if the upstream answers with a status below 500."""
+        timeout = max(timeout, 0.1)
+        try:
+            response = yield get_upstream_client().fetch(
+                'http://{}:{}{}'.format(host_ip, host_port, path),
+                connect_timeout=timeout, request_timeout=timeout,
+                follow_redirects=False, raise_error=False)
+        except Exception: # pylint: disable=broad-except
+            # Nothing listens on the port yet
+            raise gen.Return(False)
+        raise gen.Return(response.code < 500)
+
+    def stats(self):
+        """Return a dictionary with the upstreams warming up and the counters."""
+        return {
+            'warming': sum(len(ports) for ports in self._upstreams.values()),
+            'ready': self.ready,
+            'timeouts': self.timeouts,
+            'held': self.held,
+        }
+
+
+# Process-wide warm-up of the upstreams, started by `TokenizedDockerSpawner`
+# (see its `proxy_warmup_ports` option) and waited for by the proxy handlers
+upstream_warmup = UpstreamWarmup()
+stats_collector.register('upstream_warmup', upstream_warmup.stats,
+                         "Warm-up of the upstreams")
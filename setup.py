@@ -29,7 +29,7 @@ if __name__ == '__main__':
     setup(
         name="jhproxy",
         author="Giovanni Pizzi",
-        packages=find_packages(),
+        packages=find_packages(exclude=['tests']),
         description=
         'A port proxy for JupyterHub when using the DockerSpawner, optionally with (token-based) authorization.',
         url="https://github.com/aiidalab/jhproxy",
@@ -49,4 +49,8 @@ if __name__ == '__main__':
         long_description_content_type='text/markdown',
         version=get_version(),
         install_requires=['jupyterhub', 'dockerspawner', 'traitlets'],
+        extras_require={'brotli': ['brotli']},
+        entry_points={
+            'console_scripts': ['jhproxy-service = jhproxy.service:main'],
+        },
     )
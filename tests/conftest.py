@@ -0,0 +1,16 @@
+"""
+Fixtures shared by the tests.
+"""
+import pytest
+import time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A monotonic clock that only moves when told to: the list [now], whose
+    item can be increased by the tests.
+    """
+    now = [1000.]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
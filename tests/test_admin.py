@@ -0,0 +1,116 @@
+"""
+Tests of the `ProxyTokenAdminHandler`, authenticated with the API tokens of
+the hub.
+"""
+from unittest import mock
+from jhproxy import ProxyTokenAdminHandler
+from jhproxy.spawners import TokenizedDockerSpawner
+from jhproxy.tokens import DEFAULT_TOKEN
+from tests.utils import HubTestCase
+import json
+
+
+class ProxyTokenAdminTest(HubTestCase):
+
+    def get_handlers(self):
+        return [
+            (r'/admin', ProxyTokenAdminHandler, dict(commit_batch_size=2)),
+        ]
+
+    def setUp(self):
+        super().setUp()
+        self.add_user('admin', admin=True)
+        self.spawners = {name: self.add_user(name, token='secret')
+                         for name in ('alice', 'bob', 'carol')}
+
+    def post(self, body, scopes=('admin:servers',)):
+        token = self.new_api_token('admin', scopes=list(scopes))
+        return self.fetch('/admin', method='POST', body=json.dumps(body),
+                          headers={'Authorization': 'token ' + token})
+
+    def assert_unchanged(self, *names):
+        for name in names:
+            self.assertEqual(
+                self.spawners[name].proxy_tokens.get_token(DEFAULT_TOKEN),
+                'secret')
+
+    def test_random(self):
+        response = self.post({'action': 'random', 'users': ['alice', 'bob']})
+        self.assertEqual(response.code, 200)
+        tokens = json.loads(response.body)['tokens']
+        self.assertEqual(sorted(tokens), ['alice', 'bob'])
+        for name, token in tokens.items():
+            self.assertEqual(self.spawners[name].proxy_token, token)
+        self.assert_unchanged('carol')
+
+    def test_actions(self):
+        response = self.post({'action': 'allow_all', 'users': ['alice']})
+        self.assertEqual(json.loads(response.body), {'tokens': {'alice': ''}})
+        response = self.post({'action': 'disabled', 'users': ['alice']})
+        self.assertEqual(json.loads(response.body),
+                         {'tokens': {'alice': None}})
+        self.assertEqual(self.spawners['alice'].proxy_tokens.mode,
+                         'disabled')
+
+    def test_not_authenticated(self):
+        response = self.fetch('/admin', method='POST', body=json.dumps(
+            {'action': 'disabled', 'users': ['alice']}))
+        self.assertEqual(response.code, 403)
+        self.assert_unchanged('alice')
+
+    def test_scopes(self):
+        """The users outside the scope of the token fail the whole batch."""
+        scopes = ['admin:servers!user=alice']
+        response = self.post({'action': 'disabled', 'users': ['alice']},
+                             scopes)
+        self.assertEqual(response.code, 200)
+        response = self.post(
+            {'action': 'disabled', 'users': ['bob', 'alice', 'carol']},
+            scopes)
+        self.assertEqual(response.code, 403)
+        self.assertIn(b'bob, carol', response.body)
+        self.assert_unchanged('bob', 'carol')
+        self.assertEqual(self.post({'action': 'disabled', 'users': ['bob']},
+                                   ['read:users']).code, 403)
+        self.assert_unchanged('bob')
+
+    def test_not_found(self):
+        response = self.post(
+            {'action': 'disabled', 'users': ['alice', 'dave']})
+        self.assertEqual(response.code, 404)
+        self.assertIn(b'dave', response.body)
+        self.assert_unchanged('alice')
+
+    def test_invalid_body(self):
+        for body in ({'action': 'remove', 'users': ['alice']},
+                     {'action': 'disabled', 'users': 'alice'},
+                     {'action': 'disabled'}, ['alice']):
+            self.assertEqual(self.post(body).code, 400)
+        self.assert_unchanged('alice')
+
+    def test_save_states(self):
+        """The states are saved, in commits of commit_batch_size users."""
+        calls = []
+        commit = self.db.commit
+        save_proxy_state = TokenizedDockerSpawner.save_proxy_state
+
+        def record_commit():
+            calls.append('commit')
+            commit()
+
+        def record_save(spawner, commit=True):
+            calls.append(spawner.user.name)
+            save_proxy_state(spawner, commit=commit)
+
+        with mock.patch.object(self.db, 'commit', record_commit), \
+                mock.patch.object(TokenizedDockerSpawner, 'save_proxy_state',
+                                  record_save):
+            response = self.post(
+                {'action': 'random', 'users': ['alice', 'bob', 'carol']})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(calls[calls.index('alice'):],
+                         ['alice', 'bob', 'commit', 'carol', 'commit'])
+        for spawner in self.spawners.values():
+            self.db.expire(spawner.orm_spawner)
+            self.assertEqual(spawner.orm_spawner.state['proxy_tokens'],
+                             spawner.proxy_tokens.get_state())
@@ -0,0 +1,130 @@
+"""
+Tests of `jhproxy.cache`.
+"""
+from tornado.httputil import HTTPHeaders
+from jhproxy.cache import ResponseCache, parse_cache_control
+
+# (user, proxy port, path, query, token scope, Accept-Encoding), as built by
+# the proxy handlers
+KEY = ('alice', 5000, '/data', '', 'token', '')
+
+VARY_HEADERS = {'Cache-Control': 'max-age=60', 'Vary': 'Accept-Language'}
+
+
+def store(cache, key, request_headers, headers, body=b'body'):
+    """Store a 200 response with the headers in the cache."""
+    headers = HTTPHeaders(headers)
+    ttl = cache.get_ttl(200, headers, request_headers)
+    cache.set(key, request_headers, 200, 'OK', headers, body, ttl)
+    return ttl
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('Max-Age=60, no-cache, private="x"') == {
+        'max-age': '60',
+        'no-cache': None,
+        'private': 'x',
+    }
+
+
+def test_ttl():
+    cache = ResponseCache(max_ttl=100)
+    request_headers = HTTPHeaders()
+
+    def get_ttl(headers, code=200):
+        return cache.get_ttl(code, HTTPHeaders(headers), request_headers)
+
+    assert get_ttl({'Cache-Control': 'max-age=60'}) == 60
+    assert get_ttl({'Cache-Control': 'max-age=60, s-maxage=30'}) == 30
+    assert get_ttl({'Cache-Control': 'max-age=60', 'Age': '50'}) == 10
+    assert get_ttl({'Cache-Control': 'max-age=6000'}) == 100
+    assert get_ttl({'Cache-Control': 'no-cache', 'Etag': '"1"'}) == 0
+    assert get_ttl({'Cache-Control': 'no-cache'}) is None
+    assert get_ttl({'Cache-Control': 'max-age=60, private'}) is None
+    assert get_ttl({'Cache-Control': 'max-age=60, no-store'}) is None
+    assert get_ttl({'Cache-Control': 'max-age=60', 'Vary': '*'}) is None
+    assert get_ttl({'Cache-Control': 'max-age=60',
+                    'Set-Cookie': 'a=b'}) is None
+    assert get_ttl({'Cache-Control': 'max-age=60'}, 404) is None
+
+
+def test_authorization():
+    """Authorized responses are only cached if explicitly public."""
+    cache = ResponseCache()
+    request_headers = HTTPHeaders({'Authorization': 'Bearer x'})
+    assert cache.get_ttl(200, HTTPHeaders({'Cache-Control': 'max-age=60'}),
+                         request_headers) is None
+    assert cache.get_ttl(
+        200, HTTPHeaders({'Cache-Control': 'max-age=60, public'}),
+        request_headers) == 60
+
+
+def test_cacheable_request():
+    assert ResponseCache.is_cacheable_request('GET', HTTPHeaders())
+    assert not ResponseCache.is_cacheable_request('POST', HTTPHeaders())
+    assert not ResponseCache.is_cacheable_request(
+        'GET', HTTPHeaders({'Range': 'bytes=0-1'}))
+    assert not ResponseCache.is_cacheable_request(
+        'GET', HTTPHeaders({'Cache-Control': 'no-store'}))
+
+
+def test_scope():
+    """The responses are not shared between users nor token scopes."""
+    cache = ResponseCache()
+    request_headers = HTTPHeaders()
+    store(cache, KEY, request_headers, {'Cache-Control': 'max-age=60'})
+    assert cache.get(KEY, request_headers).body == b'body'
+    assert cache.get(('bob', ) + KEY[1:], request_headers) is None
+    assert cache.get(KEY[:4] + ('other-token', ) + KEY[5:],
+                     request_headers) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_vary():
+    """The request headers listed in Vary select the stored variant."""
+    cache = ResponseCache()
+    english = HTTPHeaders({'Accept-Language': 'en'})
+    french = HTTPHeaders({'Accept-Language': 'fr'})
+    store(cache, KEY, english, VARY_HEADERS, b'hello')
+    assert cache.get(KEY, english).body == b'hello'
+    assert cache.get(KEY, french) is None
+
+    store(cache, KEY, french, VARY_HEADERS, b'bonjour')
+    assert cache.get(KEY, english).body == b'hello'
+    assert cache.get(KEY, french).body == b'bonjour'
+    assert cache.stats()['entries'] == 2
+
+
+def test_stale():
+    """Stale responses are only kept if they can be revalidated."""
+    cache = ResponseCache()
+    request_headers = HTTPHeaders()
+    other_key = KEY[:2] + ('/other', ) + KEY[3:]
+    store(cache, KEY, request_headers,
+          {'Cache-Control': 'no-cache', 'Etag': '"1"'})
+    store(cache, other_key, request_headers, {'Cache-Control': 'max-age=60'})
+    cache.get(other_key, request_headers).set_ttl(-1)
+
+    entry = cache.get(KEY, request_headers)
+    assert not entry.is_fresh()
+    assert entry.etag == '"1"'
+    assert cache.get(other_key, request_headers) is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_eviction():
+    cache = ResponseCache(max_size=300, max_entry_size=100)
+    request_headers = HTTPHeaders()
+    store(cache, KEY, request_headers, {'Cache-Control': 'max-age=60'},
+          b'x' * 101)
+    assert cache.stats()['entries'] == 0
+
+    keys = [KEY[:2] + ('/{}'.format(i), ) + KEY[3:] for i in range(4)]
+    for key in keys:
+        store(cache, key, request_headers, {'Cache-Control': 'max-age=60'},
+              b'x' * 80)
+    assert cache.get(keys[0], request_headers) is None
+    assert cache.get(keys[3], request_headers) is not None
+    assert cache.stats()['evictions'] >= 1
+    assert cache.size <= cache.max_size
@@ -0,0 +1,126 @@
+"""
+Tests of `jhproxy.coalesce`.
+"""
+from tornado.concurrent import Future
+from tornado.httputil import HTTPHeaders
+from tornado.iostream import StreamClosedError
+from tornado.testing import AsyncTestCase, gen_test
+from jhproxy.coalesce import RequestCoalescer, is_shareable
+
+
+def done(error=None):
+    """Return a resolved Future (failed with the error, if any)."""
+    future = Future()
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+    return future
+
+
+class Follower(object):
+    """The callbacks of a follower, recording the response."""
+
+    def __init__(self, accept=True, error=None):
+        self.accept = accept
+        self.error = error
+        self.code = None
+        self.chunks = []
+
+    def on_headers(self, code, reason, headers):
+        self.code = code
+        return self.accept
+
+    def on_chunk(self, chunk):
+        self.chunks.append(chunk)
+        return done(self.error)
+
+
+def test_shareable():
+    request_headers = HTTPHeaders({'Accept-Language': 'en'})
+    assert is_shareable(HTTPHeaders(), request_headers, HTTPHeaders())
+    assert not is_shareable(HTTPHeaders({'Set-Cookie': 'a=b'}),
+                            request_headers, request_headers)
+    assert not is_shareable(HTTPHeaders({'Cache-Control': 'private'}),
+                            request_headers, request_headers)
+    vary = HTTPHeaders({'Vary': 'Accept-Language'})
+    assert is_shareable(vary, request_headers, request_headers)
+    assert not is_shareable(vary, request_headers, HTTPHeaders())
+    assert not is_shareable(HTTPHeaders({'Vary': '*'}), request_headers,
+                            request_headers)
+
+
+def test_join():
+    coalescer = RequestCoalescer()
+    assert coalescer.join('key') is None
+    flight = coalescer.begin('key', HTTPHeaders())
+    assert coalescer.join('key') is flight
+    flight.start(200, 'OK', HTTPHeaders())
+    # Too late to follow once the response started
+    assert coalescer.join('key') is None
+
+
+class FlightTest(AsyncTestCase):
+
+    def begin(self, *followers):
+        coalescer = self.coalescer = RequestCoalescer()
+        flight = coalescer.begin('key', HTTPHeaders())
+        futures = [flight.follow(follower.on_headers, follower.on_chunk)
+                   for follower in followers]
+        flight.start(200, 'OK', HTTPHeaders())
+        return flight, futures
+
+    @gen_test
+    def test_shared(self):
+        followers = [Follower(), Follower(accept=False)]
+        flight, futures = self.begin(*followers)
+        self.assertIs(futures[1].result(), False)
+        yield flight.write(b'a', done())
+        yield flight.write(b'b', done())
+        flight.finish()
+        self.assertIs((yield futures[0]), True)
+        self.assertEqual(followers[0].chunks, [b'a', b'b'])
+        self.assertEqual(followers[1].chunks, [])
+        self.assertEqual(self.coalescer.stats()['hits'], 1)
+
+    @gen_test
+    def test_leader_disconnected(self):
+        """The followers still get the body if the first client leaves."""
+        follower = Follower()
+        flight, futures = self.begin(follower)
+        yield flight.write(b'a', done(StreamClosedError()))
+        yield flight.write(b'b', done(StreamClosedError()))
+        flight.finish()
+        self.assertIs((yield futures[0]), True)
+        self.assertEqual(follower.chunks, [b'a', b'b'])
+
+    @gen_test
+    def test_follower_disconnected(self):
+        """A follower whose client leaves is dropped, with the error."""
+        followers = [Follower(error=StreamClosedError()), Follower()]
+        flight, futures = self.begin(*followers)
+        yield flight.write(b'a', done())
+        yield flight.write(b'b', done())
+        flight.finish()
+        with self.assertRaises(StreamClosedError):
+            yield futures[0]
+        self.assertIs((yield futures[1]), True)
+        self.assertEqual(followers[0].chunks, [b'a'])
+        self.assertEqual(followers[1].chunks, [b'a', b'b'])
+
+    @gen_test
+    def test_all_disconnected(self):
+        """Reading the upstream stops once no client is left."""
+        flight, futures = self.begin(Follower(error=StreamClosedError()))
+        with self.assertRaises(StreamClosedError):
+            yield flight.write(b'a', done(StreamClosedError()))
+        with self.assertRaises(StreamClosedError):
+            yield futures[0]
+
+    @gen_test
+    def test_upstream_error(self):
+        flight, futures = self.begin(Follower())
+        yield flight.write(b'a', done())
+        flight.finish(RuntimeError("Upstream closed"))
+        with self.assertRaises(RuntimeError):
+            yield futures[0]
@@ -0,0 +1,131 @@
+"""
+Tests of the compression of the responses by the `ProxyHandler`
+(`jhproxy.compress`).
+"""
+from tornado import web
+from jhproxy import ProxyHandler
+from jhproxy.compress import (CompressionBudget, negotiate_encoding,
+                              parse_accept_encoding)
+from tests.utils import PROXY_PORT, HubTestCase
+from unittest import mock
+import gzip
+
+TEXT = b'<p>Hello world</p>\n' * 200
+
+
+class UpstreamHandler(web.RequestHandler):
+    """Responses of all kinds, depending on the path."""
+
+    def get(self, path):
+        self.set_header('Content-Type', 'text/html')
+        self.set_header('Etag', '"v1"')
+        if path == 'small':
+            self.write(b'<p>Hello</p>')
+            return
+        if path == 'encoded':
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(gzip.compress(TEXT))
+            return
+        if path == 'no-transform':
+            self.set_header('Cache-Control', 'no-transform')
+        elif path == 'image':
+            self.set_header('Content-Type', 'image/png')
+        elif path == 'vary':
+            self.set_header('Vary', 'Cookie')
+        elif path == 'weak':
+            self.set_header('Etag', 'W/"v1"')
+        self.write(TEXT)
+
+
+def test_negotiate_encoding():
+    assert parse_accept_encoding('gzip;q=0.5, br') == {'gzip': .5, 'br': 1.}
+    assert negotiate_encoding('gzip, deflate', ('gzip', )) == 'gzip'
+    assert negotiate_encoding('gzip;q=0', ('gzip', )) is None
+    assert negotiate_encoding('*', ('gzip', )) == 'gzip'
+    assert negotiate_encoding(None, ('gzip', )) is None
+
+
+class CompressionTest(HubTestCase):
+
+    def get_handlers(self):
+        options = dict(proxy_port=PROXY_PORT, compress_responses=True,
+                       compress_encodings=('gzip', ))
+        return [
+            (r'/proxy/([^/]+)(/.*)', ProxyHandler, options),
+            (r'/buffered/([^/]+)(/.*)', ProxyHandler,
+             dict(options, stream_response=False)),
+            (r'/budget/([^/]+)(/.*)', ProxyHandler,
+             dict(options, compress_cpu_budget=1e-9)),
+            (r'/plain/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT)),
+        ]
+
+    def get_upstream_app(self):
+        return web.Application([(r'/(.*)', UpstreamHandler)])
+
+    def setUp(self):
+        super().setUp()
+        self.add_user('alice')
+
+    def get(self, path, accept_encoding='gzip', prefix='proxy'):
+        return self.fetch('/{}/alice/{}'.format(prefix, path),
+                          headers={'Accept-Encoding': accept_encoding},
+                          decompress_response=False)
+
+    def assert_compressed(self, response):
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(response.body), TEXT)
+
+    def assert_not_compressed(self, response):
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Etag'], '"v1"')
+
+    def test_compressed(self):
+        for prefix in ('proxy', 'buffered'):
+            response = self.get('text', prefix=prefix)
+            self.assert_compressed(response)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            # Not the bytes of the upstream anymore
+            self.assertEqual(response.headers['Etag'], 'W/"v1"')
+
+    def test_etag(self):
+        response = self.get('weak')
+        self.assert_compressed(response)
+        self.assertEqual(response.headers['Etag'], 'W/"v1"')
+
+    def test_vary(self):
+        response = self.get('vary')
+        self.assert_compressed(response)
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_not_accepted(self):
+        """The response still varies with the encodings accepted."""
+        response = self.get('text', accept_encoding='identity')
+        self.assert_not_compressed(response)
+        self.assertEqual(response.body, TEXT)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_skipped(self):
+        for path in ('small', 'no-transform', 'image'):
+            self.assert_not_compressed(self.get(path))
+        response = self.get('text', prefix='plain')
+        self.assert_not_compressed(response)
+        self.assertNotIn('Vary', response.headers)
+
+    def test_encoded(self):
+        """The encoding of the upstream is passed through."""
+        response = self.get('encoded')
+        self.assert_compressed(response)
+        self.assertEqual(response.headers['Etag'], '"v1"')
+
+    def test_budget(self):
+        """Once the CPU budget is spent, the responses are not compressed."""
+        budget = CompressionBudget()
+        with mock.patch('jhproxy.compress.compression_budget', budget), \
+                mock.patch('jhproxy.proxy.compression_budget', budget):
+            self.assert_compressed(self.get('text', prefix='budget'))
+            self.assert_not_compressed(self.get('text', prefix='budget'))
+            self.assert_compressed(self.get('text'))
+        self.assertEqual(budget.exceeded, 1)
@@ -0,0 +1,211 @@
+"""
+Tests of `jhproxy.events`, with a fake event source in place of docker.
+"""
+from unittest import mock
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+from jhproxy.events import (CONTAINER_LABEL, DockerEventWatcher,
+                            ports_from_list)
+from jhproxy.routes import PortMap
+from jhproxy.spawners import TokenizedDockerSpawner
+import dockerspawner
+import queue
+import time
+
+PORTS = {'5000/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32768'}]}
+NEW_PORTS = {'5000/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32769'}]}
+LABELS = {CONTAINER_LABEL: 'hub'}
+
+
+def container_event(action, container_id, labels=LABELS):
+    # The attributes of the container events include the labels
+    attributes = dict(labels, name=container_id)
+    return {
+        'Type': 'container',
+        'Action': action,
+        'Actor': {'ID': container_id, 'Attributes': attributes},
+    }
+
+
+def network_event(action, container_id):
+    return {
+        'Type': 'network',
+        'Action': action,
+        'Actor': {'Attributes': {'container': container_id}},
+    }
+
+
+class FakeStream(object):
+    """A stream of events, as returned by the `events` of docker."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self._queue.get()
+        if event is None:
+            raise StopIteration
+        if isinstance(event, Exception):
+            raise event
+        return event
+
+    def push(self, event):
+        self._queue.put(event)
+
+    def close(self):
+        self._queue.put(None)
+
+
+class FakeClient(object):
+    """The docker client, for `containers` and `inspect_container` only."""
+
+    def __init__(self, containers):
+        self.ports = {}
+        self._containers = containers
+
+    def containers(self, filters=None):
+        labels = set((filters or {}).get('label', []))
+        return [container for container in self._containers
+                if labels <= {'{}={}'.format(*item)
+                              for item in container['Labels'].items()}]
+
+    def inspect_container(self, container_id):
+        if container_id not in self.ports:
+            raise KeyError(container_id)
+        return {
+            'State': {'Running': True},
+            'NetworkSettings': {'Ports': self.ports[container_id]},
+        }
+
+
+class FakeWatcher(DockerEventWatcher):
+    """A watcher reading the events of the streams of the test."""
+
+    def __init__(self, port_map):
+        super().__init__(port_map, retry_delay=0.01)
+        self.streams = []
+
+    def get_events(self):
+        stream = FakeStream()
+        self.streams.append(stream)
+        return stream
+
+
+def test_ports_from_list():
+    container = {
+        'Id': 'abc',
+        'Ports': [
+            {'PrivatePort': 5000, 'PublicPort': 32768, 'Type': 'tcp',
+             'IP': '0.0.0.0'},
+            {'PrivatePort': 8888, 'Type': 'tcp'},
+        ],
+    }
+    assert ports_from_list(container) == PORTS
+    assert ports_from_list({'Id': 'abc', 'Ports': None}) == {}
+
+
+def test_container_labels():
+    """The spawner creates its containers with the labels."""
+    spawner = TokenizedDockerSpawner()
+    with mock.patch.object(dockerspawner.DockerSpawner, 'docker') as docker:
+        spawner.docker('create_container', image='image', labels=['mine'])
+        spawner.docker('inspect_container', 'id')
+    docker.assert_has_calls([
+        mock.call('create_container', image='image',
+                  labels={'mine': '', CONTAINER_LABEL: 'true'}),
+        mock.call('inspect_container', 'id'),
+    ])
+
+
+class DockerEventWatcherTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.port_map = PortMap()
+        ports = [{'PrivatePort': 5000, 'PublicPort': 32768, 'Type': 'tcp',
+                  'IP': '0.0.0.0'}]
+        self.client = FakeClient([
+            {'Id': 'running', 'Ports': ports, 'Labels': LABELS},
+            {'Id': 'other', 'Ports': ports, 'Labels': {}},
+        ])
+        self.watcher = FakeWatcher(self.port_map)
+
+    def tearDown(self):
+        self.watcher.stop()
+        super().tearDown()
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=5):
+        """Wait until condition() is true."""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_events(self):
+        self.watcher.start(self.client, LABELS)
+        yield self.wait_for(lambda: 'running' in self.port_map)
+        self.assertEqual(self.port_map.get('running'), PORTS)
+        stream = self.watcher.streams[0]
+
+        self.client.ports['started'] = PORTS
+        stream.push(container_event('start', 'started'))
+        yield self.wait_for(lambda: 'started' in self.port_map)
+
+        self.client.ports['running'] = NEW_PORTS
+        stream.push(network_event('connect', 'running'))
+        yield self.wait_for(
+            lambda: self.port_map.get('running') == NEW_PORTS)
+
+        # Unknown containers are not inspected
+        stream.push(network_event('connect', 'unknown'))
+        stream.push(container_event('die', 'started'))
+        yield self.wait_for(lambda: 'started' not in self.port_map)
+        self.assertNotIn('unknown', self.port_map)
+        self.assertEqual(self.watcher.stats()['events'], 4)
+
+    @gen_test
+    def test_labels(self):
+        """The containers without the labels are ignored."""
+        self.watcher.start(self.client, LABELS)
+        yield self.wait_for(lambda: 'running' in self.port_map)
+        self.assertNotIn('other', self.port_map)
+        stream = self.watcher.streams[0]
+        self.client.ports['other'] = self.client.ports['labeled'] = PORTS
+        for labels in ({}, {CONTAINER_LABEL: 'other-hub'}):
+            stream.push(container_event('start', 'other', labels))
+        stream.push(container_event('start', 'labeled'))
+        yield self.wait_for(lambda: 'labeled' in self.port_map)
+        self.assertNotIn('other', self.port_map)
+
+    @gen_test
+    def test_gone(self):
+        """A container that cannot be inspected is dropped."""
+        self.watcher.start(self.client, LABELS)
+        yield self.wait_for(lambda: 'running' in self.port_map)
+        self.watcher.streams[0].push(container_event('start', 'running'))
+        yield self.wait_for(lambda: 'running' not in self.port_map)
+
+    @gen_test
+    def test_reconnect(self):
+        """The containers are listed again after an error."""
+        self.watcher.start(self.client, LABELS)
+        yield self.wait_for(lambda: 'running' in self.port_map)
+        self.port_map.drop('running')
+        self.watcher.streams[0].push(RuntimeError("Connection lost"))
+        yield self.wait_for(lambda: len(self.watcher.streams) == 2)
+        yield self.wait_for(lambda: 'running' in self.port_map)
+        self.assertEqual(self.watcher.stats()['errors'], 1)
+        self.assertTrue(self.watcher.running)
+
+    @gen_test
+    def test_stop(self):
+        self.watcher.start(self.client, LABELS)
+        yield self.wait_for(lambda: self.watcher.streams)
+        self.watcher.stop()
+        yield self.wait_for(lambda: not self.watcher.running)
+        self.assertEqual(len(self.watcher.streams), 1)
@@ -0,0 +1,86 @@
+"""
+Tests of the filtering of the forwarded headers, in `jhproxy.headers`.
+"""
+from tornado.httputil import HTTPHeaders
+from jhproxy.headers import (RESPONSE_SKIPPED_HEADERS, copy_headers,
+                             get_request_headers, strip_hub_cookies)
+
+
+def make_headers(*items):
+    headers = HTTPHeaders()
+    for name, value in items:
+        headers.add(name, value)
+    return headers
+
+
+def test_hop_by_hop():
+    headers = get_request_headers(make_headers(
+        ('Host', 'hub.example.com'),
+        ('Connection', 'keep-alive, X-Custom'),
+        ('Keep-Alive', 'timeout=5'),
+        ('Transfer-Encoding', 'chunked'),
+        ('Te', 'trailers'),
+        ('Upgrade', 'h2c'),
+        ('Expect', '100-continue'),
+        ('X-Custom', 'hop'),
+        ('X-Proxy-Token', 'secret'),
+        ('Accept', 'text/html'),
+    ))
+    assert sorted(headers) == ['Accept', 'Host']
+
+
+def test_websocket():
+    """The handshakes keep their Connection and Upgrade headers."""
+    headers = get_request_headers(make_headers(
+        ('Connection', 'Upgrade'),
+        ('Upgrade', 'websocket'),
+        ('Sec-Websocket-Key', 'key'),
+        ('X-Proxy-Token', 'secret'),
+    ), websocket=True)
+    assert sorted(headers) == ['Connection', 'Sec-Websocket-Key', 'Upgrade']
+
+
+def test_forwarded():
+    request_headers = make_headers(
+        ('X-Forwarded-For', '198.51.100.1'),
+        ('X-Real-Ip', '198.51.100.1'),
+        ('Forwarded', 'for=198.51.100.1'),
+    )
+    assert not get_request_headers(request_headers)
+    assert len(get_request_headers(request_headers, forwarded=False)) == 3
+
+
+def test_repeated():
+    """Repeated headers are all forwarded, in order."""
+    headers = get_request_headers(make_headers(
+        ('Accept', 'text/html'),
+        ('X-Multi', 'first'),
+        ('X-Multi', 'second'),
+    ))
+    assert headers.get_list('X-Multi') == ['first', 'second']
+
+
+def test_hub_cookies():
+    headers = get_request_headers(make_headers(
+        ('Cookie', 'jupyterhub-session-id=1; theme=dark; '
+         'jupyterhub-user-alice=2'),
+        ('Cookie', 'jupyterhub-hub-login=3'),
+    ))
+    assert headers.get_list('Cookie') == ['theme=dark']
+
+    headers = get_request_headers(make_headers(('Cookie', 'theme=dark')))
+    assert headers['Cookie'] == 'theme=dark'
+
+    assert strip_hub_cookies('jupyterhub-session-id=1') is None
+
+
+def test_response():
+    headers = copy_headers(make_headers(
+        ('Content-Type', 'text/html'),
+        ('Content-Length', '12'),
+        ('Connection', 'close'),
+        ('Set-Cookie', 'a=1'),
+        ('Set-Cookie', 'b=2'),
+    ), make_headers(('Set-Cookie', 'c=3')), RESPONSE_SKIPPED_HEADERS)
+    assert sorted(headers) == ['Content-Type', 'Set-Cookie']
+    assert headers.get_list('Set-Cookie') == ['c=3', 'a=1', 'b=2']
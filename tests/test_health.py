@@ -0,0 +1,67 @@
+"""
+Tests of the circuit breakers of `jhproxy.health`.
+"""
+from jhproxy.health import UpstreamHealth
+import pytest
+
+
+def fail(health, times, container_id='abc', proxy_port=5000):
+    for _ in range(times):
+        health.record(container_id, proxy_port, True, threshold=3, delay=1,
+                      max_delay=4)
+
+
+def test_closed(clock):
+    """The circuit stays closed below the threshold."""
+    health = UpstreamHealth()
+    fail(health, 2)
+    assert health.allow('abc', 5000) == 0
+    # A success resets the count
+    health.record('abc', 5000, False)
+    fail(health, 2)
+    assert health.allow('abc', 5000) == 0
+    assert health.stats()['open'] == 0
+
+
+def test_open(clock):
+    health = UpstreamHealth()
+    fail(health, 3)
+    assert health.allow('abc', 5000) == pytest.approx(1)
+    # Other ports and containers are not affected
+    assert health.allow('abc', 6000) == 0
+    assert health.allow('def', 5000) == 0
+    assert health.stats() == {'open': 1, 'opened': 1, 'rejected': 1}
+
+
+def test_half_open(clock):
+    """After the delay, a single probe is let through."""
+    health = UpstreamHealth()
+    fail(health, 3)
+    clock[0] += 1
+    assert health.allow('abc', 5000) == 0
+    assert health.allow('abc', 5000) == pytest.approx(1)
+
+    # The probe connects: the circuit closes
+    health.record('abc', 5000, False)
+    assert health.allow('abc', 5000) == 0
+    assert health.stats()['open'] == 0
+
+
+def test_backoff(clock):
+    """Each failed probe doubles the delay, up to max_delay."""
+    health = UpstreamHealth()
+    fail(health, 3)
+    for delay in (2, 4, 4):
+        clock[0] += 10
+        assert health.allow('abc', 5000) == 0
+        fail(health, 1)
+        assert health.allow('abc', 5000) == pytest.approx(delay)
+    assert health.stats()['opened'] == 1
+
+
+def test_reset_container(clock):
+    health = UpstreamHealth()
+    fail(health, 3)
+    health.reset_container('abc')
+    assert health.allow('abc', 5000) == 0
+    assert health.stats()['open'] == 0
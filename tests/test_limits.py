@@ -0,0 +1,84 @@
+"""
+Tests of `jhproxy.limits`.
+"""
+from traitlets import TraitError
+from jhproxy.limits import BLOCKED_RETRY_AFTER, RateLimiter
+from jhproxy.spawners import TokenizedDockerSpawner
+import pytest
+
+
+def test_burst(clock):
+    limiter = RateLimiter()
+    for _ in range(3):
+        assert limiter.acquire('key', 1, burst=3) == 0
+    assert limiter.acquire('key', 1, burst=3) == pytest.approx(1)
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_refill(clock):
+    limiter = RateLimiter()
+    assert limiter.acquire('key', 2) == 0
+    assert limiter.acquire('key', 2) == 0
+    assert limiter.acquire('key', 2) == pytest.approx(0.5)
+    clock[0] += 0.25
+    assert limiter.acquire('key', 2) == pytest.approx(0.25)
+    clock[0] += 0.25
+    assert limiter.acquire('key', 2) == 0
+    # Refilled up to the burst only
+    clock[0] += 100
+    assert limiter.acquire('key', 2) == 0
+    assert limiter.acquire('key', 2) == 0
+    assert limiter.acquire('key', 2) > 0
+
+
+def test_slow_rate(clock):
+    """A rate below 1 still allows a burst of 1."""
+    limiter = RateLimiter()
+    assert limiter.acquire('key', 0.1) == 0
+    assert limiter.acquire('key', 0.1) == pytest.approx(10)
+
+
+def test_zero_rate(clock):
+    limiter = RateLimiter()
+    assert limiter.acquire('key', 0, burst=1) == 0
+    assert limiter.acquire('key', 0, burst=1) == BLOCKED_RETRY_AFTER
+    clock[0] += 1000
+    assert limiter.acquire('key', 0, burst=1) == BLOCKED_RETRY_AFTER
+
+
+def test_zero_rate_option():
+    """The spawners refuse a rate that would block all the requests."""
+    with pytest.raises(TraitError):
+        TokenizedDockerSpawner(proxy_rate_limit=0)
+    with pytest.raises(TraitError):
+        TokenizedDockerSpawner(proxy_rate_burst=0)
+    assert TokenizedDockerSpawner(proxy_rate_limit=0.5).proxy_rate_limit == 0.5
+
+
+def test_keys(clock):
+    limiter = RateLimiter()
+    assert limiter.acquire('alice', 1) == 0
+    assert limiter.acquire('alice', 1) > 0
+    assert limiter.acquire('bob', 1) == 0
+
+
+def test_prune(clock):
+    """The full buckets are dropped once there are too many."""
+    limiter = RateLimiter(max_buckets=2)
+    limiter.acquire('first', 1)
+    limiter.acquire('second', 1)
+    clock[0] += 10
+    limiter.acquire('third', 1)
+    assert limiter.stats()['buckets'] == 1
+
+
+def test_concurrency():
+    limiter = RateLimiter()
+    assert limiter.start('key', 2)
+    assert limiter.start('key', 2)
+    assert not limiter.start('key', 2)
+    limiter.end('key')
+    assert limiter.start('key', 2)
+    limiter.end('key')
+    limiter.end('key')
+    assert limiter.stats()['in_flight_keys'] == 0
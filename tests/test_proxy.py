@@ -0,0 +1,168 @@
+"""
+Tests of the proxy handlers, in an application with the settings of a hub.
+"""
+from jhproxy import (MultiPortProxyHandler, ProxyHandler,
+                     StreamingProxyHandler)
+from jhproxy.routes import PortPolicy, user_routes
+from tests.utils import PROXY_PORT, HubTestCase
+import json
+import unittest
+
+try:
+    import pycurl # pylint: disable=unused-import
+except ImportError:
+    pycurl = None
+
+
+class ProxyTest(HubTestCase):
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT)),
+        ]
+
+    def test_get(self):
+        self.add_user('alice')
+        response = self.fetch('/proxy/alice/path?a=1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['path'], 'path')
+        self.assertEqual(self.fetch('/proxy/bob/path').code, 404)
+
+    def test_methods(self):
+        """The hub's XSRF check does not apply to the proxied requests."""
+        self.add_user('alice', token='secret')
+        for method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            body = None if method == 'DELETE' else b'data'
+            response = self.fetch('/proxy/alice/path', method=method,
+                                  body=body,
+                                  headers={'X-Proxy-Token': 'secret'})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body), {
+                'method': method,
+                'path': 'path',
+                'body': 0 if body is None else len(body),
+            })
+
+    def test_token(self):
+        spawner = self.add_user('alice', token='secret')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 403)
+        self.assertEqual(
+            self.fetch('/proxy/alice/',
+                       headers={'X-Proxy-Token': 'secret'}).code, 200)
+        # The indexed route follows the changes of the tokens
+        spawner.set_token('')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 200)
+
+
+class StreamingProxyTest(HubTestCase):
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/([^/]+)(/.*)', StreamingProxyHandler,
+             dict(proxy_port=PROXY_PORT, max_body_size=64 * 1024**2)),
+        ]
+
+    def test_upload(self):
+        """A large upload is streamed to the upstream."""
+        self.add_user('alice', token='secret')
+        body = b'x' * (16 * 1024**2)
+        for method in ('POST', 'PUT'):
+            response = self.fetch('/proxy/alice/upload', method=method,
+                                  body=body,
+                                  headers={'X-Proxy-Token': 'secret'})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body)['body'], len(body))
+        self.assertEqual(
+            self.fetch('/proxy/alice/upload', method='POST', body=body).code,
+            403)
+
+
+@unittest.skipIf(pycurl is None, "pycurl is not installed")
+class CurlProxyTest(HubTestCase):
+    """The 'curl' backend, with the uploads streamed by the simple one."""
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT, upstream_client='curl')),
+            (r'/streaming/([^/]+)(/.*)', StreamingProxyHandler,
+             dict(proxy_port=PROXY_PORT, upstream_client='curl')),
+        ]
+
+    def test_methods(self):
+        self.add_user('alice')
+        for prefix in ('proxy', 'streaming'):
+            for method, body in (('GET', None), ('POST', b'x' * 100000)):
+                response = self.fetch('/{}/alice/path'.format(prefix),
+                                      method=method, body=body)
+                self.assertEqual(response.code, 200)
+                self.assertEqual(json.loads(response.body)['body'],
+                                 len(body or b''))
+
+
+class UserRouteIndexTest(HubTestCase):
+    """The routes indexed in `jhproxy.routes.user_routes` are not stale."""
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT)),
+        ]
+
+    def test_user_recreated(self):
+        self.add_user('alice')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 200)
+        self.assertIsNotNone(user_routes.get('alice'))
+
+        self.delete_user('alice')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 404)
+        self.assertIsNone(user_routes.get('alice'))
+
+        # A new user with the same name, whose proxy needs a token
+        spawner = self.add_user('alice', token='secret')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 403)
+        self.assertIs(user_routes.get('alice').spawner, spawner)
+
+    def test_user_recreated_indexed(self):
+        """A route still indexed is dropped when the user is recreated."""
+        self.add_user('alice')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 200)
+        self.delete_user('alice')
+        spawner = self.add_user('alice', token='secret')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 403)
+        self.assertIs(user_routes.get('alice').spawner, spawner)
+
+    def test_spawner_stopped(self):
+        spawner = self.add_user('alice')
+        self.assertEqual(self.fetch('/proxy/alice/').code, 200)
+        self.io_loop.run_sync(spawner.stop)
+        self.assertIsNone(user_routes.get('alice'))
+        self.assertEqual(self.fetch('/proxy/alice/').code, 200)
+        self.assertIs(user_routes.get('alice').spawner, spawner)
+
+
+class MultiPortProxyTest(HubTestCase):
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/(\d+)/([^/]+)(/.*)', MultiPortProxyHandler,
+             dict(port_policy=PortPolicy([5000]))),
+        ]
+
+    def setUp(self):
+        super().setUp()
+        self.spawner = self.add_user('alice')
+        self.spawner.host_ports[6000] = self.upstream_port
+
+    def test_policy(self):
+        self.assertEqual(self.fetch('/proxy/5000/alice/').code, 200)
+        self.assertEqual(self.fetch('/proxy/6000/alice/').code, 404)
+
+    def test_spawner_ports(self):
+        """The ports of the spawner replace the ones of the policy."""
+        self.spawner.proxy_allowed_ports = [6000]
+        self.assertEqual(self.fetch('/proxy/6000/alice/').code, 200)
+        self.assertEqual(self.fetch('/proxy/5000/alice/').code, 404)
+        self.spawner.proxy_allowed_ports = None
+        self.assertEqual(self.fetch('/proxy/5000/alice/').code, 200)
@@ -0,0 +1,91 @@
+"""
+Tests of the websockets proxied by the `ProxyHandler` (`jhproxy.relay`).
+"""
+from tornado import gen, web, websocket
+from tornado.httpclient import HTTPClientError
+from tornado.testing import gen_test
+from jhproxy import ProxyHandler
+from jhproxy.relay import open_websockets
+from tests.utils import PROXY_PORT, HubTestCase
+import time
+
+
+class EchoHandler(websocket.WebSocketHandler):
+    """Echo the messages, and close the websocket on 'close'."""
+
+    def on_message(self, message):
+        if message == 'close':
+            self.close()
+            return
+        self.write_message(message, binary=isinstance(message, bytes))
+
+
+class RelayTest(HubTestCase):
+
+    def get_handlers(self):
+        return [
+            (r'/proxy/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT, max_websockets_per_user=1)),
+            (r'/idle/([^/]+)(/.*)', ProxyHandler,
+             dict(proxy_port=PROXY_PORT, websocket_idle_timeout=0.2)),
+        ]
+
+    def get_upstream_app(self):
+        return web.Application([(r'/.*', EchoHandler)])
+
+    def setUp(self):
+        super().setUp()
+        self.add_user('alice')
+
+    def connect(self, prefix='proxy'):
+        return websocket.websocket_connect(
+            'ws://127.0.0.1:{}/{}/alice/ws'.format(self.get_http_port(),
+                                                   prefix))
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=5):
+        """Wait until condition() is true."""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_relay(self):
+        connection = yield self.connect()
+        connection.write_message('hello')
+        self.assertEqual((yield connection.read_message()), 'hello')
+        connection.write_message(b'\x00' * 100000, binary=True)
+        self.assertEqual((yield connection.read_message()), b'\x00' * 100000)
+        connection.close()
+
+    @gen_test
+    def test_idle_timeout(self):
+        connection = yield self.connect('idle')
+        connection.write_message('hello')
+        self.assertEqual((yield connection.read_message()), 'hello')
+        start = time.monotonic()
+        self.assertIsNone((yield connection.read_message()))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        yield self.wait_for(lambda: not open_websockets['alice'])
+
+    @gen_test
+    def test_max_websockets(self):
+        connection = yield self.connect()
+        self.assertEqual(open_websockets['alice'], 1)
+        with self.assertRaises(HTTPClientError) as context:
+            yield self.connect()
+        self.assertEqual(context.exception.code, 429)
+
+        # Closed by the client
+        connection.close()
+        yield self.wait_for(lambda: not open_websockets['alice'])
+        connection = yield self.connect()
+
+        # Closed by the upstream
+        connection.write_message('close')
+        self.assertIsNone((yield connection.read_message()))
+        yield self.wait_for(lambda: not open_websockets['alice'])
+        connection = yield self.connect()
+        connection.close()
+        yield self.wait_for(lambda: not open_websockets['alice'])
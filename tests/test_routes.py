@@ -0,0 +1,79 @@
+"""
+Tests of `jhproxy.routes`.
+"""
+from jhproxy.routes import PortPolicy
+import json
+import os
+
+
+def write_ports(path, ports, mtime):
+    """Write the ports to the file, with the given modification time."""
+    with open(path, 'w') as ports_file:
+        ports_file.write(ports if isinstance(ports, str) else
+                         json.dumps(ports))
+    os.utime(path, (mtime, mtime))
+
+
+def test_policy():
+    policy = PortPolicy([5000, '6000'])
+    assert policy.allows(5000)
+    assert policy.allows(6000)
+    assert not policy.allows(7000)
+    policy.set([7000])
+    assert policy.allows(7000)
+    assert not policy.allows(5000)
+    assert not PortPolicy().allows(5000)
+
+
+def test_watch(tmp_path, clock):
+    path = str(tmp_path / 'ports.json')
+    write_ports(path, [5000], 1000)
+    policy = PortPolicy(reload_interval=5)
+    policy.watch(path)
+    assert policy.allows(5000)
+
+    # Checked again only after the interval
+    write_ports(path, [6000], 2000)
+    assert policy.allows(5000)
+    clock[0] += 5
+    assert policy.allows(6000)
+    assert not policy.allows(5000)
+
+    # Read again only if modified
+    write_ports(path, [7000], 2000)
+    clock[0] += 5
+    assert policy.allows(6000)
+    write_ports(path, [7000], 3000)
+    policy.reload()
+    assert policy.allows(7000)
+
+
+def test_watch_errors(tmp_path, clock):
+    """The current ports are kept while the file cannot be read."""
+    path = str(tmp_path / 'ports.json')
+    write_ports(path, [5000], 1000)
+    policy = PortPolicy(reload_interval=5)
+    policy.watch(path)
+
+    write_ports(path, '[5000, ', 2000)
+    clock[0] += 5
+    assert policy.allows(5000)
+
+    write_ports(path, {'port': 6000}, 3000)
+    clock[0] += 5
+    assert policy.allows(5000)
+
+    os.remove(path)
+    clock[0] += 5
+    assert policy.allows(5000)
+
+    write_ports(path, [6000], 4000)
+    clock[0] += 5
+    assert policy.allows(6000)
+    assert not policy.allows(5000)
+
+
+def test_watch_missing(tmp_path):
+    policy = PortPolicy([5000])
+    policy.watch(str(tmp_path / 'missing.json'))
+    assert policy.allows(5000)
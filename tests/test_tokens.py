@@ -0,0 +1,171 @@
+"""
+Tests of `jhproxy.tokens`, of the rotation of the tokens of
+`TokenizedDockerSpawner`, and of the `ProxyTokenHandler`.
+"""
+from jhproxy import ProxyTokenHandler
+from jhproxy.spawners import TokenizedDockerSpawner
+from jhproxy.tokens import DEFAULT_TOKEN, TokenSet, hash_token
+from tests.utils import HubTestCase
+import json
+import time
+
+
+def test_modes():
+    spawner = TokenizedDockerSpawner()
+    tokens = spawner.proxy_tokens
+    assert tokens.mode == 'disabled'
+    spawner.set_token('')
+    assert tokens.mode == 'allow_all'
+    spawner.set_token('secret')
+    assert tokens.mode == 'tokens'
+    assert tokens.verify('secret') == hash_token('secret')
+    assert tokens.verify('other') is None
+    spawner.set_token(None)
+    assert tokens.mode == 'disabled'
+    assert not tokens
+
+
+def test_same_token_replaced():
+    """A token added under a second name replaces the first one."""
+    tokens = TokenSet()
+    tokens.add('first', 'secret')
+    tokens.add('second', 'secret')
+    assert [token['name'] for token in tokens.describe()] == ['second']
+    tokens.remove('second')
+    assert tokens.verify('secret') is None
+
+
+def test_expiry(monkeypatch):
+    now = time.time()
+    tokens = TokenSet()
+    tokens.add('short', 'short-token', expires=now + 10)
+    tokens.add('long', 'long-token', expires=now + 100)
+    assert tokens.verify('short-token') is not None
+
+    monkeypatch.setattr(time, 'time', lambda: now + 50)
+    assert tokens.verify('short-token') is None
+    assert 'short' not in tokens
+    assert tokens.verify('long-token') is not None
+
+    monkeypatch.setattr(time, 'time', lambda: now + 200)
+    tokens.prune()
+    assert not tokens
+
+
+def test_state():
+    """Only the digests are saved, the tokens survive a reload."""
+    tokens = TokenSet()
+    tokens.add('named', 'secret', expires=time.time() + 100)
+    state = tokens.get_state()
+    assert 'secret' not in repr(state)
+
+    loaded = TokenSet()
+    loaded.load_state(state)
+    assert loaded.mode == 'tokens'
+    assert loaded.verify('secret') is not None
+    assert loaded.get_token('named') is None
+
+    tokens.load_state(state)
+    assert tokens.get_token('named') == 'secret'
+
+
+def test_free_name():
+    tokens = TokenSet()
+    assert tokens.get_free_name('prefix') == 'prefix-1'
+    tokens.add('prefix-1')
+    assert tokens.get_free_name('prefix') == 'prefix-2'
+
+
+def test_rotation_grace(monkeypatch):
+    """Each rotated token is accepted for the grace period."""
+    now = time.time()
+    spawner = TokenizedDockerSpawner(token_rotation_grace_period=60)
+    spawner.set_token('first')
+    spawner.regenerate_random_token()
+    second = spawner.proxy_tokens.get_token(DEFAULT_TOKEN)
+
+    monkeypatch.setattr(time, 'time', lambda: now + 30)
+    spawner.regenerate_random_token()
+    third = spawner.proxy_tokens.get_token(DEFAULT_TOKEN)
+    for token in ('first', second, third):
+        assert spawner.proxy_tokens.verify(token) is not None
+    assert len(spawner.proxy_tokens) == 3
+
+    monkeypatch.setattr(time, 'time', lambda: now + 70)
+    assert spawner.proxy_tokens.verify('first') is None
+    assert spawner.proxy_tokens.verify(second) is not None
+
+    monkeypatch.setattr(time, 'time', lambda: now + 100)
+    spawner.regenerate_random_token()
+    assert spawner.proxy_tokens.verify(second) is None
+    assert spawner.proxy_tokens.verify(third) is not None
+    assert len(spawner.proxy_tokens) == 2
+
+
+def test_rotation_without_grace():
+    spawner = TokenizedDockerSpawner(token_rotation_grace_period=0)
+    spawner.set_token('first')
+    spawner.regenerate_random_token()
+    assert spawner.proxy_tokens.verify('first') is None
+    assert len(spawner.proxy_tokens) == 1
+
+
+class TokenAuthProxyTokenHandler(ProxyTokenHandler):
+    """A ProxyTokenHandler authenticated by the API tokens of the tests."""
+    _accept_token_auth = True
+
+
+class ProxyTokenHandlerTest(HubTestCase):
+
+    def get_handlers(self):
+        return [(r'/proxytoken/', TokenAuthProxyTokenHandler)]
+
+    def setUp(self):
+        super().setUp()
+        self.spawner = self.add_user('alice', token='secret')
+        self.headers = {
+            'Authorization': 'token ' + self.new_api_token('alice'),
+        }
+
+    def get(self, query=''):
+        return self.fetch('/proxytoken/' + query, headers=self.headers)
+
+    def test_get(self):
+        response = self.get()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), 'secret')
+
+    def test_hashed(self):
+        """After a restart, only the digest of the token is known."""
+        tokens = self.spawner.proxy_tokens
+        state = tokens.get_state()
+        tokens.clear('disabled')
+        tokens.load_state(state)
+        response = self.get()
+        self.assertEqual(response.code, 404)
+        self.assertIn(b'only its hash is stored', response.body)
+
+    def test_named_only(self):
+        self.spawner.add_named_token('ci')
+        self.spawner.remove_named_token(DEFAULT_TOKEN)
+        response = self.get()
+        self.assertEqual(response.code, 404)
+        self.assertIn(b'no default proxy token', response.body)
+
+    def test_list(self):
+        now = time.time()
+        self.spawner.add_named_token('ci', expires_in=60)
+        response = self.get('?list')
+        self.assertEqual(response.code, 200)
+        result = json.loads(response.body)
+        self.assertEqual(result['mode'], 'tokens')
+        self.assertEqual([token['name'] for token in result['tokens']],
+                         ['ci', DEFAULT_TOKEN])
+        self.assertAlmostEqual(result['tokens'][0]['expires'], now + 60,
+                               delta=5)
+        self.assertIsNone(result['tokens'][1]['expires'])
+        self.assertNotIn(b'secret', response.body)
+
+        self.spawner.set_token(None)
+        self.assertEqual(json.loads(self.get('?list').body),
+                         {'mode': 'disabled', 'tokens': []})
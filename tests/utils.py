@@ -0,0 +1,126 @@
+"""
+Helpers of the tests of the handlers: a hub in memory (database, users and
+the settings of its tornado application), whose spawners map the ports of
+their "containers" to local servers instead of asking docker.
+"""
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port
+from tornado.httpserver import HTTPServer
+from jupyterhub import orm, roles
+from jupyterhub.auth import Authenticator
+from jupyterhub.objects import Hub
+from jupyterhub.user import UserDict
+from jhproxy.routes import route_cache, user_routes
+from jhproxy.spawners import TokenizedDockerSpawner
+
+# The port proxied inside the containers
+PROXY_PORT = 5000
+
+
+class MockSpawner(TokenizedDockerSpawner):
+    """
+    A TokenizedDockerSpawner whose container maps the ports of `host_ports`
+    ({port in the container: port on 127.0.0.1}), without docker.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.host_ip = '127.0.0.1'
+        self.host_ports = {}
+        self.object_id = 'container-{}'.format(self.user.name)
+
+    @gen.coroutine
+    def docker(self, method, *args, **kwargs):
+        if method != 'inspect_container':
+            return None
+        raise gen.Return({'NetworkSettings': {'Ports': {
+            '{}/tcp'.format(port): [{'HostIp': self.host_ip,
+                                     'HostPort': str(host_port)}]
+            for port, host_port in self.host_ports.items()
+        }}})
+
+
+class UpstreamHandler(web.RequestHandler):
+    """The service in the containers: echo the request."""
+
+    def get(self, path):
+        self.write({
+            'method': self.request.method,
+            'path': path,
+            'body': len(self.request.body),
+        })
+
+    post = put = patch = delete = get
+
+
+class HubTestCase(AsyncHTTPTestCase):
+    """
+    Test the handlers of `get_handlers`, in an application with the
+    settings of a hub (with `xsrf_cookies`, as in JupyterHub >= 4.1), and
+    the upstream application of `get_upstream_app` on a local port.
+    """
+
+    def setUp(self):
+        self.db = orm.new_session_factory('sqlite://')()
+        self.hub_settings = {
+            'db': self.db,
+            'hub': Hub(),
+            'authenticator': Authenticator(),
+            'cookie_secret': b'secret' * 6,
+            'xsrf_cookies': True,
+            'login_url': '/hub/login',
+            'spawner_class': MockSpawner,
+        }
+        # As in the hub, the users share the session of the handlers
+        self.users = self.hub_settings['users'] = UserDict(
+            lambda: self.db, self.hub_settings)
+        for role in roles.get_default_roles():
+            roles.create_role(self.db, role)
+        # The client of the API tokens created by the hub
+        self.db.add(orm.OAuthClient(identifier='jupyterhub'))
+        self.db.commit()
+        super().setUp()
+        sock, self.upstream_port = bind_unused_port()
+        self.upstream = HTTPServer(self.get_upstream_app())
+        self.upstream.add_sockets([sock])
+
+    def tearDown(self):
+        self.upstream.stop()
+        user_routes.remove()
+        route_cache.invalidate()
+        super().tearDown()
+        self.db.close()
+
+    def get_handlers(self):
+        raise NotImplementedError()
+
+    def get_app(self):
+        return web.Application(self.get_handlers(), **self.hub_settings)
+
+    def get_upstream_app(self):
+        return web.Application([(r'/(.*)', UpstreamHandler)])
+
+    def add_user(self, name, token='', admin=False):
+        """
+        Add a user whose container maps PROXY_PORT to the upstream, and
+        return its spawner.
+        """
+        orm_user = orm.User(name=name, admin=admin)
+        self.db.add(orm_user)
+        self.db.commit()
+        roles.assign_default_roles(self.db, orm_user)
+        spawner = self.users.add(orm_user).spawners['']
+        spawner.host_ports[PROXY_PORT] = self.upstream_port
+        spawner.set_token(token)
+        return spawner
+
+    def new_api_token(self, name, scopes=None):
+        """
+        Return a new API token of a user (with the given scopes, by default
+        the ones of the user).
+        """
+        return orm.User.find(self.db, name).new_api_token(scopes=scopes)
+
+    def delete_user(self, name):
+        """Delete a user, as the hub does."""
+        self.users.delete(self.users[name])